@@ -2,32 +2,117 @@ import csv
 import json
 import sys
 import traceback
+from itertools import chain, islice
+
+X_COLUMNS = ["lng", "longitude", "long", "lon", "x", "X", "X coordinate", "x coordinate", "easting", "Easting"]
+Y_COLUMNS = ["lat", "latitude", "y", "Y", "Y Coordinate", "y coordinate", "northing", "Northing" ]
+CSV_SAMPLE_ROWS = 1000 # Rows read to infer the type of each column
+
+def find_coordinate_columns(fields):
+    ''' Returns the indices of the X and Y columns of a CSV header row '''
+    x_column = None
+    y_column = None
+    for column_counter, column in enumerate(fields):
+        if column in X_COLUMNS:
+            x_column = column_counter
+        if column in Y_COLUMNS:
+            y_column = column_counter
+    if x_column is None or y_column is None:
+        raise ValueError("Could not find X and Y columns in " + ", ".join(fields))
+    return x_column, y_column
+
+def has_leading_zero(value):
+    ''' True for numbers written with a leading zero, such as codes and ZIP codes, which are kept as text '''
+    digits = value.strip().lstrip("+-")
+    return len(digits) > 1 and digits[0] == "0" and digits[1].isdigit()
+
+def infer_column_type(values):
+    ''' Returns int, float or None (left as text) for the non empty values of a column '''
+    values = [value for value in values if value != ""]
+    if not values or any(has_leading_zero(value) for value in values):
+        return None
+    for column_type in (int, float):
+        try:
+            for value in values:
+                column_type(value)
+            return column_type
+        except ValueError:
+            pass
+    return None
+
+def convert_value(value, column_type):
+    ''' Returns a value as its column's type, None when it is empty, raising ValueError when it does not fit '''
+    if column_type is None:
+        return value
+    if value == "":
+        return None
+    if has_leading_zero(value):
+        raise ValueError("Leading zero in " + repr(value))
+    return column_type(value)
+
+def widen_column_type(value, column_type):
+    ''' Returns the type a column must widen to for a value that does not fit it, or None when none will do '''
+    if column_type is int:
+        try:
+            convert_value(value, float)
+            return float
+        except ValueError:
+            pass
+    return None
+
+def iter_csv_features(input_csv, sample_rows=CSV_SAMPLE_ROWS, mismatches=None):
+    '''
+    Yields a point feature for every row of a CSV file, with numeric columns typed from a sample
+    of rows. An int column is widened to float by a later float value. Other values past the
+    sample that do not fit their column are loaded as None, so a column never mixes numbers and
+    text, and are counted in mismatches, a dictionary of column name to their rows, first row
+    number and first value, when it is given.
+    '''
+    with open(input_csv, 'rb') as file:
+        reader = csv.reader(file)
+        fields = next(reader)
+        x_column, y_column = find_coordinate_columns(fields)
+        sample = list(islice(reader, sample_rows))
+        column_types = [infer_column_type([row[index] for row in sample if index < len(row)]) for index in xrange(len(fields))]
+        properties_columns = [(index, field) for index, field in enumerate(fields) if index != x_column]
+
+        for row_number, row in enumerate(chain(sample, reader), 1):
+            if not row:
+                continue
+            properties = {}
+            for index, field in properties_columns:
+                try:
+                    properties[field] = convert_value(row[index], column_types[index])
+                except ValueError:
+                    wider_type = widen_column_type(row[index], column_types[index])
+                    if wider_type:
+                        # The values already loaded are numbers all the same
+                        column_types[index] = wider_type
+                        properties[field] = wider_type(row[index])
+                    else:
+                        properties[field] = None
+                        if mismatches is not None:
+                            mismatch = mismatches.setdefault(field, { "rows" : 0, "first_row" : row_number, "value" : row[index] })
+                            mismatch["rows"] += 1
+            yield {
+                "type": "Feature",
+                "geometry": {"type": "Point", "coordinates": [float(row[x_column]), float(row[y_column])]},
+                "properties": properties
+            }
 
 def csv_to_geojson(input_csv, output_name):
     ''' Takes point data in CSV format, with some form of position fields and converts them to GeoJSON'''
 
     print input_csv, output_name
 
-    X_COLUMNS = ["lng", "longitude", "long", "lon", "x", "X", "X coordinate", "x coordinate", "easting", "Easting"]
-    Y_COLUMNS = ["lat", "latitude", "y", "Y", "Y Coordinate", "y coordinate", "northing", "Northing" ]
-
     with open(input_csv, 'rb') as file:
         features = []
         reader = csv.reader(file)
         row_counter = 0
         for row in reader:
             if row_counter == 0:
-                column_counter = 0
                 fields = row
-                for column in row:
-                    if column in X_COLUMNS:
-                        x_column = column_counter
-                    if column in Y_COLUMNS:
-                        y_column = column_counter
-                    column_counter += 1
-
-                if not x_column and not y_column:
-                    raise ValueError('A very specific bad thing happened')
+                x_column, y_column = find_coordinate_columns(fields)
             else:
                 x = row[x_column]
                 y = row[y_column]
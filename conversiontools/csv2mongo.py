@@ -0,0 +1,42 @@
+from csv2geojson import *
+from geojson2mongo import *
+from os import path
+import traceback
+import sys
+
+def csv_to_mongodb(database, input_csv, collection_name=None, host=None, output_name=None, mismatches=None, **load_options):
+    ''' Streams the rows of a point CSV into a collection, also writing them to output_name as GeoJSON if given.
+        Values that did not fit their column's type are counted in mismatches if given, or else printed '''
+    db = get_load_database(database, host)
+    if not collection_name:
+        collection_name = path.splitext(path.basename(input_csv))[0]
+
+    reported = mismatches is not None
+    mismatches = mismatches if reported else {}
+    features = iter_csv_features(input_csv, mismatches=mismatches)
+    if output_name:
+        features = write_features(features, output_name)
+    loaded = ingest_features(db, collection_name, features, input_csv, **load_options)
+    if not reported:
+        for column, mismatch in sorted(mismatches.items()):
+            print "Loaded", mismatch["rows"], "values of", column, "that did not fit its type as null, the first on row", mismatch["first_row"], ":", repr(mismatch["value"])
+    return loaded
+
+if __name__ == '__main__':
+
+    try:
+        if len(sys.argv) < 4:
+            print "Usage: csv2mongo.py database input.csv collection_name [output.geojson]"
+        else:
+            database = str(sys.argv[1])
+            input_csv = str(sys.argv[2])
+            collection_name = sys.argv[3]
+            output_name = sys.argv[4] if len(sys.argv) > 4 else None
+            print "Processing: \n", input_csv, "\nPushing into ", database, " as ", collection_name
+            csv_to_mongodb(database, input_csv, collection_name, output_name=output_name)
+            print "CSV successfully loaded into database", database, "as", collection_name
+
+    except:
+        error = sys.exc_info()[0]
+        print "There was an error: ", error
+        print traceback.format_exc()
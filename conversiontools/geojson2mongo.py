@@ -1,29 +1,375 @@
 import json
-from pymongo import MongoClient
+from pymongo import UpdateOne, GEOSPHERE
+from pymongo.errors import OperationFailure
+import threading
+import Queue
+import time
 import sys
+import os
 from os import path
+from uuid import uuid4
+from datetime import datetime
+from validategeojson import ValidationReport, InvalidGeoJSON, VALIDATION_MODES, iter_validated_features
+from simplifygeojson import build_levels_of_detail, LOD_FIELD, LOD_ZOOMS, LOD_METHOD
+from topology import LINE_TYPES
+from mongoconnection import *
 import traceback
 
+# Callables run with (database, collection_name) after a collection has been written to
+WRITE_LISTENERS = []
 
-def feature_collection_to_mongodb(database, file_name, collection_name=None, host="localhost"):
-    print file_name
-    client = MongoClient(host, 27017)
-    db = client[database]
+def register_write_listener(listener):
+    """Call listener(database, collection_name) whenever a loader writes to a collection"""
+    WRITE_LISTENERS.append(listener)
+
+def notify_write(database, collection_name):
+    for listener in WRITE_LISTENERS:
+        listener(database, collection_name)
+
+# Callables run with (database, collection_name, loaded, seconds, invalid) after each load
+LOAD_LISTENERS = []
+
+def register_load_listener(listener):
+    """Call listener(database, collection_name, loaded, seconds, invalid) when a load finishes, for ingestion rates"""
+    LOAD_LISTENERS.append(listener)
+
+def notify_load(database, collection_name, loaded, elapsed, invalid):
+    for listener in LOAD_LISTENERS:
+        listener(database, collection_name, loaded, elapsed, invalid)
+
+# The CPU heavy parts of a load (parsing, validating and numbering features, and simplifying
+# them) go through run_in_cpu_executor. They run in the caller's thread unless a server that
+# serves many requests per thread sets an executor, while Mongo is always written from the
+# caller's thread
+cpu_executor = None
+
+def set_cpu_executor(executor):
+    """Run CPU heavy work as executor(function, *args, **kwargs), or in the caller's thread if None"""
+    global cpu_executor
+    cpu_executor = executor
+
+def run_in_cpu_executor(function, *args, **kwargs):
+    """Return function(*args, **kwargs), run by the CPU executor if one is set"""
+    if cpu_executor is None:
+        return function(*args, **kwargs)
+    return cpu_executor(function, *args, **kwargs)
+
+def iter_in_cpu_executor(iterable):
+    """Yield the values of an iterable, each made by the CPU executor if one is set"""
+    iterator = iter(iterable)
+    finished = object()
+    while True:
+        value = run_in_cpu_executor(next, iterator, finished)
+        if value is finished:
+            return
+        yield value
+
+# Per database collection holding each loaded collection's content version and load time
+METADATA_COLLECTION = "loxo_metadata"
+
+def set_content_version(db, collection_name):
+    """Give a collection a new content version, used by the API for ETag and Last-Modified headers"""
+    db[METADATA_COLLECTION].update_one(
+        {"_id" : collection_name},
+        {"$set" : {"version" : uuid4().hex, "modified" : datetime.utcnow()}},
+        upsert=True
+    )
+
+
+# Features are parsed from the file a chunk at a time and written in unordered batches, so
+# memory use depends on the batch size and the largest feature, not on the size of the file.
+
+LOAD_READ_SIZE = 1024 * 1024
+LOAD_BATCH_SIZE = int(os.environ.get("LOXO_LOAD_BATCH_SIZE", 1000))
+LOAD_WRITERS = int(os.environ.get("LOXO_LOAD_WRITERS", 1))
+LOAD_REPORT_EVERY = 100000 # Features between progress reports
+LOAD_VALIDATION = os.environ.get("LOXO_LOAD_VALIDATION", "skip") # skip or reject invalid features, or none
+JSON_WHITESPACE = " \t\n\r"
+
+class FeatureStreamParser(object):
+    """Incrementally parses the features array of a GeoJSON FeatureCollection from a file object"""
+
+    def __init__(self, data_file, read_size=LOAD_READ_SIZE):
+        self.file = data_file
+        self.read_size = read_size
+        self.decoder = json.JSONDecoder()
+        self.buffer = ""
+        self.position = 0
+        self.finished = False
+
+    def read_more(self):
+        """Append the next chunk of the file to the unconsumed part of the buffer"""
+        chunk = self.file.read(self.read_size)
+        if not chunk:
+            self.finished = True
+            return False
+        self.buffer = self.buffer[self.position:] + chunk
+        self.position = 0
+        return True
+
+    def peek(self):
+        """Return the next character that is not whitespace"""
+        while True:
+            while self.position < len(self.buffer) and self.buffer[self.position] in JSON_WHITESPACE:
+                self.position += 1
+            if self.position < len(self.buffer):
+                return self.buffer[self.position]
+            if not self.read_more():
+                raise ValueError("Unexpected end of GeoJSON")
+
+    def expect(self, characters):
+        """Consume the next character, which must be one of characters, and return it"""
+        character = self.peek()
+        if character not in characters:
+            raise ValueError("Expected one of " + repr(characters) + " but found " + repr(character))
+        self.position += 1
+        return character
+
+    def decode_value(self):
+        """Decode the next JSON value, reading more of the file until it is complete"""
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.position)
+                # A number at the very end of the buffer may continue in the next chunk
+                if end < len(self.buffer) or self.finished:
+                    self.position = end
+                    return value
+            except ValueError:
+                if self.finished:
+                    raise
+            self.read_more()
+
+    def __iter__(self):
+        self.expect("{")
+        if self.peek() == "}":
+            return
+        while True:
+            key = self.decode_value()
+            self.expect(":")
+            if key == "features":
+                self.expect("[")
+                if self.peek() == "]":
+                    self.position += 1
+                else:
+                    while True:
+                        yield self.decode_value()
+                        if self.expect(",]") == "]":
+                            break
+            else:
+                self.decode_value()
+            if self.expect(",}") == "}":
+                return
+
+def iter_geojson_features(data_file, read_size=LOAD_READ_SIZE):
+    """Yield the features of a GeoJSON FeatureCollection file object one at a time"""
+    return iter(FeatureStreamParser(data_file, read_size))
+
+def write_features(features, output_name):
+    """
+    Pass features through while writing them to a GeoJSON FeatureCollection file, compactly
+    and one feature per line, so the file is written as the features are consumed.
+    """
+    if not output_name.endswith(".geojson"):
+        output_name += ".geojson"
+    with open(output_name, "w") as outfile:
+        outfile.write('{"type":"FeatureCollection","features":[\n')
+        for count, feature in enumerate(features):
+            if count:
+                outfile.write(",\n")
+            json.dump(feature, outfile, separators=(',', ':'))
+            yield feature
+        outfile.write("\n]}\n")
+
+def print_load_rate(loaded, elapsed, source=None):
+    features = "features from " + source if source else "features"
+    print "Loaded", loaded, features, "in %.1fs" % elapsed, "(%.0f features/s)" % (loaded / max(elapsed, 1e-9))
+
+def load_progress_printer(every=LOAD_REPORT_EVERY):
+    """Return a progress callback that prints the load rate every so many features"""
+    reported = [0]
+    def progress(loaded, elapsed):
+        if loaded // every != reported[0] // every:
+            print_load_rate(loaded, elapsed)
+        reported[0] = loaded
+    return progress
+
+def iter_feature_batches(features, batch_size, first_id=0):
+    """Group features into lists of batch_size, numbering them with loxo_id as they go"""
+    batch = []
+    for loxo_id, feature in enumerate(features, first_id):
+        if not feature.get("properties"):
+            feature["properties"] = {}
+        feature["properties"]["loxo_id"] = loxo_id
+        batch.append(feature)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def load_features(collection, features, batch_size=LOAD_BATCH_SIZE, writers=LOAD_WRITERS, progress=None):
+    """
+    Insert an iterable of features into a collection in unordered insert_many batches, giving
+    each a loxo_id, and return how many were loaded. With more than one writer, batches are
+    inserted by that many threads, each using its own pooled connection. progress, if given,
+    is called with (features loaded, seconds elapsed) after every batch.
+    """
+    batch_size = max(1, int(batch_size))
+    writers = max(1, int(writers))
+    started = time.time()
+    loaded = [0]
+    lock = threading.Lock()
+
+    def write(batch):
+        collection.insert_many(batch, ordered=False)
+        with lock:
+            loaded[0] += len(batch)
+            if progress:
+                progress(loaded[0], time.time() - started)
+
+    # Features are read, validated and numbered a batch at a time by the CPU executor
+    batches = iter_in_cpu_executor(iter_feature_batches(features, batch_size))
+    if writers == 1:
+        for batch in batches:
+            write(batch)
+        return loaded[0]
+
+    # A bounded queue keeps the parser at most a few batches ahead of the writers
+    queue = Queue.Queue(maxsize=writers * 2)
+    errors = []
+
+    def writer():
+        while True:
+            batch = queue.get()
+            if batch is None:
+                return
+            if not errors:
+                try:
+                    write(batch)
+                except Exception as err:
+                    errors.append(err)
+
+    threads = [threading.Thread(target=writer) for _ in xrange(writers)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    try:
+        for batch in batches:
+            if errors:
+                break
+            queue.put(batch)
+    finally:
+        for thread in threads:
+            queue.put(None)
+        for thread in threads:
+            thread.join()
+    if errors:
+        raise errors[0]
+    return loaded[0]
+
+def store_levels_of_detail(collection, zooms=LOD_ZOOMS, method=LOD_METHOD, batch_size=LOAD_BATCH_SIZE):
+    """
+    Store simplified copies of a collection's lines and polygons under LOD_FIELD, one per zoom
+    level. Their borders are simplified together, so every line and polygon geometry is read
+    into memory at once. Returns how many features were given levels.
+    """
+    if not zooms:
+        return 0
+    find = { "geometry.type" : { "$in" : LINE_TYPES + ["GeometryCollection"] } }
+    features = list(collection.find(find, { "_id" : 0, "geometry" : 1, "properties.loxo_id" : 1 }))
+    if not features:
+        return 0
+    levels = run_in_cpu_executor(build_levels_of_detail, [feature.get("geometry") for feature in features], zooms, method)
+    updates = [UpdateOne({ "properties.loxo_id" : feature["properties"]["loxo_id"] }, { "$set" : { LOD_FIELD : level } })
+               for feature, level in zip(features, levels) if level]
+    for start in xrange(0, len(updates), batch_size):
+        collection.bulk_write(updates[start:start + batch_size], ordered=False)
+    return len(updates)
+
+def create_spatial_index(collection):
+    """
+    Give a collection a 2dsphere index on geometry, which serves spatial queries on every
+    geometry type. Returns None, or Mongo's error if a geometry it considers invalid (such as
+    a self-intersecting polygon) stopped the index being built.
+    """
+    try:
+        collection.create_index([("geometry", GEOSPHERE)], background=True)
+    except OperationFailure as err:
+        print "Could not build a 2dsphere index on", collection.name, ":", err
+        return str(err)
+    return None
+
+def finish_load(db, collection_name):
+    """Index, version and announce a collection once its features have been loaded"""
+    # Keyset paging walks the collection in loxo_id order, and levels of detail are stored by it
+    db[collection_name].create_index([("properties.loxo_id", 1)], background=True)
+    create_spatial_index(db[collection_name])
+    started = time.time()
+    simplified = store_levels_of_detail(db[collection_name])
+    if simplified:
+        print "Stored levels of detail for", simplified, "features in %.1fs" % (time.time() - started)
+    set_content_version(db, collection_name)
+    notify_write(db.name, collection_name)
+
+def retire_failed_load(db, collection_name):
+    """
+    Version and announce a collection whose load failed part way, as the batches already
+    inserted stay in it, so that cached responses of its old content are not served
+    """
+    try:
+        if collection_name not in db.collection_names():
+            return
+        set_content_version(db, collection_name)
+    except Exception as err:
+        print "Could not record a new content version for", collection_name, ":", err
+    notify_write(db.name, collection_name)
+
+def ingest_features(db, collection_name, features, source, validation=LOAD_VALIDATION, report=None,
+                    batch_size=LOAD_BATCH_SIZE, writers=LOAD_WRITERS, progress=None):
+    """
+    Validate, load and finish a stream of features in a single pass, returning how many were
+    loaded. In skip mode invalid features are left out, in reject mode the first one stops the
+    load with InvalidGeoJSON (dropping the collection if this load created it). Problems are
+    recorded in report, a ValidationReport, when one is given. A load that fails for any other
+    reason still gives the collection a new content version, for what it did write.
+    """
+    if validation and validation != "none":
+        if report is None:
+            report = ValidationReport()
+        features = iter_validated_features(features, report, validation)
+
+    started = time.time()
+    existed = collection_name in db.collection_names()
+    finished = False
+    try:
+        loaded = load_features(db[collection_name], features, batch_size, writers, progress or load_progress_printer())
+        elapsed = time.time() - started
+        print_load_rate(loaded, elapsed, source)
+        notify_load(db.name, collection_name, loaded, elapsed, report.invalid if report is not None else 0)
+        if report is not None and report.invalid:
+            print "Skipped", report.invalid, "invalid features from", source
+
+        finish_load(db, collection_name)
+        finished = True
+    except InvalidGeoJSON:
+        if not existed:
+            db.drop_collection(collection_name)
+        raise
+    finally:
+        if not finished:
+            retire_failed_load(db, collection_name)
+    return loaded
+
+def feature_collection_to_mongodb(database, file_name, collection_name=None, host=None, **load_options):
+    db = get_load_database(database, host)
     if not collection_name:
         collection_name = path.splitext(path.basename(file_name))[0]
     if not file_name.endswith(".geojson"):
        file_name += ".geojson"
-    with open(file_name) as data_file:
-        data = json.load(data_file)
-        features = data["features"]
-        id = 0
-        for feature in features:
-            #print feature
-            print db
-            print db[collection_name]
-            feature["properties"]["loxo_id"] = id
-            db[collection_name].insert(feature)
-            id += 1
+
+    with open(file_name, "rb") as data_file:
+        return ingest_features(db, collection_name, iter_geojson_features(data_file), file_name, **load_options)
 
 if __name__ == '__main__':
 
@@ -1,18 +1,16 @@
-from pymongo import MongoClient
+from geojson2mongo import *
 import requests
 from os import path
 import sys
 
-def feature_collection_endpoint_to_mongodb(database, url, collection_name=None):
-
-    client = MongoClient('localhost', 27017)
-    db = client[database]
+def feature_collection_endpoint_to_mongodb(database, url, collection_name=None, host=None, **load_options):
+    db = get_load_database(database, host)
     if not collection_name:
         collection_name = path.splitext(path.basename(url))[0]
-    features = requests.get(url).json()["features"]
-    # print features
-    for feature in features:
-        db[collection_name].insert(feature)
+    response = requests.get(url, stream=True)
+    response.raise_for_status()
+    response.raw.decode_content = True
+    return ingest_features(db, collection_name, iter_geojson_features(response.raw), url, **load_options)
 
             
 if __name__ == '__main__':
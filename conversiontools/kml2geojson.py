@@ -1,17 +1,171 @@
-import xml.dom.minidom as dom
+import xml.etree.cElementTree as ElementTree
 from kml import kml
-import json
+from geojson2mongo import write_features
 import sys
 import traceback
 
-def kml_to_geojson(kml_file, output_name):
+# KML is read with iterparse, so each Placemark becomes a feature as soon as its end tag
+# is parsed and is then cleared. The features match kml.build_feature_collection, whose
+# minidom lookups by tag name are reproduced here over each Placemark's own elements.
+
+GX_NAMESPACE = "http://www.google.com/kml/ext/2.2"
+
+def tag_name(element):
+    ''' Returns an element's tag as minidom names it, gx: prefixed for the Google extension namespace '''
+    tag = element.tag
+    if tag[0] == "{":
+        namespace, tag = tag[1:].split("}", 1)
+        if namespace == GX_NAMESPACE:
+            return "gx:" + tag
+    return tag
+
+def get(element, name):
+    ''' Returns the descendants of an element with the given tag name, in document order '''
+    return [child for child in element.iter() if child is not element and tag_name(child) == name]
+
+def get1(element, name):
+    found = get(element, name)
+    return found[0] if found else None
+
+def val(element):
+    ''' Returns the text an element starts with, or an empty string '''
+    if element is None or element.text is None:
+        return ''
+    return element.text
+
+def valf(element):
+    try:
+        return float(val(element))
+    except ValueError:
+        return None
+
+def gx_coords(element):
+    return {
+        'coordinates': [kml.gx_coords1(val(coord)) for coord in get(element, 'gx:coord')],
+        'times': [val(when) for when in get(element, 'when')],
+    }
 
-    kml_one = dom.parse(kml_file) # parse KML file using minidom
-    if not output_name.endswith(".geojson"):
-            output_name += ".geojson"
-    with open( output_name, 'w') as outfile:
-        output = kml.build_feature_collection(kml_one)
-        json.dump(output, outfile, indent=4)
+def build_geometry(element):
+    ''' Returns the geometries and track times of a Placemark, as kml.build_geometry does '''
+    for multi in ('MultiGeometry', 'MultiTrack', 'gx:MultiTrack'):
+        multi_element = get1(element, multi)
+        if multi_element is not None:
+            return build_geometry(multi_element)
+
+    geoms = []
+    times = []
+    for geotype in kml.GEOTYPES:
+        for geonode in get(element, geotype):
+            if geotype == 'Point':
+                geoms.append({'type': 'Point', 'coordinates': kml.coords1(val(get1(geonode, 'coordinates')))})
+            elif geotype == 'LineString':
+                geoms.append({'type': 'LineString', 'coordinates': kml.coords(val(get1(geonode, 'coordinates')))})
+            elif geotype == 'Polygon':
+                rings = [kml.coords(val(get1(ring, 'coordinates'))) for ring in get(geonode, 'LinearRing')]
+                geoms.append({'type': 'Polygon', 'coordinates': rings})
+            else:
+                track = gx_coords(geonode)
+                geoms.append({'type': 'LineString', 'coordinates': track['coordinates']})
+                if track['times']:
+                    times.append(track['times'])
+    return {'geoms': geoms, 'times': times}
+
+def build_style_properties(props, poly_style, line_style):
+    ''' Adds the stroke and fill properties of a Placemark's inline PolyStyle and LineStyle '''
+    if poly_style is not None:
+        color = val(get1(poly_style, 'color'))
+        if color:
+            rgb, opacity = kml.build_rgb_and_opacity(color)
+            props['fill'] = rgb
+            props['fill-opacity'] = opacity
+            # Set default border style
+            props['stroke'] = rgb
+            props['stroke-opacity'] = opacity
+            props['stroke-width'] = 1
+        fill = valf(get1(poly_style, 'fill'))
+        if fill == 0:
+            props['fill-opacity'] = fill
+        elif fill == 1 and 'fill-opacity' not in props:
+            props['fill-opacity'] = fill
+        outline = valf(get1(poly_style, 'outline'))
+        if outline == 0:
+            props['stroke-opacity'] = outline
+        elif outline == 1 and 'stroke-opacity' not in props:
+            props['stroke-opacity'] = outline
+    if line_style is not None:
+        color = val(get1(line_style, 'color'))
+        if color:
+            rgb, opacity = kml.build_rgb_and_opacity(color)
+            props['stroke'] = rgb
+            props['stroke-opacity'] = opacity
+        width = valf(get1(line_style, 'width'))
+        if width:
+            props['stroke-width'] = width
+
+def build_feature(placemark):
+    ''' Returns the GeoJSON feature of a parsed Placemark element, or None if it has no geometry '''
+    geoms_and_times = build_geometry(placemark)
+    if not geoms_and_times['geoms']:
+        return None
+
+    props = {}
+    name = get1(placemark, 'name')
+    if name is not None:
+        props['name'] = val(name)
+    description = val(get1(placemark, 'description'))
+    if description:
+        props['description'] = description
+    style_url = get1(placemark, 'styleUrl')
+    if style_url is not None:
+        style_url = val(style_url)
+        if not style_url.startswith('#'):
+            style_url = '#' + style_url
+        props['styleUrl'] = style_url
+    build_style_properties(props, get1(placemark, 'PolyStyle'), get1(placemark, 'LineStyle'))
+    extended_data = get1(placemark, 'ExtendedData')
+    if extended_data is not None:
+        for data in get(extended_data, 'Data'):
+            props[data.get('name', '')] = val(get1(data, 'value'))
+        for simple_data in get(extended_data, 'SimpleData'):
+            props[simple_data.get('name', '')] = val(simple_data)
+    time_span = get1(placemark, 'TimeSpan')
+    if time_span is not None:
+        props['timeSpan'] = {'begin': val(get1(time_span, 'begin')), 'end': val(get1(time_span, 'end'))}
+    times = geoms_and_times['times']
+    if times:
+        props['times'] = times[0] if len(times) == 1 else times
+
+    feature = {'type': 'Feature', 'properties': props}
+    geoms = geoms_and_times['geoms']
+    if len(geoms) == 1:
+        feature['geometry'] = geoms[0]
+    else:
+        feature['geometry'] = {'type': 'GeometryCollection', 'geometries': geoms}
+    if placemark.get('id'):
+        feature['id'] = placemark.get('id')
+    return feature
+
+def iter_kml_features(kml_file):
+    ''' Yields a GeoJSON feature for every Placemark in a KML file, parsing it incrementally '''
+    ancestors = []
+    for event, element in ElementTree.iterparse(kml_file, events=("start", "end")):
+        if event == "start":
+            ancestors.append(element)
+            continue
+        ancestors.pop()
+        if tag_name(element) == "Placemark":
+            feature = build_feature(element)
+            if feature is not None:
+                yield feature
+            # Free the Placemark, so memory does not grow with the number already read
+            element.clear()
+            if ancestors:
+                ancestors[-1].remove(element)
+
+def kml_to_geojson(kml_file, output_name):
+    ''' Converts a KML file to a compact GeoJSON FeatureCollection, one Placemark at a time '''
+    for _ in write_features(iter_kml_features(kml_file), output_name):
+        pass
 
 
 if __name__ == '__main__':
@@ -31,4 +185,4 @@ if __name__ == '__main__':
     except:
         error = sys.exc_info()[0]
         print "There was an error: ", error, "\n"
-        print traceback.format_exc()
\ No newline at end of file
+        print traceback.format_exc()
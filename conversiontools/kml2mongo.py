@@ -0,0 +1,34 @@
+from kml2geojson import *
+from geojson2mongo import *
+from os import path
+import traceback
+import sys
+
+def kml_to_mongodb(database, input_kml, collection_name=None, host=None, output_name=None, **load_options):
+    ''' Streams the Placemarks of a KML file into a collection, also writing them to output_name as GeoJSON if given '''
+    db = get_load_database(database, host)
+    if not collection_name:
+        collection_name = path.splitext(path.basename(input_kml))[0]
+
+    features = iter_kml_features(input_kml)
+    if output_name:
+        features = write_features(features, output_name)
+    return ingest_features(db, collection_name, features, input_kml, **load_options)
+
+if __name__ == '__main__':
+
+    try:
+        if len(sys.argv) < 4:
+            print "Usage: kml2mongo.py database input.kml collection_name"
+        else:
+            database = str(sys.argv[1])
+            input_kml = str(sys.argv[2])
+            collection_name = sys.argv[3]
+            print "Processing: \n", input_kml, "\nPushing into ", database, " as ", collection_name
+            kml_to_mongodb(database, input_kml, collection_name)
+            print "KML successfully loaded into database", database, "as", collection_name
+
+    except:
+        error = sys.exc_info()[0]
+        print "There was an error: ", error
+        print traceback.format_exc()
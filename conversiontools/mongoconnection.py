@@ -0,0 +1,124 @@
+from pymongo import MongoClient, WriteConcern
+from pymongo.read_preferences import ReadPreference
+from pymongo.errors import PyMongoError
+import threading
+import os
+
+# One pooled MongoClient per process, shared by the API, the stats and tiles endpoints and the
+# loaders. Clients are made on first use rather than at import, and made again in a process
+# whose pid has changed, so a server that forks its workers after importing Loxo gives each
+# worker its own pool instead of sharing sockets with its parent. Settings come from the
+# environment, with the Docker link variables naming the host.
+
+MONGO_URI = os.environ.get("LOXO_MONGO_URI") # A mongodb:// URI, for replica sets, used in place of host and port
+MONGO_HOST = os.environ.get("LOXO_DB_1_PORT_27017_TCP_ADDR", "localhost")
+MONGO_PORT = int(os.environ.get("LOXO_DB_1_PORT_27017_TCP_PORT", 27017))
+MONGO_MAX_POOL_SIZE = int(os.environ.get("LOXO_MONGO_MAX_POOL_SIZE", 100)) # Sockets per process
+MONGO_MIN_POOL_SIZE = int(os.environ.get("LOXO_MONGO_MIN_POOL_SIZE", 0))
+MONGO_CONNECT_TIMEOUT_MS = int(os.environ.get("LOXO_MONGO_CONNECT_TIMEOUT_MS", 5000))
+MONGO_SERVER_SELECTION_TIMEOUT_MS = int(os.environ.get("LOXO_MONGO_SERVER_SELECTION_TIMEOUT_MS", 5000))
+MONGO_SOCKET_TIMEOUT_MS = int(os.environ.get("LOXO_MONGO_SOCKET_TIMEOUT_MS", 0)) or None # None waits forever
+MONGO_CHECK_TIMEOUT_MS = 1000 # How long server_available waits for a server
+
+# Bulk loads trade acknowledgement for speed as configured, "w" as a number or "majority"
+LOAD_WRITE_CONCERN = os.environ.get("LOXO_LOAD_WRITE_CONCERN", "1")
+LOAD_JOURNAL = os.environ.get("LOXO_LOAD_JOURNAL") == "1"
+
+READ_PREFERENCES = {
+    "primary" : ReadPreference.PRIMARY,
+    "primaryPreferred" : ReadPreference.PRIMARY_PREFERRED,
+    "secondary" : ReadPreference.SECONDARY,
+    "secondaryPreferred" : ReadPreference.SECONDARY_PREFERRED,
+    "nearest" : ReadPreference.NEAREST,
+}
+STATS_READ_PREFERENCE = os.environ.get("LOXO_STATS_READ_PREFERENCE", "primary") # Heavy stats reads may go to secondaries
+
+def get_write_concern(w=LOAD_WRITE_CONCERN, journal=LOAD_JOURNAL):
+    ''' Returns the WriteConcern for a w setting from the environment, a number or a tag such as majority '''
+    if str(w).isdigit():
+        w = int(w)
+    return WriteConcern(w=w, j=journal or None)
+
+def get_read_preference(name=STATS_READ_PREFERENCE):
+    if name not in READ_PREFERENCES:
+        raise ValueError("Unknown read preference " + str(name) + ", must be one of " + ", ".join(sorted(READ_PREFERENCES)))
+    return READ_PREFERENCES[name]
+
+class MongoConnection(object):
+    ''' Lazily made, fork safe MongoClients, one per host, with the pool and timeout settings '''
+
+    def __init__(self, uri=MONGO_URI, host=MONGO_HOST, port=MONGO_PORT, **options):
+        self.uri = uri
+        self.host = host
+        self.port = port
+        self.options = {
+            "maxPoolSize" : MONGO_MAX_POOL_SIZE,
+            "minPoolSize" : MONGO_MIN_POOL_SIZE,
+            "connectTimeoutMS" : MONGO_CONNECT_TIMEOUT_MS,
+            "serverSelectionTimeoutMS" : MONGO_SERVER_SELECTION_TIMEOUT_MS,
+            "socketTimeoutMS" : MONGO_SOCKET_TIMEOUT_MS,
+        }
+        self.options.update(options)
+        self.clients = {}
+        self.pid = None
+        self.lock = threading.Lock()
+
+    def make_client(self, host, **options):
+        settings = dict(self.options, **options)
+        if host is None and self.uri:
+            return MongoClient(self.uri, connect=False, **settings)
+        return MongoClient(host or self.host, self.port, connect=False, **settings)
+
+    def client(self, host=None):
+        ''' The client for host, the configured server by default, made for this process '''
+        if host == self.host:
+            host = None
+        with self.lock:
+            if self.pid != os.getpid():
+                # Clients inherited over a fork share their parent's sockets, so are left unused
+                self.clients = {}
+                self.pid = os.getpid()
+            if host not in self.clients:
+                self.clients[host] = self.make_client(host)
+            return self.clients[host]
+
+    def get_database(self, database, host=None):
+        return self.client(host)[database]
+
+    def get_load_database(self, database, host=None):
+        ''' A database whose writes use the bulk load write concern '''
+        return self.client(host).get_database(database, write_concern=get_write_concern())
+
+    def get_stats_database(self, database, host=None):
+        ''' A database whose reads use the stats read preference, to spread heavy reads over a replica set '''
+        return self.client(host).get_database(database, read_preference=get_read_preference())
+
+    def server_available(self, timeout_ms=MONGO_CHECK_TIMEOUT_MS):
+        ''' Returns None if a server answers within timeout_ms, otherwise the error '''
+        client = self.make_client(None, serverSelectionTimeoutMS=timeout_ms)
+        try:
+            client.admin.command("ping")
+            return None
+        except PyMongoError as err:
+            return err
+        finally:
+            client.close()
+
+    def close(self):
+        with self.lock:
+            if self.pid == os.getpid():
+                for client in self.clients.values():
+                    client.close()
+            self.clients = {}
+
+
+mongo = MongoConnection()
+
+def get_database(database, host=None):
+    return mongo.get_database(database, host)
+
+def get_load_database(database, host=None):
+    return mongo.get_load_database(database, host)
+
+def get_stats_database(database, host=None):
+    return mongo.get_stats_database(database, host)
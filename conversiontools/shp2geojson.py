@@ -1,26 +1,57 @@
 import sys
-from json import dumps
 import shapefile
 import traceback
+import zipfile
+import datetime
+from io import BytesIO
+from os import path
+from geojson2mongo import write_features
+from simplifygeojson import simplify_geometry
 
-def shapefile_to_geojson(input_shp, output_name):
-    ''' Takes point data in CSV format, with some form of position fields and converts them to GeoJSON'''
+def open_shapefile(input_shp):
+    ''' Returns a shapefile Reader for a .shp file, or for the first .shp found inside a .zip archive '''
+    if not input_shp.lower().endswith(".zip"):
+        return shapefile.Reader(input_shp)
 
-    # read the shapefile
-    reader = shapefile.Reader(input_shp)
-    fields = reader.fields[1:]
-    field_names = [field[0] for field in fields]
-    buffer = []
-    for sr in reader.shapeRecords():
-        atr = dict(zip(field_names, sr.record))
-        geom = sr.shape.__geo_interface__
-        buffer.append(dict(type="Feature", geometry=geom, properties=atr))
+    # The members are read into memory rather than extracted, the Reader needs to seek in them
+    with zipfile.ZipFile(input_shp) as archive:
+        names = [name for name in archive.namelist() if not name.startswith("__MACOSX")]
+        shps = [name for name in names if path.splitext(name)[1].lower() == ".shp"]
+        if not shps:
+            raise ValueError("No .shp file found in " + input_shp)
+        # The .dbf and .shx are the members sharing the first .shp's name, whatever their case
+        basename = path.splitext(shps[0])[0].lower()
+        members = { ".shp" : shps[0] }
+        for name in names:
+            stem, extension = path.splitext(name)
+            if stem.lower() == basename and extension.lower() in (".dbf", ".shx"):
+                members.setdefault(extension.lower(), name)
+        if ".dbf" not in members:
+            raise ValueError("No .dbf file found for " + shps[0] + " in " + input_shp)
+        parts = dict((extension[1:], BytesIO(archive.read(name))) for extension, name in members.items())
+    return shapefile.Reader(**parts)
 
-    # write the GeoJSON file
+def record_value(value):
+    ''' Converts dbf values that GeoJSON and BSON cannot hold as they are '''
+    if isinstance(value, datetime.date):
+        return value.isoformat()
+    return value
 
-    geojson = open(output_name + ".geojson", "w")
-    geojson.write(dumps({"type": "FeatureCollection", "features": buffer}, indent=2) + "\n")
-    geojson.close()
+def iter_shapefile_features(input_shp, tolerance=None, precision=None):
+    ''' Yields a GeoJSON feature for every shape record, reading one record at a time '''
+    reader = open_shapefile(input_shp)
+    field_names = [field[0] for field in reader.fields[1:]]
+    for sr in reader.iterShapeRecords():
+        atr = dict(zip(field_names, [record_value(value) for value in sr.record]))
+        geom = sr.shape.__geo_interface__ if sr.shape.shapeType != shapefile.NULL else None
+        yield dict(type="Feature", geometry=simplify_geometry(geom, tolerance, precision), properties=atr)
+
+def shapefile_to_geojson(input_shp, output_name, tolerance=None, precision=None):
+    ''' Takes a Shapefile (or a zip of one) and converts it to GeoJSON, one feature at a time.
+        Coordinates can optionally be simplified to tolerance degrees and rounded to precision decimal places '''
+
+    for _ in write_features(iter_shapefile_features(input_shp, tolerance, precision), output_name):
+        pass
 
     ## Based on code from http://geospatialpython.com/2013/07/shapefile-to-geojson.html
     ## Joel Lawhead 2013
@@ -35,11 +66,13 @@ if __name__ == '__main__':
         else:
             input_shp = str(sys.argv[1])
             output_name = str(sys.argv[2])
+            tolerance = float(sys.argv[3]) if len(sys.argv) > 3 else None
+            precision = int(sys.argv[4]) if len(sys.argv) > 4 else None
             print "Converting", input_shp, "to", output_name + ".geojson"
-            shapefile_to_geojson(input_shp, output_name)
+            shapefile_to_geojson(input_shp, output_name, tolerance, precision)
             print "...Done!"
 
     except:
         error = sys.exc_info()[0]
         print "There was an error: ", error, "\n"
-        print traceback.format_exc()
\ No newline at end of file
+        print traceback.format_exc()
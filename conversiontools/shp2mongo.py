@@ -0,0 +1,37 @@
+from shp2geojson import *
+from geojson2mongo import *
+from os import path
+import traceback
+import sys
+
+def shapefile_to_mongodb(database, input_shp, collection_name=None, host=None, tolerance=None, precision=None,
+                         output_name=None, **load_options):
+    ''' Streams the records of a Shapefile (or a zip of one) into a collection, also writing them to output_name as GeoJSON if given '''
+    db = get_load_database(database, host)
+    if not collection_name:
+        collection_name = path.splitext(path.basename(input_shp))[0]
+
+    features = iter_shapefile_features(input_shp, tolerance, precision)
+    if output_name:
+        features = write_features(features, output_name)
+    return ingest_features(db, collection_name, features, input_shp, **load_options)
+
+if __name__ == '__main__':
+
+    try:
+        if len(sys.argv) < 4:
+            print "Usage: shp2mongo.py database input.shp|input.zip collection_name [tolerance] [precision]"
+        else:
+            database = str(sys.argv[1])
+            input_shp = str(sys.argv[2])
+            collection_name = sys.argv[3]
+            tolerance = float(sys.argv[4]) if len(sys.argv) > 4 else None
+            precision = int(sys.argv[5]) if len(sys.argv) > 5 else None
+            print "Processing: \n", input_shp, "\nPushing into ", database, " as ", collection_name
+            shapefile_to_mongodb(database, input_shp, collection_name, tolerance=tolerance, precision=precision)
+            print "Shapefile successfully loaded into database", database, "as", collection_name
+
+    except:
+        error = sys.exc_info()[0]
+        print "There was an error: ", error
+        print traceback.format_exc()
@@ -0,0 +1,173 @@
+import numpy as np
+import heapq
+import os
+from topology import build_topology, shape_to_geometry, iter_lines
+
+# Optional coordinate reduction applied to geometries as they are converted. Lines and
+# rings are simplified with Douglas-Peucker and coordinates are rounded to a number of
+# decimal places. Parts that would collapse below a valid size are left as they were.
+
+MINIMUM_POINTS = { "line" : 2, "ring" : 4 }
+
+# Levels of detail stored with lines and polygons at ingest, one per zoom level, each
+# simplified to about a pixel of a 256 pixel web map tile at that zoom
+LOD_FIELD = "loxo_lod"
+LOD_ZOOMS = [int(zoom) for zoom in os.environ.get("LOXO_LOD_ZOOMS", "0,3,6,9,12").split(",") if zoom.strip()]
+LOD_METHOD = os.environ.get("LOXO_LOD_METHOD", "douglas-peucker")
+
+def douglas_peucker(points, tolerance):
+    ''' Returns a boolean mask of the points kept by Douglas-Peucker simplification at tolerance '''
+    points = np.asarray(points, dtype=np.float64)[:, :2]
+    keep = np.zeros(len(points), dtype=bool)
+    keep[0] = keep[-1] = True
+    stack = [(0, len(points) - 1)]
+    while stack:
+        first, last = stack.pop()
+        if last - first < 2:
+            continue
+        start = points[first]
+        segment = points[last] - start
+        offsets = points[first + 1:last] - start
+        length = np.hypot(segment[0], segment[1])
+        if length == 0:
+            # Closed rings start and end on the same point, measure from that point
+            distances = np.hypot(offsets[:, 0], offsets[:, 1])
+        else:
+            distances = np.abs(segment[0] * offsets[:, 1] - segment[1] * offsets[:, 0]) / length
+        farthest = distances.argmax()
+        if distances[farthest] > tolerance:
+            split = first + 1 + farthest
+            keep[split] = True
+            stack.append((first, split))
+            stack.append((split, last))
+    return keep
+
+def visvalingam(points, tolerance):
+    ''' Returns a boolean mask of the points kept by Visvalingam-Whyatt simplification, which
+        removes points whose triangle with their neighbours has an area below tolerance squared '''
+    points = np.asarray(points, dtype=np.float64)[:, :2]
+    count = len(points)
+    keep = np.ones(count, dtype=bool)
+    previous = range(-1, count - 1)
+    following = range(1, count + 1)
+
+    def area(index):
+        (x1, y1), (x2, y2), (x3, y3) = points[previous[index]], points[index], points[following[index]]
+        return abs((x2 - x1) * (y3 - y1) - (x3 - x1) * (y2 - y1)) / 2
+
+    areas = [0.0] + [area(index) for index in xrange(1, count - 1)] + [0.0]
+    heap = [(areas[index], index) for index in xrange(1, count - 1)]
+    heapq.heapify(heap)
+    threshold = tolerance * tolerance
+    removed = 0.0
+    while heap:
+        point_area, index = heapq.heappop(heap)
+        if not keep[index] or point_area != areas[index]:
+            continue # Stale, the point was removed or its area changed with a neighbour
+        if point_area >= threshold:
+            break
+        keep[index] = False
+        # A point's area is never less than one already removed, so removal goes in order
+        removed = max(removed, point_area)
+        before, after = previous[index], following[index]
+        following[before], previous[after] = after, before
+        for neighbour in (before, after):
+            if 0 < neighbour < count - 1:
+                areas[neighbour] = max(area(neighbour), removed)
+                heapq.heappush(heap, (areas[neighbour], neighbour))
+    return keep
+
+SIMPLIFY_METHODS = { "douglas-peucker" : douglas_peucker, "visvalingam" : visvalingam }
+
+def quantize_coordinates(coordinates, precision):
+    ''' Rounds coordinates to precision decimal places, dropping points that become repeats '''
+    quantized = []
+    for coordinate in coordinates:
+        coordinate = [round(value, precision) for value in coordinate]
+        if not quantized or coordinate != quantized[-1]:
+            quantized.append(coordinate)
+    return quantized
+
+def simplify_line(coordinates, tolerance=None, precision=None, kind="line"):
+    ''' Simplifies and quantizes a line or ring, returning it unchanged if it would become too short '''
+    simplified = coordinates
+    if tolerance and len(coordinates) > 2:
+        keep = douglas_peucker(coordinates, tolerance)
+        simplified = [coordinate for coordinate, kept in zip(coordinates, keep) if kept]
+    if precision is not None:
+        simplified = quantize_coordinates(simplified, precision)
+    if len(simplified) < MINIMUM_POINTS[kind]:
+        return coordinates
+    return simplified
+
+def simplify_geometry(geometry, tolerance=None, precision=None):
+    ''' Returns a copy of a GeoJSON geometry with its lines simplified and coordinates quantized '''
+    if geometry is None or (not tolerance and precision is None):
+        return geometry
+    geometry_type = geometry["type"]
+    if geometry_type == "GeometryCollection":
+        return { "type" : geometry_type, "geometries" : [simplify_geometry(part, tolerance, precision) for part in geometry["geometries"]] }
+
+    coordinates = geometry["coordinates"]
+    if geometry_type == "Point":
+        coordinates = [round(value, precision) for value in coordinates] if precision is not None else coordinates
+    elif geometry_type == "MultiPoint":
+        coordinates = quantize_coordinates(coordinates, precision) if precision is not None else coordinates
+    elif geometry_type == "LineString":
+        coordinates = simplify_line(coordinates, tolerance, precision)
+    elif geometry_type == "MultiLineString":
+        coordinates = [simplify_line(line, tolerance, precision) for line in coordinates]
+    elif geometry_type == "Polygon":
+        coordinates = [simplify_line(ring, tolerance, precision, "ring") for ring in coordinates]
+    elif geometry_type == "MultiPolygon":
+        coordinates = [[simplify_line(ring, tolerance, precision, "ring") for ring in polygon] for polygon in coordinates]
+    return { "type" : geometry_type, "coordinates" : coordinates }
+
+def zoom_tolerance(zoom):
+    ''' The size in degrees of a pixel at the equator on a 256 pixel web map tile at zoom '''
+    return 360.0 / (256 * 2 ** zoom)
+
+def count_positions(geometry):
+    return sum(len(line) for line, _ in iter_lines(geometry))
+
+def simplify_arcs(arcs, tolerance, method=LOD_METHOD):
+    ''' Simplifies every arc, always keeping their ends so that they still meet '''
+    mask = SIMPLIFY_METHODS[method]
+    simplified = []
+    for arc in arcs:
+        if len(arc) > 2:
+            arc = [position for position, kept in zip(arc, mask(arc, tolerance)) if kept]
+        simplified.append(arc)
+    return simplified
+
+def build_levels_of_detail(geometries, zooms=LOD_ZOOMS, method=LOD_METHOD):
+    '''
+    Simplifies a list of geometries together at each zoom, so borders shared between them are
+    simplified the same way on both sides. Returns a dict of { zoom : geometry } per geometry,
+    holding only the levels that are smaller than the geometry itself. Parts too small for a
+    level are left out of it, and a geometry that would vanish keeps its next finer level.
+    '''
+    arcs, shapes = build_topology(geometries)
+    levels = [{} for _ in geometries]
+    finer = list(geometries)
+    sizes = [count_positions(geometry) for geometry in geometries]
+    for zoom in sorted(zooms, reverse=True):
+        simplified = simplify_arcs(arcs, zoom_tolerance(zoom), method)
+        for index, shape in enumerate(shapes):
+            geometry = shape_to_geometry(shape, simplified) or finer[index]
+            finer[index] = geometry
+            if count_positions(geometry) < sizes[index]:
+                levels[index][str(zoom)] = geometry
+    return levels
+
+def get_level_of_detail(zoom=None, tolerance=None, zooms=LOD_ZOOMS):
+    '''
+    Returns the stored level that serves a map zoom, or a simplification tolerance in degrees:
+    the coarsest one no coarser than asked for. None when only full detail will do.
+    '''
+    if zoom is not None:
+        tolerance = zoom_tolerance(zoom)
+    if tolerance is None:
+        return None
+    levels = [level for level in sorted(zooms) if zoom_tolerance(level) <= tolerance * (1 + 1e-9)]
+    return str(levels[0]) if levels else None
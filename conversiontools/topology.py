@@ -0,0 +1,180 @@
+import sys
+import json
+
+# Shared arcs for a set of GeoJSON geometries, as in TopoJSON. Lines and rings are cut
+# wherever they meet another line or ring, or leave it, and each stretch between those
+# junctions is kept once as an arc. Geometries are then lists of arc indexes, with ~index
+# for an arc followed backwards, so a border between two polygons is a single arc that
+# anything done to it (such as simplification) changes the same way for both sides.
+
+LINE_TYPES = ["LineString", "MultiLineString", "Polygon", "MultiPolygon"]
+MINIMUM_POINTS = { "line" : 2, "ring" : 4 }
+
+def iter_lines(geometry):
+    ''' Yields (coordinates, is ring) for every line and ring of a geometry '''
+    if geometry is None:
+        return
+    geometry_type = geometry["type"]
+    if geometry_type == "GeometryCollection":
+        for part in geometry["geometries"]:
+            for line in iter_lines(part):
+                yield line
+    elif geometry_type == "LineString":
+        yield geometry["coordinates"], False
+    elif geometry_type == "MultiLineString":
+        for line in geometry["coordinates"]:
+            yield line, False
+    elif geometry_type == "Polygon":
+        for ring in geometry["coordinates"]:
+            yield ring, True
+    elif geometry_type == "MultiPolygon":
+        for polygon in geometry["coordinates"]:
+            for ring in polygon:
+                yield ring, True
+
+def find_junctions(lines):
+    '''
+    Returns the set of positions where lines meet or part: the ends of every line, and every
+    position that is reached from different neighbours in different places
+    '''
+    junctions = set()
+    neighbours = {}
+    for line, ring in lines:
+        points = [tuple(position) for position in line]
+        if ring:
+            points = points[:-1]
+        elif points:
+            junctions.add(points[0])
+            junctions.add(points[-1])
+        count = len(points)
+        for index in xrange(0 if ring else 1, count if ring else count - 1):
+            point = points[index]
+            pair = frozenset((points[index - 1], points[(index + 1) % count]))
+            seen = neighbours.setdefault(point, pair)
+            if seen != pair:
+                junctions.add(point)
+    return junctions
+
+class Topology(object):
+    ''' The unique arcs of a set of geometries, added one line or ring at a time '''
+
+    def __init__(self, junctions):
+        self.junctions = junctions
+        self.arcs = []
+        self.index = {}
+
+    def add_arc(self, points):
+        ''' Returns the index of an arc, ~index if it is a known arc reversed, adding it if new '''
+        key = tuple(points)
+        if key in self.index:
+            return self.index[key]
+        reversed_key = key[::-1]
+        if reversed_key in self.index:
+            return ~self.index[reversed_key]
+        self.index[key] = len(self.arcs)
+        self.arcs.append([list(point) for point in points])
+        return self.index[key]
+
+    def add_line(self, line, ring=False):
+        ''' Cuts a line or ring into arcs at the junctions and returns their indexes '''
+        points = [tuple(position) for position in line]
+        if ring:
+            cuts = [index for index, point in enumerate(points[:-1]) if point in self.junctions]
+            if not cuts:
+                # A ring meeting nothing starts at its lowest point, so repeats of it match
+                start = points.index(min(points[:-1]))
+                return [self.add_arc(points[start:-1] + points[:start + 1])]
+            start = cuts[0]
+            points = points[start:-1] + points[:start + 1]
+        arcs = []
+        first = 0
+        for index in xrange(1, len(points)):
+            if index == len(points) - 1 or points[index] in self.junctions:
+                arcs.append(self.add_arc(points[first:index + 1]))
+                first = index
+        return arcs
+
+    def add_geometry(self, geometry):
+        ''' Returns a geometry with its lines and rings as lists of arc indexes, as TopoJSON does '''
+        if geometry is None:
+            return None
+        geometry_type = geometry["type"]
+        if geometry_type == "GeometryCollection":
+            return { "type" : geometry_type, "geometries" : [self.add_geometry(part) for part in geometry["geometries"]] }
+        coordinates = geometry["coordinates"]
+        if geometry_type == "LineString":
+            return { "type" : geometry_type, "arcs" : self.add_line(coordinates) }
+        if geometry_type == "MultiLineString":
+            return { "type" : geometry_type, "arcs" : [self.add_line(line) for line in coordinates] }
+        if geometry_type == "Polygon":
+            return { "type" : geometry_type, "arcs" : [self.add_line(ring, True) for ring in coordinates] }
+        if geometry_type == "MultiPolygon":
+            return { "type" : geometry_type, "arcs" : [[self.add_line(ring, True) for ring in polygon] for polygon in coordinates] }
+        return { "type" : geometry_type, "coordinates" : coordinates }
+
+def build_topology(geometries):
+    ''' Returns the shared arcs of a list of geometries, and the geometries in terms of them '''
+    junctions = find_junctions(line for geometry in geometries for line in iter_lines(geometry))
+    topology = Topology(junctions)
+    shapes = [topology.add_geometry(geometry) for geometry in geometries]
+    return topology.arcs, shapes
+
+def join_arcs(indexes, arcs, kind="line"):
+    ''' Joins arcs back into a line or ring, returning None if it has become too short '''
+    line = []
+    for index in indexes:
+        arc = arcs[index] if index >= 0 else arcs[~index][::-1]
+        line.extend(arc[1:] if line else arc)
+    if len(line) < MINIMUM_POINTS[kind]:
+        return None
+    return line
+
+def join_polygon(rings, arcs):
+    ''' Joins a polygon's rings, leaving out holes that have collapsed. None if the outer ring has '''
+    joined = [join_arcs(ring, arcs, "ring") for ring in rings]
+    if not joined or joined[0] is None:
+        return None
+    return [ring for ring in joined if ring is not None]
+
+def shape_to_geometry(shape, arcs):
+    '''
+    Rebuilds a GeoJSON geometry from add_geometry's shape and a list of arcs, such as simplified
+    copies of the topology's arcs. Collapsed parts are left out; None if nothing is left.
+    '''
+    if shape is None:
+        return None
+    geometry_type = shape["type"]
+    if geometry_type == "GeometryCollection":
+        parts = [shape_to_geometry(part, arcs) for part in shape["geometries"]]
+        parts = [part for part in parts if part is not None]
+        return { "type" : geometry_type, "geometries" : parts } if parts else None
+    if "arcs" not in shape:
+        return { "type" : geometry_type, "coordinates" : shape["coordinates"] }
+
+    if geometry_type == "LineString":
+        coordinates = join_arcs(shape["arcs"], arcs)
+    elif geometry_type == "MultiLineString":
+        coordinates = [line for line in (join_arcs(line, arcs) for line in shape["arcs"]) if line is not None] or None
+    elif geometry_type == "Polygon":
+        coordinates = join_polygon(shape["arcs"], arcs)
+    else:
+        coordinates = [polygon for polygon in (join_polygon(rings, arcs) for rings in shape["arcs"]) if polygon is not None] or None
+    if coordinates is None:
+        return None
+    return { "type" : geometry_type, "coordinates" : coordinates }
+
+
+if __name__ == '__main__':
+
+    try:
+        if len(sys.argv) == 1:
+            print "Input GeoJSON not specified"
+        else:
+            with open(sys.argv[1]) as data_file:
+                geometries = [feature.get("geometry") for feature in json.load(data_file)["features"]]
+            arcs, shapes = build_topology(geometries)
+            positions = sum(len(line) for geometry in geometries for line, _ in iter_lines(geometry))
+            print len(arcs), "arcs with", sum(len(arc) for arc in arcs), "positions, from", positions, "in the lines and rings"
+    except:
+        error = sys.exc_info()[0]
+        print "There was an error: ", error
@@ -1,88 +1,193 @@
+import numpy as np
 import json
 import sys
 
+# Single pass GeoJSON validation. Features are checked one at a time as they stream past,
+# with each feature's coordinates checked together as one array, and problems collected in
+# a ValidationReport rather than stopping at the first.
+
+#http://geojson.org/geojson-spec.html
+VALID_FEATURES = ["Point", "LineString", "Polygon", "MultiPoint", "MultiLineString","MultiPolygon", "GeometryCollection"]
+MAX_REPORTED_ERRORS = 100
+VALIDATION_MODES = ["skip", "reject"] # What ingestion does with invalid features
+
+class ValidationReport(object):
+    ''' Counts of valid and invalid features, with the first max_errors problems and the features they were in '''
+
+    def __init__(self, max_errors=MAX_REPORTED_ERRORS):
+        self.max_errors = max_errors
+        self.features = 0
+        self.invalid = 0
+        self.errors = []
+
+    def add(self, index, errors):
+        self.features += 1
+        if errors:
+            self.invalid += 1
+            for error in errors:
+                if len(self.errors) < self.max_errors:
+                    self.errors.append({ "feature" : index, "error" : error })
+
+    def add_document_error(self, error):
+        ''' Records a problem with the document itself, such as it not being a FeatureCollection '''
+        self.invalid += 1
+        self.errors.append({ "feature" : None, "error" : error })
+
+    def is_valid(self):
+        return self.features > 0 and self.invalid == 0
+
+    def to_dict(self):
+        return {
+            "features" : self.features,
+            "valid" : self.features - self.invalid,
+            "invalid" : self.invalid,
+            "errors" : self.errors,
+        }
+
+
+class InvalidGeoJSON(ValueError):
+    ''' Raised by ingestion in reject mode, carrying the report up to the invalid feature '''
+
+    def __init__(self, index, errors, report):
+        ValueError.__init__(self, "Feature " + str(index) + " is invalid: " + "; ".join(errors))
+        self.report = report
+
+
+def is_sequence(value):
+    return isinstance(value, (list, tuple))
+
+def position_errors(positions):
+    ''' Checks a list of positions together: numbers, at least x and y, finite and within longitude and latitude ranges '''
+    if not positions:
+        return ["Geometry has no coordinates"]
+    try:
+        array = np.array(positions)
+    except ValueError:
+        array = np.array(None)
+    if array.dtype == object:
+        # Mixed 2D and 3D positions are allowed, compare them on x and y
+        if not all(is_sequence(position) and len(position) >= 2 for position in positions):
+            return ["Coordinates must be arrays of at least two numbers"]
+        array = np.array([position[:2] for position in positions])
+    if array.ndim != 2 or array.shape[1] < 2 or array.dtype.kind not in "iuf":
+        return ["Coordinates must be arrays of at least two numbers"]
+
+    errors = []
+    array = array[:, :2].astype(np.float64)
+    if not np.isfinite(array).all():
+        errors.append("Coordinates must be finite")
+    elif (np.abs(array[:, 0]) > 180).any():
+        errors.append(str(int((np.abs(array[:, 0]) > 180).sum())) + " longitudes are outside -180 to 180")
+    elif (np.abs(array[:, 1]) > 90).any():
+        errors.append(str(int((np.abs(array[:, 1]) > 90).sum())) + " latitudes are outside -90 to 90")
+    return errors
+
+def line_errors(line, minimum, ring=False):
+    ''' Checks the structure of a line or ring, returning its errors '''
+    if not is_sequence(line) or len(line) < minimum:
+        return [("Rings" if ring else "LineStrings") + " need at least " + str(minimum) + " positions"]
+    if ring and not (is_sequence(line[0]) and is_sequence(line[-1])):
+        return ["Coordinates must be arrays of at least two numbers"]
+    if ring and list(line[0]) != list(line[-1]):
+        return ["Rings must be closed, with the same first and last position"]
+    return []
+
+def geometry_errors(geometry):
+    ''' Returns the problems with a GeoJSON geometry, an empty list if it is valid '''
+    if not isinstance(geometry, dict):
+        return ["Feature has no geometry"]
+    geometry_type = geometry.get("type")
+    if geometry_type not in VALID_FEATURES:
+        return ["Geometry type " + repr(geometry_type) + " is not one of " + ", ".join(VALID_FEATURES)]
+
+    if geometry_type == "GeometryCollection":
+        geometries = geometry.get("geometries")
+        if not is_sequence(geometries) or not geometries:
+            return ["GeometryCollection has no geometries"]
+        return [error for part in geometries for error in geometry_errors(part)]
+
+    coordinates = geometry.get("coordinates")
+    if not is_sequence(coordinates) or not coordinates:
+        return ["Geometry has no coordinates"]
+
+    # Check the nesting of each type, gathering its positions to check in one go
+    errors = []
+    if geometry_type == "Point":
+        positions = [coordinates]
+    elif geometry_type in ("MultiPoint", "LineString"):
+        positions = coordinates
+        if geometry_type == "LineString":
+            errors += line_errors(coordinates, 2)
+    else:
+        if geometry_type == "MultiPolygon":
+            if not all(is_sequence(polygon) and polygon for polygon in coordinates):
+                return ["MultiPolygons must be arrays of polygons"]
+            lines = [ring for polygon in coordinates for ring in polygon]
+        else:
+            lines = coordinates
+        ring = geometry_type != "MultiLineString"
+        for line in lines:
+            errors += line_errors(line, 4 if ring else 2, ring)
+        if errors:
+            return errors
+        positions = [position for line in lines for position in line]
+    return errors + position_errors(positions)
+
+def feature_errors(feature):
+    ''' Returns the problems with a GeoJSON feature, an empty list if it is valid '''
+    if not isinstance(feature, dict):
+        return ["Feature is not an object"]
+    if feature.get("type") != "Feature":
+        return ["Feature type must be 'Feature'"]
+    errors = []
+    if "properties" not in feature or not isinstance(feature["properties"], (dict, type(None))):
+        errors.append("Feature has no properties object")
+    return errors + geometry_errors(feature.get("geometry"))
+
+def iter_validated_features(features, report, mode="skip"):
+    ''' Yields the valid features of a stream, recording every feature in report.
+        Invalid features are dropped in skip mode, and raise InvalidGeoJSON in reject mode '''
+    for index, feature in enumerate(features):
+        errors = feature_errors(feature)
+        report.add(index, errors)
+        if not errors:
+            yield feature
+        elif mode == "reject":
+            raise InvalidGeoJSON(index, errors, report)
+
+def validate_features(features, max_errors=MAX_REPORTED_ERRORS):
+    ''' Validates a stream of features in one pass, returning a ValidationReport '''
+    report = ValidationReport(max_errors)
+    for _ in iter_validated_features(features, report):
+        pass
+    return report
+
+def validate_geojson_report(geojson_file, max_errors=MAX_REPORTED_ERRORS):
+    ''' Validates a GeoJSON file as it is read, returning a ValidationReport '''
+    from geojson2mongo import iter_geojson_features
+    report = ValidationReport(max_errors)
+    with open(geojson_file, "rb") as data_file:
+        try:
+            for _ in iter_validated_features(iter_geojson_features(data_file), report):
+                pass
+        except ValueError as err:
+            report.add_document_error("The file is not a GeoJSON FeatureCollection: " + str(err))
+    return report
+
 def validate_geojson_from_url(geojson_file, file=True):
     ''' Checks if GeoJSON file is valid; returns True if correct or False if invalid '''
-
-    with open(geojson_file) as data_file:
-        data = json.load(data_file)
-        #print data
-        return validate_geojson_from_dict(data)
+    return validate_geojson_report(geojson_file).is_valid()
 
 def validate_geojson_from_file(geojson_file, file=True):
     ''' Checks if GeoJSON file is valid; returns True if correct or False if invalid '''
-
-    with open(geojson_file) as data_file:
-        data = json.load(data_file)
-        #print data
-        return validate_geojson_from_dict(data)
+    return validate_geojson_report(geojson_file).is_valid()
 
 def validate_geojson_from_dict(data):
     ''' Checks if GeoJSON in dictionary form is valid; returns True if correct or False if invalid '''
-
-    #http://geojson.org/geojson-spec.html
-    VALID_FEATURES = ["Point", "LineString", "Polygon", "MultiPoint", "MultiLineString","MultiPolygon", "GeometryCollection"]
-
-    features = data["features"]
-    if not features:
+    features = data.get("features") if isinstance(data, dict) else None
+    if not is_sequence(features):
         return False
-
-    for feature in features:
-        try:
-            if not feature["type"]:
-                print "The feature: ", feature, "has no type field!"
-                return False
-            if not feature["properties"]:
-                print "The feature: ", feature, "has no properties field!"
-                return False
-            if not feature["geometry"]:
-                print "The feature: ", feature, "has no geometry!"
-                return False
-            if not feature["geometry"]["type"]:
-                print "The feature: ", feature, "has no type!"
-                return False
-            if feature["geometry"]["type"] not in VALID_FEATURES:
-                print "The feature: ", feature, "does not have a valid type! Must be in :", VALID_FEATURES
-                return False
-            if not feature["geometry"]["coordinates"]:
-                print "The feature: ", feature, "has no coordinates!"
-                return False
-            if feature["geometry"]["type"] == "Point" and len(feature["geometry"]["coordinates"]) < 2:
-                print "The feature: ", feature, "has less than one coordinate (i.e. missing x or y)"
-                return False
-            if feature["geometry"]["type"] != "Point" and len(feature["geometry"]["coordinates"][0]) < 1:
-                print "The feature: ", feature, "has less than one set of coordinate points"
-                return False
-            if feature["geometry"]["type"] == "Point":
-                for coord in feature["geometry"]["coordinates"]:
-                    try:
-                        float(coord)
-                    except ValueError:
-                        print coord, "in", feature, "is not a float"
-                        return False
-            if feature["geometry"]["type"] == "LineString":
-                for pair in feature["geometry"]["coordinates"]:
-                    try:
-                        float(pair[0])
-                        float(pair[1])
-                    except ValueError:
-                        print pair, "in", feature, "contains none float"
-                        return False
-            if feature["geometry"]["type"] == "Polygon":
-                for parts in feature["geometry"]["coordinates"]:
-                    print parts
-                    for part in parts:
-                        try:
-                            print part
-                            float(part[0])
-                            float(part[1])
-                        except ValueError:
-                            print parts, "in", feature, "contains none float"
-                            return False
-        except KeyError:
-            return False # The property was not found so we know the GeoJSON is malformed
-
-    return True
+    return validate_features(features).is_valid()
 
 
 if __name__ == '__main__':
@@ -92,11 +197,12 @@ if __name__ == '__main__':
             print "Input GeoJSON not specified"
         elif len(sys.argv) == 2:
             input_geojson = str(sys.argv[1])
-            valid = validate_geojson_from_file(input_geojson)
-            if valid:
+            report = validate_geojson_report(input_geojson)
+            if report.is_valid():
                 print "True: The GeoJSON is well formed and valid!"
-            elif not valid:
+            else:
                 print "False: The GeoJSON is not well formed and/or valid!"
+            print json.dumps(report.to_dict(), indent=2)
     except:
         error = sys.exc_info()[0]
-        print "There was an error: ", error
\ No newline at end of file
+        print "There was an error: ", error
@@ -1,39 +1,79 @@
-from pymongo import MongoClient, GEO2D, DESCENDING, errors
-from flask import Flask, make_response, request, Blueprint, render_template, redirect, url_for, send_from_directory
+from pymongo import GEOSPHERE, DESCENDING
+from flask import Flask, make_response, request, Blueprint, render_template, redirect, url_for, send_from_directory, Response, stream_with_context
 from bson.json_util import dumps
 from werkzeug.utils import secure_filename
-from ast import literal_eval
-from bson.son import SON
+from urllib import urlencode
 import json
 import os
 
 from loxoutils import *
 from loxostats import *
 from loxoerrors import *
+from loxojobs import *
+from loxotiles import *
+from loxoformats import *
+from loxoquery import *
+from loxometrics import *
+from conversiontools.mongoconnection import *
 
 # Flask Setup
-DB_DOWN = False
 UPLOAD_FOLDER = 'uploads'
 ALLOWED_EXTENSIONS = set(['kml', 'zip', 'geojson', 'csv', "png"])
 
 app = Flask(__name__)
 app.register_blueprint(stats_api, url_prefix='/loxo/<database>/collections/<dataset>/stats')
+app.register_blueprint(tiles_api, url_prefix='/loxo/<database>/collections/<dataset>/tiles')
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
+instrument_app(app)
+
+metrics.register(CollectedCounters("loxo_response_cache_events_total", "Response cache hits, misses, stores and evictions",
+    ("event",), lambda: dict(((event,), count) for event, count in response_cache.stats().iteritems())))
+metrics.register(CollectedCounters("loxo_tile_cache_events_total", "Tile cache hits and misses",
+    ("event",), lambda: dict(((event,), count) for event, count in tile_cache.stats().iteritems())))
+
+
+def get_page():
+    """Return the paging options of the current request"""
+    try:
+        return get_page_options(request.args)
+    except ValueError as err:
+        raise InvalidUsage(str(err), 400)
+
+def get_level():
+    """Return the level of detail asked for by the current request"""
+    try:
+        return get_detail_level(request.args)
+    except ValueError as err:
+        raise InvalidUsage(str(err), 400)
+
+def get_output():
+    """Return the output format and precision asked for by the current request"""
+    try:
+        return get_output_options(request.args, request.accept_mimetypes)
+    except ValueError as err:
+        raise InvalidUsage(str(err), 400)
+
+def stream_feature_collection(features, page=None):
+    """Stream a FeatureCollection to the client, in the format asked for, as its features come off the cursor"""
+    limit = page["limit"] if page else None
+    output = get_output()
+    base_url, args = request.base_url, request.args.to_dict()
+
+    def next_link(after):
+        """Link to this query's page that starts after the given loxo_id"""
+        args["after"] = after
+        return base_url + "?" + urlencode(sorted(args.items()))
+    collection = timed_serialization(iter_output(features, output, request.view_args["dataset"], limit, next_link), output["format"])
+    return Response(stream_with_context(collection), mimetype=OUTPUT_FORMATS[output["format"]])
 
 
-# MongoDB Setup
-try:
-    mdb_port = 27017
-    host = os.environ.get('LOXO_DB_1_PORT_27017_TCP_ADDR', 'localhost')
-    client = MongoClient(host, mdb_port, serverSelectionTimeoutMS=1) #Checks to see if MDB is up
-    client.server_info()
-
-except errors.ServerSelectionTimeoutError as err:
-    DB_DOWN = True
-    print "MongoDB is down :", err
+#API Endpoints
 
+@app.route('/loxo/metrics')
+def get_metrics():
+    """Request, Mongo, serialization, stats and ingestion metrics in the Prometheus text format"""
+    return Response(metrics.render(), content_type=CONTENT_TYPE)
 
-#API Endpoints
 
 @app.route('/')
 @app.route('/loxo/')
@@ -62,14 +102,33 @@ def upload_file():
             endpoint_name = os.path.splitext(filename)[0]
             database = request.form.get("database")
             if not database:
-                print request.form["database"]
-                raise InvalidUsage("Database name was not provided", 400, '{ "error" : "database was not provided" }')
-            else:
-                handle_file(database, file_location, endpoint_name, host)
-
-            return redirect('/loxo/' + database + '/collections/' + endpoint_name)
-
-    return render_template('upload.html')
+                raise InvalidUsage("Database name was not provided", 400, { "error" : "database was not provided" })
+            validation = request.form.get("validation", LOAD_VALIDATION)
+            if validation not in VALIDATION_MODES + ["none"]:
+                raise InvalidUsage("Unknown validation mode", 400, { "validation" : VALIDATION_MODES + ["none"] })
+
+            job = ingest_jobs.submit(IngestJob(database, endpoint_name, file_location),
+                                     lambda job: handle_file(database, file_location, endpoint_name, job, validation))
+            status = url_for('get_job', job_id=job.id)
+            response = make_response(json.dumps({
+                "job" : job.id,
+                "status" : status,
+                "collection" : '/loxo/' + database + '/collections/' + endpoint_name
+            }), 202)
+            response.headers["Location"] = status
+            response.mimetype = "application/json"
+            return response
+        raise InvalidUsage("File type is not supported", 400, { "extensions" : sorted(ALLOWED_EXTENSIONS) })
+
+    return render_template('upload.html', validation=LOAD_VALIDATION)
+
+@app.route('/loxo/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    """Report the phase and progress of an ingestion job"""
+    job = ingest_jobs.get(job_id)
+    if job is None:
+        raise InvalidUsage("No such job", 404)
+    return Response(json.dumps(job.to_dict()), mimetype='application/json')
 
 
 @app.route('/loxo/uploads/<filename>')
@@ -80,107 +139,62 @@ def uploaded_file(filename):
 @app.route('/loxo/<database>/index/spatial', methods=['GET'])
 def index_collections(database):
     """Peform Spatial Indexing on the Collections"""
-    db = client[database]
+    db = get_database(database)
+    errors = {}
     for collection in db.collection_names(include_system_collections=False):
-        print "Indexing ", collection, "with a ", GEO2D, " index."
-        db[collection].create_index( [("geometry.coordinates", GEO2D)], background=True )
-    return make_response( json.dumps({"Spatial Index": "Finished"}) )
+        if collection == METADATA_COLLECTION:
+            continue
+        print "Indexing ", collection, "with a ", GEOSPHERE, " index."
+        error = create_spatial_index(db[collection])
+        if error:
+            errors[collection] = error
+        bump_dataset_version(database, collection)
+    return make_response( json.dumps({"Spatial Index": "Finished", "errors": errors}) )
 
 
 @app.route('/loxo/<database>/collections/<dataset>', methods=['GET'])
+@conditional_response(get_database)
+@cache_response
 def get_data_by_value(database, dataset):
     """Return a dataset, based on parameters passed"""
-    db = client[database]
+    db = get_database(database)
     collection = db[dataset]
-
-    if len(request.args) == 0:
-        feature_collection = find_features(collection, {})
-        return make_response(create_feature_collection(feature_collection))
-
-    else:
-        property = request.args.get("property")
-        within_proximity = request.args.get("withinProximity")
-        within_donut = request.args.get("withinDonut")
-        within_polygon = request.args.get("withinPolygon")
-        k_nearest = request.args.get("kNearest")
-
-        # Handle Requests
-        if property:
-            get_property = "properties." + property
-            return_features = find_features(collection, {get_property : request.args.get("value")})
-            feature_collection = create_feature_collection(return_features)
-            return make_response( feature_collection )
-
-        if within_proximity and not property:
-            args = within_proximity.split(",")
-            lng = float(args[0])
-            lat = float(args[1])
-            proximity_radius = abs(float(args[2]))
-            print proximity_radius
-            proximity_radius_query = [[lng, lat], meters_to_radians(proximity_radius)]
-            find = {"geometry.coordinates": {"$geoWithin": {"$centerSphere": proximity_radius_query }}}
-            return_features = find_features(collection, find)
-            feature_collection = create_feature_collection(return_features)
-            return make_response( feature_collection )
-
-        if within_donut and not property:
-            args = within_donut.split(",")
-            lng = float(args[0])
-            lat = float(args[1])
-            donut_min = meters_to_radians(abs(float(args[2])))
-            donut_max = meters_to_radians(abs(float(args[3])))
-            donut_query = { "$nearSphere": [lng, lat], "$minDistance" : donut_min, "$maxDistance": donut_max}
-            find = { "geometry.coordinates": donut_query}
-            return_features = find_features(collection, find) # Exclude the id field
-            feature_collection = create_feature_collection(return_features)
-            return make_response( feature_collection )
-
-        if within_polygon and not property:
-
-            #polygon = [ [0.0 , 0.0], [-180.0 , 0.0], [-180.0 , 90.0], [0.0 , 90.0] ]
-            polygon = literal_eval(within_polygon) # http://stackoverflow.com/questions/1894269/convert-string-representation-of-list-to-list-in-python
-            find = { "geometry.coordinates": {"$geoWithin": {"$polygon": polygon }} }
-            return_features = find_features(collection, find)
-            feature_collection = create_feature_collection(return_features)
-            return make_response( feature_collection )
-
-        if k_nearest and not property:
-            args = k_nearest.split(",")
-            lng = float(args[0])
-            lat = float(args[1])
-            distance_radius = abs(float(args[2]))
-            #query = [{"$geoNear":{ "near": [lat, lng], "distanceField": "distance", "maxDistance": distance_radius}}]
-
-            result = db.command(SON([('geoNear', dataset), ('near', [lng, lat]), ('num', distance_radius)]))["results"]
-            feature_type = "Feature"
-            results = []
-
-            for parent_obj in result:
-                print parent_obj
-                print parent_obj["obj"]
-                print type(parent_obj)
-                obj = parent_obj["obj"]
-                feature = { }
-                feature["geometry"] = obj["geometry"]
-                feature["type"] = feature_type
-                feature["properties"] = obj["properties"]
-                feature["properties"]["kNeartestDistance"] = parent_obj["dis"]
-                results.append(feature)
-
-            return create_feature_collection(results)
-
-
-        if within_proximity and property or within_proximity and property:
-            return "Sorry, property AND proximity searching not currently supported"
+    page = get_page()
+    level = get_level()
+
+    try:
+        query = build_query(request.args, FORMAT_ARGS)
+    except InvalidQuery as err:
+        raise InvalidUsage(str(err), 400, err.payload)
+    features = run_query(collection, query, page, level)
+    # Nearest features are not paged
+    return stream_feature_collection(features, page if "near" not in query else None)
+
+
+@app.route('/loxo/<database>/collections/<dataset>/batch', methods=['POST'])
+def run_batch(database, dataset):
+    """
+    Run an array of queries, each an object of query string arguments, against a dataset at
+    once. Results come back in the same order, each a FeatureCollection or an error.
+    """
+    specs = request.get_json(force=True, silent=True)
+    if not isinstance(specs, list):
+        raise InvalidUsage("The body must be a JSON array of queries", 400)
+    if len(specs) > BATCH_MAX_QUERIES:
+        raise InvalidUsage("Batches are limited to " + str(BATCH_MAX_QUERIES) + " queries", 413)
+    collection = get_database(database)[dataset]
+    return Response(timed_serialization(batch_runner.iter_results(collection, specs), "batch"), mimetype='application/json')
 
 #Retrieve by ID
 @app.route('/loxo/<database>/collections/<dataset>/<int:id>', methods=['GET'])
+@conditional_response(get_database)
+@cache_response
 def get_data_by_id(database, dataset, id):
-    db = client[database]
+    db = get_database(database)
     collection = db[dataset]
     get_property = "properties.loxo_id"
-    return_feature = find_features(collection, {get_property : id})
-    return make_response( return_feature )
+    return_feature = find_features(collection, {get_property : id}, get_page(), get_level())
+    return Response(COMPACT_ENCODER.encode(list(return_feature)), mimetype='application/json')
 
 ## Error handling
 apply_error_handling(app)
@@ -188,10 +202,11 @@ apply_error_handling(app)
 
 if __name__ == '__main__':
 
-    if DB_DOWN == False:
-        if host == 'localhost':
-
-            app.run(host='localhost')
-        else:
-            # DOCKER
-            app.run(host='0.0.0.0')
\ No newline at end of file
+    error = mongo.server_available()
+    if error:
+        print "MongoDB is down :", error
+    elif mongo.host == 'localhost':
+        app.run(host='localhost')
+    else:
+        # DOCKER
+        app.run(host='0.0.0.0')
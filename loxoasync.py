@@ -0,0 +1,75 @@
+from gevent import monkey
+monkey.patch_all() # Before anything imports socket, threading or pymongo
+
+from gevent.pywsgi import WSGIServer
+from gevent.threadpool import ThreadPool
+from gevent.pool import Pool
+import multiprocessing
+import gevent
+import os
+
+from loxoapi import app
+from loxoutils import set_cpu_executor
+from loxopairwise import set_process_pools
+from conversiontools.mongoconnection import mongo
+
+# Serves the Loxo app, with all of its routes and blueprints, from one process that waits on
+# many clients at once. Each request runs in a greenlet, and pymongo's sockets are made
+# cooperative, so a request waiting on Mongo or a slow client lets the others run. Streamed
+# responses hand over to other requests between chunks. Stats kernels, and the parsing,
+# validation and simplification of uploads, run on a pool of threads outside the event loop,
+# so a long computation or load does not hold up every other request. gevent cannot watch
+# child processes from those threads, so kernels that would use a pool of worker processes
+# (averageDistance, totalDistance and idwGrid) run on a single thread instead.
+#
+#   pip install gevent
+#   python loxoasync.py
+
+ASYNC_PORT = int(os.environ.get("LOXO_ASYNC_PORT", 5000))
+ASYNC_CONNECTIONS = int(os.environ.get("LOXO_ASYNC_CONNECTIONS", 10000)) # Clients served at once
+ASYNC_CPU_THREADS = int(os.environ.get("LOXO_ASYNC_CPU_THREADS", multiprocessing.cpu_count()))
+
+class CPUExecutor(object):
+    """Runs functions on a pool of threads, blocking only the calling greenlet until they return"""
+
+    def __init__(self, threads=ASYNC_CPU_THREADS):
+        self.pool = ThreadPool(max(1, threads))
+
+    def __call__(self, function, *args, **kwargs):
+        return self.pool.apply(function, args, kwargs)
+
+def cooperative(wsgi_app):
+    """Wrap a WSGI app so that other greenlets run between the chunks of its responses"""
+    def cooperative_app(environ, start_response):
+        body = wsgi_app(environ, start_response)
+        try:
+            for chunk in body:
+                yield chunk
+                gevent.sleep(0)
+        finally:
+            if hasattr(body, "close"):
+                body.close()
+    return cooperative_app
+
+def configure(threads=ASYNC_CPU_THREADS):
+    """Send CPU heavy work to a pool of threads, without process pools, for serving under gevent"""
+    set_cpu_executor(CPUExecutor(threads))
+    set_process_pools(False)
+
+def serve(host, port=ASYNC_PORT, connections=ASYNC_CONNECTIONS):
+    configure()
+    server = WSGIServer((host, port), cooperative(app), spawn=Pool(connections))
+    print "Serving Loxo on", host, "port", port, "for up to", connections, "clients at once"
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+
+    error = mongo.server_available()
+    if error:
+        print "MongoDB is down :", error
+    elif mongo.host == 'localhost':
+        serve('localhost')
+    else:
+        # DOCKER
+        serve('0.0.0.0')
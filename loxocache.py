@@ -0,0 +1,474 @@
+from collections import OrderedDict
+from functools import wraps
+from flask import Response, request, make_response, g
+from werkzeug.utils import secure_filename
+from scipy import sparse
+from conversiontools.geojson2mongo import register_write_listener, METADATA_COLLECTION
+import numpy as np
+import threading
+import hashlib
+import shutil
+import json
+import os
+
+# Per dataset caches for derived structures (point arrays, neighbour lists and weights
+# matrices). Entries are kept in memory with LRU eviction, and evicted entries are spilled
+# to .npz files so they can be reloaded without going back to Mongo. Keys carry the datasets
+# content version, so an upload through any process, or a restart, never finds the structures
+# of the data it replaced. Write listeners only free them early.
+
+CACHE_DIR = os.environ.get("LOXO_CACHE_DIR", "cache")
+WEIGHTS_CACHE_ENTRIES = int(os.environ.get("LOXO_WEIGHTS_CACHE_ENTRIES", 32))
+
+class MemoryLRU(object):
+    """A thread safe, in process LRU mapping with a maximum number of entries"""
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.RLock()
+
+    def get(self, key):
+        with self.lock:
+            value = self.entries.pop(key, None)
+            if value is not None:
+                self.entries[key] = value
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = value
+            while len(self.entries) > self.max_entries:
+                evicted_key, evicted_value = self.entries.popitem(last=False)
+                self.evicted(evicted_key, evicted_value)
+
+    def evicted(self, key, value):
+        """Called with every entry pushed out by put"""
+        pass
+
+    def discard(self, match):
+        """Remove every entry whose key satisfies match(key)"""
+        with self.lock:
+            for key in [key for key in self.entries if match(key)]:
+                del self.entries[key]
+
+
+def dataset_cache_path(database, dataset, directory=None):
+    """Directory holding a datasets spilled cache entries, safe for any database or dataset name"""
+    parts = []
+    for name in (database, dataset):
+        name = unicode(name)
+        digest = hashlib.sha1(name.encode("utf-8")).hexdigest()[:8]
+        parts.append((secure_filename(name) or "_") + "-" + digest)
+    return os.path.join(directory or CACHE_DIR, *parts)
+
+def weights_to_arrays(weights):
+    """Flatten a CSR matrix into a dictionary of arrays that can be stored in an .npz file"""
+    weights = weights.tocsr()
+    return {
+        "data" : weights.data,
+        "indices" : weights.indices,
+        "indptr" : weights.indptr,
+        "shape" : np.array(weights.shape),
+    }
+
+def arrays_to_weights(arrays):
+    """Rebuild a CSR matrix flattened by weights_to_arrays"""
+    return sparse.csr_matrix((arrays["data"], arrays["indices"], arrays["indptr"]), shape=tuple(arrays["shape"]))
+
+
+class ArrayCache(MemoryLRU):
+    """
+    LRU cache of dictionaries of NumPy arrays keyed by (database, dataset, content version, name).
+    Entries evicted from memory are written to <CACHE_DIR>/<database>/<dataset>/arrays/<version>/<name>.npz
+    and loaded back on the next get. The files of other versions are removed when the first
+    entry of a version is spilled.
+    """
+
+    def __init__(self, max_entries, directory=None):
+        MemoryLRU.__init__(self, max_entries)
+        self.directory = directory
+
+    def version_path(self, database, dataset, version):
+        return os.path.join(dataset_cache_path(database, dataset, self.directory), "arrays", secure_filename(version) or "_")
+
+    def spill_path(self, key):
+        database, dataset, version, name = key
+        return os.path.join(self.version_path(database, dataset, version), hashlib.sha1(unicode(name).encode("utf-8")).hexdigest() + ".npz")
+
+    def get(self, key):
+        arrays = MemoryLRU.get(self, key)
+        if arrays is None and self.directory:
+            path = self.spill_path(key)
+            try:
+                with np.load(path) as spilled:
+                    arrays = dict((name, spilled[name]) for name in spilled.files)
+            except IOError:
+                return None
+            MemoryLRU.put(self, key, arrays)
+        return arrays
+
+    def evicted(self, key, arrays):
+        if not self.directory:
+            return
+        path = self.spill_path(key)
+        try:
+            if not os.path.isdir(os.path.dirname(path)):
+                versions = os.path.dirname(os.path.dirname(path))
+                if os.path.isdir(versions):
+                    for old_version in os.listdir(versions):
+                        shutil.rmtree(os.path.join(versions, old_version), ignore_errors=True)
+                os.makedirs(os.path.dirname(path))
+            # Write then rename, so readers in other processes never see a partial file
+            temporary = path + "." + str(os.getpid()) + ".tmp"
+            with open(temporary, "wb") as spill_file:
+                np.savez(spill_file, **arrays)
+            os.rename(temporary, path)
+        except (IOError, OSError) as err:
+            print "Could not spill cache entry", key, ":", err
+
+    def get_or_build(self, key, build):
+        """Return the cached arrays for key, calling build() and caching the result on a miss"""
+        arrays = self.get(key)
+        if arrays is None:
+            arrays = build()
+            self.put(key, arrays)
+        return arrays
+
+    def invalidate(self, database, dataset):
+        """Drop every memory and disk entry of a dataset"""
+        self.discard(lambda key: key[0] == database and key[1] == dataset)
+        if self.directory:
+            shutil.rmtree(dataset_cache_path(database, dataset, self.directory), ignore_errors=True)
+
+
+weights_cache = ArrayCache(WEIGHTS_CACHE_ENTRIES, CACHE_DIR)
+tree_cache = MemoryLRU(WEIGHTS_CACHE_ENTRIES) # KD-trees over the cached points, keyed by (database, dataset, version)
+cluster_cache = MemoryLRU(WEIGHTS_CACHE_ENTRIES) # Cluster indexes, keyed by (database, dataset, version, aggregated attributes)
+
+def invalidate_dataset(database, dataset):
+    """Forget everything cached about a dataset when this process writes to it, before its new version is asked for"""
+    weights_cache.invalidate(database, dataset)
+    tree_cache.discard(lambda key: key[:2] == (database, dataset))
+    cluster_cache.discard(lambda key: key[:2] == (database, dataset))
+    tile_cache.invalidate(database, dataset)
+
+register_write_listener(invalidate_dataset)
+
+
+class TileCache(object):
+    """
+    Map tiles kept on disk under each datasets cache directory, in a folder per content version
+    so that a new upload is never served old tiles, whichever process it was loaded by. The
+    folders of older versions are removed when the first tile of a new version is stored, and
+    all of them when a dataset is written in this process.
+    """
+
+    def __init__(self, directory=CACHE_DIR):
+        self.directory = directory
+        self.hits = 0
+        self.misses = 0
+
+    def version_path(self, database, dataset, version):
+        return os.path.join(dataset_cache_path(database, dataset, self.directory), "tiles", secure_filename(version))
+
+    def get(self, database, dataset, version, name):
+        """Return the stored bytes of a tile (name is z/x/y.format), or None"""
+        try:
+            with open(os.path.join(self.version_path(database, dataset, version), name), "rb") as tile_file:
+                tile = tile_file.read()
+        except IOError:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return tile
+
+    def put(self, database, dataset, version, name, tile):
+        path = os.path.join(self.version_path(database, dataset, version), name)
+        try:
+            versions = os.path.dirname(self.version_path(database, dataset, version))
+            if not os.path.isdir(self.version_path(database, dataset, version)) and os.path.isdir(versions):
+                for old_version in os.listdir(versions):
+                    shutil.rmtree(os.path.join(versions, old_version), ignore_errors=True)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            # Write then rename, so readers in other processes never see a partial tile
+            temporary = path + "." + str(os.getpid()) + "." + str(threading.current_thread().ident) + ".tmp"
+            with open(temporary, "wb") as tile_file:
+                tile_file.write(tile)
+            os.rename(temporary, path)
+        except (IOError, OSError) as err:
+            print "Could not cache tile", name, "of", dataset, ":", err
+
+    def invalidate(self, database, dataset):
+        shutil.rmtree(os.path.join(dataset_cache_path(database, dataset, self.directory), "tiles"), ignore_errors=True)
+
+    def stats(self):
+        return { "hits" : self.hits, "misses" : self.misses }
+
+
+tile_cache = TileCache(CACHE_DIR)
+
+
+# Response cache for the collection, query and stats endpoints. Keys are normalised from
+# the database, dataset, request URL and query arguments, and include the datasets content
+# version from METADATA_COLLECTION, so a load retires the datasets entries in every worker
+# process. A version counter in the backend is kept too, so that writes seen by this process
+# free the entries they retire straight away.
+
+RESPONSE_CACHE_BYTES = int(os.environ.get("LOXO_RESPONSE_CACHE_BYTES", 256 * 1024 * 1024))
+RESPONSE_CACHE_ENTRY_BYTES = int(os.environ.get("LOXO_RESPONSE_CACHE_ENTRY_BYTES", 16 * 1024 * 1024))
+RESPONSE_CACHE_URL = os.environ.get("LOXO_RESPONSE_CACHE_URL") # e.g. redis://cache:6379/0 to share between workers
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+def normalize_query(database, dataset, path, args, accept=None):
+    """
+    Return a canonical string for a query, the same whatever order its arguments came in.
+    accept is the Accept header, for responses whose format it may choose.
+    """
+    items = sorted((unicode(key), unicode(value)) for key, values in args.lists() for value in values)
+    query = [database, dataset, path, items]
+    if accept:
+        query.append(accept)
+    return json.dumps(query, separators=(',', ':'))
+
+def request_accept():
+    """The Accept header of the current request, unless a format argument makes it irrelevant"""
+    if "format" in request.args:
+        return None
+    return request.headers.get("Accept")
+
+
+class CacheBackend(object):
+    """Storage for cached response bodies and dataset version counters"""
+
+    def get(self, key):
+        raise NotImplementedError
+
+    def set(self, key, value):
+        raise NotImplementedError
+
+    def get_version(self, database, dataset):
+        raise NotImplementedError
+
+    def bump_version(self, database, dataset):
+        raise NotImplementedError
+
+
+class MemoryBackend(CacheBackend):
+    """In process backend, evicting the least recently used entries beyond max_bytes"""
+    shared = False # Version counters only see this process's writes
+
+    def __init__(self, max_bytes=RESPONSE_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.entries = OrderedDict()
+        self.versions = {}
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            value = self.entries.pop(key, None)
+            if value is not None:
+                self.entries[key] = value
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            previous = self.entries.pop(key, None)
+            if previous is not None:
+                self.size -= len(previous)
+            self.entries[key] = value
+            self.size += len(value)
+            while self.size > self.max_bytes and self.entries:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= len(evicted)
+                self.evictions += 1
+
+    def get_version(self, database, dataset):
+        return self.versions.get((database, dataset), 0)
+
+    def bump_version(self, database, dataset):
+        with self.lock:
+            self.versions[(database, dataset)] = self.versions.get((database, dataset), 0) + 1
+            # Entries of older versions can never be hit again, free their memory now
+            prefix = json.dumps([database, dataset], separators=(',', ':'))[:-1] + ","
+            for key in [key for key in self.entries if key.split("|", 1)[1].startswith(prefix)]:
+                self.size -= len(self.entries.pop(key))
+
+
+class RedisBackend(CacheBackend):
+    """
+    Shared backend for several worker processes or hosts. Size and LRU eviction are left to
+    the Redis server's maxmemory and maxmemory-policy allkeys-lru settings.
+    """
+    shared = True
+
+    def __init__(self, url, prefix="loxo:"):
+        if redis is None:
+            raise ImportError("The shared response cache needs the redis package")
+        self.redis = redis.StrictRedis.from_url(url)
+        self.prefix = prefix
+        self.evictions = 0
+
+    def version_key(self, database, dataset):
+        return self.prefix + "version:" + json.dumps([database, dataset], separators=(',', ':'))
+
+    def get(self, key):
+        return self.redis.get(self.prefix + key)
+
+    def set(self, key, value):
+        self.redis.set(self.prefix + key, value)
+
+    def get_version(self, database, dataset):
+        return int(self.redis.get(self.version_key(database, dataset)) or 0)
+
+    def bump_version(self, database, dataset):
+        self.redis.incr(self.version_key(database, dataset))
+
+
+class ResponseCache(object):
+    """Caches whole response bodies, including streamed ones, and counts hits and misses"""
+
+    def __init__(self, backend, max_entry_bytes=RESPONSE_CACHE_ENTRY_BYTES):
+        self.backend = backend
+        self.max_entry_bytes = max_entry_bytes
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.oversize = 0
+
+    def key(self, database, dataset, path, args, accept=None, content_version=None):
+        version = str(self.backend.get_version(database, dataset)) + ":" + (content_version or "")
+        return version + "|" + normalize_query(database, dataset, path, args, accept)
+
+    def get(self, key):
+        value = self.backend.get(key)
+        if value is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        mimetype, body = value.split("\n", 1)
+        return Response(body, mimetype=mimetype)
+
+    def store(self, key, response):
+        """Return the response, arranging for its body to be cached once it has been sent"""
+        if response.status_code != 200 or response.direct_passthrough:
+            return response
+        if not response.is_streamed:
+            body = response.get_data()
+            if len(body) <= self.max_entry_bytes:
+                self.backend.set(key, str(response.mimetype) + "\n" + body)
+                self.stores += 1
+            return response
+        response.response = self.tee(key, response.mimetype, response.response)
+        return response
+
+    def tee(self, key, mimetype, chunks):
+        """Pass a streamed body through, keeping a copy to cache if it stays small enough"""
+        kept = []
+        size = 0
+        for chunk in chunks:
+            if kept is not None:
+                size += len(chunk)
+                if size <= self.max_entry_bytes:
+                    kept.append(chunk)
+                else:
+                    kept = None
+                    self.oversize += 1
+            yield chunk
+        if kept is not None:
+            self.backend.set(key, str(mimetype) + "\n" + "".join(kept))
+            self.stores += 1
+
+    def bump_version(self, database, dataset):
+        self.backend.bump_version(database, dataset)
+
+    def stats(self):
+        return {
+            "hits" : self.hits,
+            "misses" : self.misses,
+            "stores" : self.stores,
+            "oversize" : self.oversize,
+            "evictions" : self.backend.evictions,
+        }
+
+
+response_cache = ResponseCache(RedisBackend(RESPONSE_CACHE_URL) if RESPONSE_CACHE_URL else MemoryBackend())
+
+def cache_response(view):
+    """
+    Decorate a view taking database and dataset arguments so that its responses are served
+    from, and stored in, the response cache. Goes under conditional_response, which looks up
+    the datasets content version. Without one, responses are only cached in a shared backend,
+    as another process's writes would never retire them from this one's memory.
+    """
+    @wraps(view)
+    def cached_view(database, dataset, *args, **kwargs):
+        content_version = getattr(g, "content_version", None)
+        if content_version is None and not response_cache.backend.shared:
+            return view(database, dataset, *args, **kwargs)
+        # The whole URL, host included, as TileJSON templates and next page links are absolute
+        key = response_cache.key(database, dataset, request.base_url, request.args, request_accept(), content_version)
+        response = response_cache.get(key)
+        if response is None:
+            response = response_cache.store(key, make_response(view(database, dataset, *args, **kwargs)))
+        response.vary.add("Accept")
+        return response
+    return cached_view
+
+def get_etag(version, database, dataset):
+    """Entity tag for the current request, from a datasets content version and the normalised query"""
+    query = normalize_query(database, dataset, request.path, request.args, request_accept())
+    return hashlib.sha1((version + u"|" + query).encode("utf-8")).hexdigest()
+
+def conditional_response(get_database, get_session=None):
+    """
+    Decorator factory adding ETag and Last-Modified headers to a dataset view, from the content
+    version recorded in METADATA_COLLECTION at ingest. Requests whose If-None-Match (or failing
+    that If-Modified-Since) still matches get a 304 without the view running. get_database(name)
+    returns the Mongo database to read the version from, and get_session(name) optionally the
+    session to read it in, so the view's reads in that session see data at least that new.
+    """
+    def decorator(view):
+        @wraps(view)
+        def conditional_view(database, dataset, *args, **kwargs):
+            options = { "session" : get_session(database) } if get_session else {}
+            metadata = get_database(database)[METADATA_COLLECTION].find_one({"_id" : dataset}, **options)
+            g.content_version = metadata["version"] if metadata else None
+            if metadata is None:
+                # Loaded before content versions were recorded, nothing to validate against
+                return view(database, dataset, *args, **kwargs)
+
+            etag = get_etag(metadata["version"], database, dataset)
+            modified = metadata["modified"].replace(microsecond=0)
+            if request.if_none_match:
+                unchanged = request.if_none_match.contains(etag)
+            else:
+                unchanged = request.if_modified_since is not None and modified <= request.if_modified_since
+
+            if unchanged:
+                response = Response(status=304)
+            else:
+                response = make_response(view(database, dataset, *args, **kwargs))
+                if response.status_code != 200:
+                    return response
+            response.set_etag(etag)
+            response.last_modified = modified
+            # Let clients keep responses but revalidate them, so a new upload is seen straight away
+            response.cache_control.no_cache = True
+            return response
+        return conditional_view
+    return decorator
+
+def bump_dataset_version(database, dataset):
+    """Retire every cached response of a dataset"""
+    response_cache.bump_version(database, dataset)
+
+register_write_listener(bump_dataset_version)
@@ -0,0 +1,162 @@
+from scipy.spatial import cKDTree
+import numpy as np
+import math
+
+# Hierarchical point clustering in the manner of supercluster
+# (https://github.com/mapbox/supercluster). Points are projected to web mercator, then
+# clustered one zoom at a time from CLUSTER_MAX_ZOOM down to 0, each zoom greedily grouping
+# the clusters of the zoom above that are within CLUSTER_RADIUS pixels of each other. Every
+# zoom is kept sorted by x, so a bbox query is two binary searches and a mask over y.
+
+CLUSTER_RADIUS = 40 # Pixels
+CLUSTER_EXTENT = 512 # Pixels across a tile, the radius is relative to it
+CLUSTER_MAX_ZOOM = 16 # Zooms beyond this return the points themselves
+MAX_LATITUDE = 85.0511287798
+
+def lon_to_x(lons):
+    return np.asarray(lons, dtype=np.float64) / 360 + 0.5
+
+def lat_to_y(lats):
+    sines = np.sin(np.radians(np.clip(np.asarray(lats, dtype=np.float64), -MAX_LATITUDE, MAX_LATITUDE)))
+    return np.clip(0.5 - 0.25 * np.log((1 + sines) / (1 - sines)) / math.pi, 0.0, 1.0)
+
+def x_to_lon(xs):
+    return (np.asarray(xs, dtype=np.float64) - 0.5) * 360
+
+def y_to_lat(ys):
+    return np.degrees(np.arctan(np.sinh(math.pi * (1 - 2 * np.asarray(ys, dtype=np.float64)))))
+
+class ClusterLevel(object):
+    """
+    The clusters of one zoom as arrays: mercator x and y (0 to 1), point counts, the loxo_id of
+    clusters that are a single point (-1 otherwise), and the sum, minimum, maximum and number
+    of values of each aggregated attribute
+    """
+
+    def __init__(self, x, y, counts, ids, aggregates):
+        self.x, self.y, self.counts, self.ids, self.aggregates = x, y, counts, ids, aggregates
+
+    def sorted(self):
+        """This level with its clusters in x order, for range queries"""
+        order = np.argsort(self.x, kind="mergesort")
+        aggregates = dict((name, dict((part, values[order]) for part, values in parts.iteritems()))
+                          for name, parts in self.aggregates.iteritems())
+        return ClusterLevel(self.x[order], self.y[order], self.counts[order], self.ids[order], aggregates)
+
+    def within(self, min_x, min_y, max_x, max_y):
+        """Indexes of the clusters inside a mercator box"""
+        candidates = np.arange(np.searchsorted(self.x, min_x, side="left"), np.searchsorted(self.x, max_x, side="right"))
+        return candidates[(self.y[candidates] >= min_y) & (self.y[candidates] <= max_y)]
+
+def cluster_level(level, zoom, radius=CLUSTER_RADIUS, extent=CLUSTER_EXTENT):
+    """Cluster the clusters of the zoom above, returning the level for zoom, or level itself if nothing merges"""
+    if len(level.x) < 2:
+        return level
+    distance = radius / (extent * 2.0 ** zoom)
+    points = np.column_stack((level.x, level.y))
+    tree = cKDTree(points)
+    nearest, _ = tree.query(points, k=2, distance_upper_bound=distance)
+    crowded = np.flatnonzero(np.isfinite(nearest[:, 1]))
+    if not len(crowded):
+        return level
+
+    # Greedily take each unclustered point's unclustered neighbours, in index order. Points
+    # with nothing in reach cannot join or start a cluster, so they skip the search. The
+    # neighbours are all found in one call, and the small lists are walked in plain Python
+    assigned = [-1] * len(points)
+    clusters = 0
+    for index, neighbours in zip(crowded.tolist(), tree.query_ball_point(points[crowded], distance)):
+        if assigned[index] >= 0:
+            continue
+        for neighbour in neighbours:
+            if assigned[neighbour] < 0:
+                assigned[neighbour] = clusters
+        clusters += 1
+    cluster_of = np.array(assigned, dtype=np.int64)
+    alone = cluster_of < 0
+    cluster_of[alone] = np.arange(clusters, clusters + alone.sum())
+    clusters += int(alone.sum())
+
+    counts = np.bincount(cluster_of, weights=level.counts, minlength=clusters)
+    members = np.bincount(cluster_of, minlength=clusters)
+    x = np.bincount(cluster_of, weights=level.x * level.counts, minlength=clusters) / counts
+    y = np.bincount(cluster_of, weights=level.y * level.counts, minlength=clusters) / counts
+    ids = np.full(clusters, -1, dtype=np.int64)
+    single = members[cluster_of] == 1
+    ids[cluster_of[single]] = level.ids[single]
+
+    aggregates = {}
+    for name, parts in level.aggregates.iteritems():
+        minimum = np.full(clusters, np.nan)
+        maximum = np.full(clusters, np.nan)
+        np.fmin.at(minimum, cluster_of, parts["min"])
+        np.fmax.at(maximum, cluster_of, parts["max"])
+        aggregates[name] = {
+            "sum" : np.bincount(cluster_of, weights=parts["sum"], minlength=clusters),
+            "values" : np.bincount(cluster_of, weights=parts["values"], minlength=clusters),
+            "min" : minimum,
+            "max" : maximum,
+        }
+    return ClusterLevel(x, y, counts, ids, aggregates)
+
+class ClusterIndex(object):
+    """The clusters of a set of points at every zoom from 0 to max_zoom, and the points beyond it"""
+
+    def __init__(self, lons, lats, ids, attributes=None, max_zoom=CLUSTER_MAX_ZOOM, radius=CLUSTER_RADIUS, extent=CLUSTER_EXTENT):
+        """attributes maps names to float arrays of values, NaN where a point has none, to aggregate"""
+        self.max_zoom = max_zoom
+        aggregates = {}
+        for name, values in (attributes or {}).iteritems():
+            values = np.asarray(values, dtype=np.float64)
+            present = np.isfinite(values)
+            aggregates[name] = { "sum" : np.where(present, values, 0.0), "values" : present.astype(np.float64), "min" : values, "max" : values }
+        level = ClusterLevel(lon_to_x(lons), lat_to_y(lats), np.ones(len(lons)), np.asarray(ids, dtype=np.int64), aggregates)
+
+        levels = [level]
+        for zoom in xrange(max_zoom, -1, -1):
+            level = cluster_level(level, zoom, radius, extent)
+            levels.append(level)
+        # Zooms that merge nothing share the level of the zoom above, and its sorted copy
+        sorted_levels = {}
+        self.levels = []
+        for level in reversed(levels):
+            if id(level) not in sorted_levels:
+                sorted_levels[id(level)] = level.sorted()
+            self.levels.append(sorted_levels[id(level)])
+
+    def get_clusters(self, bbox, zoom):
+        """
+        Return the clusters of a zoom within bbox = [west, south, east, north] as GeoJSON
+        features, and the loxo_ids of the single points among them, whose features they stand for
+        """
+        level = self.levels[min(max(int(zoom), 0), self.max_zoom + 1)]
+        west, south, east, north = bbox
+        min_y, max_y = lat_to_y([north, south])
+        if west <= east:
+            ranges = [(west, east)]
+        else:
+            ranges = [(west, 180.0), (-180.0, east)] # Across the antimeridian
+        indexes = np.concatenate([level.within(lon_to_x(low), min_y, lon_to_x(high), max_y) for low, high in ranges])
+
+        lons, lats = x_to_lon(level.x[indexes]), y_to_lat(level.y[indexes])
+        features = []
+        points = []
+        for position, index in enumerate(indexes.tolist()):
+            if level.ids[index] >= 0:
+                points.append(int(level.ids[index]))
+                continue
+            properties = { "cluster" : True, "point_count" : int(level.counts[index]) }
+            for name, parts in level.aggregates.iteritems():
+                values = parts["values"][index]
+                properties[name] = {
+                    "sum" : float(parts["sum"][index]),
+                    "mean" : float(parts["sum"][index] / values) if values else None,
+                    "min" : None if np.isnan(parts["min"][index]) else float(parts["min"][index]),
+                    "max" : None if np.isnan(parts["max"][index]) else float(parts["max"][index]),
+                }
+            features.append({
+                "type" : "Feature",
+                "geometry" : { "type" : "Point", "coordinates" : [float(lons[position]), float(lats[position])] },
+                "properties" : properties,
+            })
+        return features, points
@@ -0,0 +1,228 @@
+from loxoutils import iter_feature_collection, COMPACT_ENCODER, STREAM_CHUNK_SIZE
+from loxoproto import GeobufEncoder, GEOBUF_PRECISION, encode_varint
+from conversiontools.topology import build_topology
+
+# The formats a FeatureCollection can be written in. Each is written a chunk at a time as
+# features come off the cursor. TopoJSON is the exception, as arcs are only shared once every
+# geometry has been seen, so the page is read before anything is written.
+#
+#   geojson  - compact GeoJSON, with precision= rounding coordinates to that many decimal places
+#   topojson - TopoJSON, with precision= quantizing the arcs to that many decimal places
+#   geobuf   - Geobuf (https://github.com/mapbox/geobuf) FeatureCollections of delta encoded
+#              integer coordinates, precision= decimal places (6 by default). Each collection
+#              is preceded by its length as a varint, and the last carries the next link.
+
+OUTPUT_FORMATS = {
+    "geojson" : "application/json",
+    "topojson" : "application/json",
+    "geobuf" : "application/x-protobuf",
+}
+DEFAULT_FORMAT = "geojson"
+FORMAT_ARGS = ["format", "precision"] # Query arguments that choose how a response is written
+MAX_PRECISION = 10
+# Media types a client may ask for in its Accept header instead, in order of preference
+ACCEPT_FORMATS = [
+    ("application/json", "geojson"),
+    ("application/geo+json", "geojson"),
+    ("application/topo+json", "topojson"),
+    ("application/x-protobuf", "geobuf"),
+    ("application/vnd.geobuf", "geobuf"),
+]
+
+def get_output_options(args, accept=None):
+    """
+    Return the output options of a request: format, from the format argument or failing
+    that the accept header's media types, and precision (decimal places of coordinates).
+    """
+    output_format = args.get("format")
+    if output_format is None:
+        best = accept.best_match([media_type for media_type, _ in ACCEPT_FORMATS]) if accept else None
+        output_format = dict(ACCEPT_FORMATS).get(best, DEFAULT_FORMAT)
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError("format must be one of " + ", ".join(sorted(OUTPUT_FORMATS)))
+
+    precision = args.get("precision")
+    if precision is not None:
+        try:
+            precision = int(precision)
+        except ValueError:
+            raise ValueError("precision must be a whole number of decimal places")
+        if not 0 <= precision <= MAX_PRECISION:
+            raise ValueError("precision must be between 0 and " + str(MAX_PRECISION))
+    return { "format" : output_format, "precision" : precision }
+
+def round_coordinates(coordinates, precision):
+    """Round every position of a coordinates array to precision decimal places"""
+    if coordinates and isinstance(coordinates[0], (int, long, float)):
+        return [round(value, precision) for value in coordinates]
+    return [round_coordinates(part, precision) for part in coordinates]
+
+def round_geometry(geometry, precision):
+    if geometry is None:
+        return None
+    if geometry["type"] == "GeometryCollection":
+        return { "type" : "GeometryCollection", "geometries" : [round_geometry(part, precision) for part in geometry["geometries"]] }
+    return { "type" : geometry["type"], "coordinates" : round_coordinates(geometry["coordinates"], precision) }
+
+def with_precision(features, precision):
+    """Yield features with their coordinates rounded to precision decimal places"""
+    for feature in features:
+        rounded = dict(feature)
+        rounded["geometry"] = round_geometry(feature.get("geometry"), precision)
+        yield rounded
+
+class PageReader(object):
+    """Iterates over at most limit features, noting whether any more followed"""
+
+    def __init__(self, features, limit=None):
+        self.features = features
+        self.limit = limit
+        self.written = 0
+        self.last_feature = None
+        self.more = False
+
+    def __iter__(self):
+        for feature in self.features:
+            if self.limit is not None and self.written == self.limit:
+                self.more = True
+                break
+            self.written += 1
+            self.last_feature = feature
+            yield feature
+
+    def next_link(self, next_link):
+        """The link to the next page, if there is one"""
+        if self.more and next_link:
+            return next_link(self.last_feature["properties"]["loxo_id"])
+        return None
+
+def iter_json_array(values):
+    """Yield the JSON array members of values, comma separated, in chunks of about STREAM_CHUNK_SIZE"""
+    chunk = []
+    chunk_size = 0
+    separator = ''
+    for value in values:
+        encoded = separator + COMPACT_ENCODER.encode(value)
+        separator = ','
+        chunk.append(encoded)
+        chunk_size += len(encoded)
+        if chunk_size >= STREAM_CHUNK_SIZE:
+            yield ''.join(chunk)
+            chunk = []
+            chunk_size = 0
+    if chunk:
+        yield ''.join(chunk)
+
+def quantize_shape(shape, translate, scale):
+    """Quantize the coordinates of a TopoJSON point or multipoint shape, and those within a collection"""
+    if shape is None or "arcs" in shape:
+        return shape
+    if shape["type"] == "GeometryCollection":
+        return { "type" : "GeometryCollection", "geometries" : [quantize_shape(part, translate, scale) for part in shape["geometries"]] }
+    if shape["type"] == "Point":
+        positions = [shape["coordinates"]]
+    else:
+        positions = shape["coordinates"]
+    quantized = [[int(round((position[0] - translate[0]) / scale)), int(round((position[1] - translate[1]) / scale))] for position in positions]
+    return { "type" : shape["type"], "coordinates" : quantized[0] if shape["type"] == "Point" else quantized }
+
+def quantize_arc(arc, translate, scale):
+    """Quantize an arc's positions and delta encode them, as TopoJSON does with a transform"""
+    quantized = []
+    last_x = last_y = 0
+    for position in arc:
+        x, y = int(round((position[0] - translate[0]) / scale)), int(round((position[1] - translate[1]) / scale))
+        quantized.append([x - last_x, y - last_y])
+        last_x, last_y = x, y
+    return quantized
+
+def iter_shape_positions(shape):
+    if shape is None or "arcs" in shape:
+        return
+    if shape["type"] == "GeometryCollection":
+        for part in shape["geometries"]:
+            for position in iter_shape_positions(part):
+                yield position
+    elif shape["type"] == "Point":
+        yield shape["coordinates"]
+    else:
+        for position in shape["coordinates"]:
+            yield position
+
+def iter_topojson(features, name, limit=None, next_link=None, precision=None):
+    """
+    Yield a Topology of features as compact JSON text, with one GeometryCollection object
+    called name holding them. With precision, the positions are rounded to that many decimal
+    places before the arcs are found, then quantized onto that grid with a transform.
+    """
+    page = PageReader(features, limit)
+    geometries = []
+    properties = []
+    for feature in page:
+        geometry = feature.get("geometry")
+        geometries.append(round_geometry(geometry, precision) if precision is not None else geometry)
+        properties.append(feature.get("properties"))
+    arcs, shapes = build_topology(geometries)
+
+    positions = [position for arc in arcs for position in arc]
+    positions.extend(position for shape in shapes for position in iter_shape_positions(shape))
+    bbox = None
+    if positions:
+        lons = [position[0] for position in positions]
+        lats = [position[1] for position in positions]
+        bbox = [min(lons), min(lats), max(lons), max(lats)]
+    transform = None
+    if precision is not None and bbox:
+        transform = { "scale" : [10.0 ** -precision] * 2, "translate" : bbox[:2] }
+        arcs = [quantize_arc(arc, transform["translate"], transform["scale"][0]) for arc in arcs]
+        shapes = [quantize_shape(shape, transform["translate"], transform["scale"][0]) for shape in shapes]
+
+    def objects():
+        for shape, feature_properties in zip(shapes, properties):
+            shape = dict(shape) if shape is not None else { "type" : None }
+            shape["properties"] = feature_properties
+            yield shape
+
+    yield '{"type":"Topology","objects":{' + COMPACT_ENCODER.encode(name) + ':{"type":"GeometryCollection","geometries":['
+    for chunk in iter_json_array(objects()):
+        yield chunk
+    yield ']}},"arcs":['
+    for chunk in iter_json_array(arcs):
+        yield chunk
+    footer = ']'
+    if bbox:
+        footer += ',"bbox":' + COMPACT_ENCODER.encode(bbox)
+    if transform:
+        footer += ',"transform":' + COMPACT_ENCODER.encode(transform)
+    link = page.next_link(next_link)
+    if link:
+        footer += ',"next":' + COMPACT_ENCODER.encode(link)
+    yield footer + '}'
+
+def iter_geobuf(features, limit=None, next_link=None, precision=None):
+    """
+    Yield features as a series of length delimited geobuf FeatureCollections of about
+    STREAM_CHUNK_SIZE bytes each. There is always at least one, and the last has the next
+    link as a foreign member when there is one.
+    """
+    encoder = GeobufEncoder(GEOBUF_PRECISION if precision is None else precision)
+    page = PageReader(features, limit)
+    for feature in page:
+        encoder.add_feature(feature)
+        if encoder.size >= STREAM_CHUNK_SIZE:
+            data = encoder.encode()
+            yield encode_varint(len(data)) + data
+    link = page.next_link(next_link)
+    data = encoder.encode({ "next" : link } if link else None)
+    yield encode_varint(len(data)) + data
+
+def iter_output(features, options, name, limit=None, next_link=None):
+    """Yield the chunks of a FeatureCollection written as get_output_options chose"""
+    precision = options["precision"]
+    if options["format"] == "topojson":
+        return iter_topojson(features, name, limit, next_link, precision)
+    if options["format"] == "geobuf":
+        return iter_geobuf(features, limit, next_link, precision)
+    if precision is not None:
+        features = with_precision(features, precision)
+    return iter_feature_collection(features, limit, next_link)
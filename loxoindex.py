@@ -0,0 +1,149 @@
+from scipy.spatial import cKDTree, ConvexHull
+from scipy.spatial.qhull import QhullError
+from loxoutils import *
+import numpy as np
+
+# Spatial indexes over points on the unit sphere. Chord length between unit vectors is
+# monotonic in great circle distance, so Euclidean KD-trees answer spherical queries.
+
+SPHERICAL_ERROR_MARGIN = (1 + HAVERSINE_RELATIVE_ERROR) / (1 - HAVERSINE_RELATIVE_ERROR)
+HEMISPHERE_EPSILON = 1e-9 # Points must sit this far inside the hemisphere for the hull search
+INDEX_BLOCK_CELLS = 2 ** 20 # Distances held in memory at once when scanning blocks
+
+def to_unit_vectors(lons, lats):
+    """Return an (n, 3) array of unit vectors for arrays of longitudes and latitudes"""
+    lons = np.radians(np.asarray(lons, dtype=np.float64))
+    lats = np.radians(np.asarray(lats, dtype=np.float64))
+    cos_lats = np.cos(lats)
+    return np.column_stack((cos_lats * np.cos(lons), cos_lats * np.sin(lons), np.sin(lats)))
+
+def meters_to_chord(meters):
+    """Chord length on the unit sphere for a great circle distance in metres"""
+    arc = np.minimum(np.asarray(meters, dtype=np.float64) / MEAN_EARTH_RADIUS, np.pi)
+    return 2 * np.sin(arc / 2)
+
+def chord_to_meters(chord):
+    """Great circle distance in metres for a chord length on the unit sphere"""
+    return 2 * MEAN_EARTH_RADIUS * np.arcsin(np.clip(np.asarray(chord, dtype=np.float64) / 2, 0.0, 1.0))
+
+def build_point_index(lons, lats):
+    """Return a KD-tree over the unit vectors of the given points"""
+    return cKDTree(to_unit_vectors(lons, lats))
+
+def refine_pairs(lons, lats, pairs, method="geodesic"):
+    """Return the distances of the given (i, j) index pairs using the chosen method"""
+    pairs = np.asarray(pairs, dtype=np.intp).reshape(-1, 2)
+    i, j = pairs[:, 0], pairs[:, 1]
+    return get_distances(lons[i], lats[i], lons[j], lats[j], method)
+
+def closest_pair(lons, lats, method="geodesic", tree=None):
+    """
+    Return (i, j, distance) for the closest pair of points in O(n log n).
+
+    Every point's nearest neighbour comes from a KD-tree on the unit sphere. The
+    spherical minimum is only approximate on the ellipsoid, so every pair within the
+    haversine error margin of it is re-measured with the chosen method.
+    """
+    if len(lons) < 2:
+        return None
+    if tree is None:
+        tree = build_point_index(lons, lats)
+
+    chords, neighbours = tree.query(tree.data, k=2)
+    if chords[:, 1].min() == 0:
+        # Coincident points, every pair of them would be a candidate
+        i = int(chords[:, 1].argmin())
+        j = int(neighbours[i, 0] if neighbours[i, 0] != i else neighbours[i, 1])
+        return min(i, j), max(i, j), 0.0
+    min_meters = chord_to_meters(chords[:, 1].min())
+    radius = meters_to_chord(min_meters * SPHERICAL_ERROR_MARGIN) * (1 + 1e-9) + 1e-15
+    candidates = tree.query_pairs(radius, output_type='ndarray')
+
+    distances = refine_pairs(lons, lats, candidates, method)
+    best = distances.argmin()
+    return int(candidates[best, 0]), int(candidates[best, 1]), float(distances[best])
+
+def spherical_hull(unit_vectors):
+    """
+    Return the indices of the vertices of the spherical convex hull of the points, or
+    None if the points do not fit inside an open hemisphere.
+
+    The points are projected gnomonically about their mean direction, which maps great
+    circles onto straight lines, so the planar hull of the projection is the spherical hull.
+    """
+    center = unit_vectors.mean(axis=0)
+    norm = np.sqrt(center.dot(center))
+    if norm < HEMISPHERE_EPSILON:
+        return None
+    center = center / norm
+    heights = unit_vectors.dot(center)
+    if heights.min() <= HEMISPHERE_EPSILON:
+        return None
+
+    # Orthonormal basis of the tangent plane at the center
+    axis = np.eye(3)[np.abs(center).argmin()]
+    east = np.cross(axis, center)
+    east = east / np.sqrt(east.dot(east))
+    north = np.cross(center, east)
+    projected = np.column_stack((unit_vectors.dot(east) / heights, unit_vectors.dot(north) / heights))
+
+    try:
+        return ConvexHull(projected).vertices
+    except (QhullError, ValueError):
+        # Fewer than three distinct or only collinear points, every point is a hull vertex
+        return np.arange(len(unit_vectors))
+
+def iter_distance_blocks(rows, columns, lons, lats):
+    """Yield (row indices, haversine distance block) covering every row x column pair"""
+    block_rows = max(1, INDEX_BLOCK_CELLS // max(len(columns), 1))
+    for r0 in xrange(0, len(rows), block_rows):
+        row_block = rows[r0:r0 + block_rows]
+        yield row_block, haversine_distances(lons[row_block][:, np.newaxis], lats[row_block][:, np.newaxis], lons[columns], lats[columns])
+
+def max_pair_distance(indices, lons, lats):
+    """Return the largest haversine distance between any two of the given points"""
+    return max(distances.max() for _, distances in iter_distance_blocks(indices, indices, lons, lats))
+
+def pairs_at_least(indices, lons, lats, threshold):
+    """Return an (m, 2) array of the pairs among indices whose haversine distance is at least threshold"""
+    found = [np.empty((0, 2), dtype=np.intp)]
+    for row_block, distances in iter_distance_blocks(indices, indices, lons, lats):
+        i, j = np.nonzero(distances >= threshold)
+        i, j = row_block[i], indices[j]
+        keep = i < j
+        found.append(np.column_stack((i[keep], j[keep])))
+    return np.concatenate(found)
+
+def farthest_pair(lons, lats, method="geodesic"):
+    """
+    Return (i, j, distance) for the farthest pair of points.
+
+    Within an open hemisphere and a diameter of at most a quarter great circle, the farthest
+    point from any point is a vertex of the spherical convex hull, so only points that are far
+    enough from some hull vertex can belong to the winning pair. Those candidates are searched
+    pairwise and re-measured with the chosen method. Other datasets are scanned exhaustively.
+    """
+    n = len(lons)
+    if n < 2:
+        return None
+    everything = np.arange(n)
+
+    hull = spherical_hull(to_unit_vectors(lons, lats))
+    if hull is not None:
+        hull_diameter = max_pair_distance(hull, lons, lats)
+        if hull_diameter <= np.pi / 2 * MEAN_EARTH_RADIUS:
+            threshold = hull_diameter / SPHERICAL_ERROR_MARGIN
+            reach = np.empty(n)
+            for row_block, distances in iter_distance_blocks(everything, hull, lons, lats):
+                reach[row_block] = distances.max(axis=1)
+            candidates = pairs_at_least(np.flatnonzero(reach >= threshold), lons, lats, threshold)
+        else:
+            hull = None
+
+    if hull is None:
+        threshold = max_pair_distance(everything, lons, lats) / SPHERICAL_ERROR_MARGIN
+        candidates = pairs_at_least(everything, lons, lats, threshold)
+
+    distances = refine_pairs(lons, lats, candidates, method)
+    best = distances.argmax()
+    return int(candidates[best, 0]), int(candidates[best, 1]), float(distances[best])
@@ -0,0 +1,87 @@
+from loxoindex import *
+from loxopairwise import imap_tasks
+import numpy as np
+import os
+
+# Inverse distance weighted interpolation over a datasets nearest neighbours. Targets are
+# matched against the unit-sphere KD-tree in bulk, and grids are split into bands of rows
+# that are interpolated on a pool of processes.
+
+DEFAULT_IDW_K = 12
+DEFAULT_IDW_POWER = 2.0
+MAX_GRID_CELLS = int(os.environ.get("LOXO_MAX_GRID_CELLS", 4000000))
+GRID_PARALLEL_CELLS = 2 ** 16 # Grids smaller than this are interpolated in the request process
+GRID_BAND_ROWS = 32
+
+def idw_interpolate(tree, lons, lats, values, target_lons, target_lats, k=DEFAULT_IDW_K, radius=None,
+                    power=DEFAULT_IDW_POWER, method="haversine"):
+    """
+    Interpolate values at every target point from its k nearest known points, optionally only
+    those within radius metres. Targets that coincide with known points take their value, and
+    targets with no neighbours in range come back as NaN.
+    """
+    targets = to_unit_vectors(target_lons, target_lats)
+    k = max(1, min(int(k), len(values)))
+    upper_bound = meters_to_chord(radius * SPHERICAL_ERROR_MARGIN) if radius else np.inf
+    chords, neighbours = tree.query(targets, k=k, distance_upper_bound=upper_bound)
+    chords = chords.reshape(len(targets), k)
+    neighbours = neighbours.reshape(len(targets), k)
+
+    found = np.isfinite(chords)
+    distances = np.full(chords.shape, np.inf)
+    if method == "haversine":
+        distances[found] = chord_to_meters(chords[found])
+    else:
+        rows = np.nonzero(found)[0]
+        distances[found] = get_distances(np.asarray(target_lons)[rows], np.asarray(target_lats)[rows],
+                                         lons[neighbours[found]], lats[neighbours[found]], method)
+    if radius:
+        distances[distances > radius] = np.inf
+
+    known = np.zeros(chords.shape)
+    known[found] = values[neighbours[found]]
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        weights = 1.0 / distances ** power
+        coincident = distances == 0
+        exact = coincident.any(axis=1)
+        # Targets on top of a known point take its value rather than dividing by zero
+        weights[exact] = coincident[exact]
+        interpolated = (weights * known).sum(axis=1) / weights.sum(axis=1)
+    return interpolated
+
+# Interpolation state shared with grid worker processes by grid_initializer
+_grid = {}
+
+def grid_initializer(tree, lons, lats, values, options):
+    _grid.update(tree=tree, lons=lons, lats=lats, values=values, options=options)
+
+def interpolate_band(band):
+    """Interpolate one band of grid rows, given as (first row, row latitudes, column longitudes)"""
+    first_row, row_lats, column_lons = band
+    grid_lons, grid_lats = np.meshgrid(column_lons, row_lats)
+    interpolated = idw_interpolate(_grid["tree"], _grid["lons"], _grid["lats"], _grid["values"],
+                                   grid_lons.ravel(), grid_lats.ravel(), **_grid["options"])
+    return first_row, interpolated.reshape(grid_lons.shape)
+
+def idw_grid(tree, lons, lats, values, bbox, resolution, processes=None, **options):
+    """
+    Interpolate a raster of cell centres covering bbox (minx, miny, maxx, maxy) at a cell size
+    of resolution degrees. Returns a (rows, columns) array with the first row at the north edge.
+    """
+    minx, miny, maxx, maxy = bbox
+    columns = max(1, int(np.ceil((maxx - minx) / resolution)))
+    rows = max(1, int(np.ceil((maxy - miny) / resolution)))
+    if rows * columns > MAX_GRID_CELLS:
+        raise ValueError("Grid of " + str(rows * columns) + " cells is larger than the limit of " + str(MAX_GRID_CELLS))
+
+    column_lons = minx + (np.arange(columns) + 0.5) * resolution
+    row_lats = maxy - (np.arange(rows) + 0.5) * resolution
+    bands = [(r0, row_lats[r0:r0 + GRID_BAND_ROWS], column_lons) for r0 in xrange(0, rows, GRID_BAND_ROWS)]
+    if rows * columns < GRID_PARALLEL_CELLS:
+        processes = 1
+
+    grid = np.empty((rows, columns))
+    for first_row, band in imap_tasks(interpolate_band, bands, grid_initializer, (tree, lons, lats, values, options), processes):
+        grid[first_row:first_row + len(band)] = band
+    return grid
@@ -0,0 +1,128 @@
+from collections import OrderedDict
+from threading import Thread, Lock
+from uuid import uuid4
+import traceback
+import Queue
+import time
+import os
+
+# Background ingestion jobs. Uploads are queued and run by a small pool of worker threads
+# in the API process, so long conversions and loads no longer hold a request open. Jobs
+# record their phase and progress so clients can poll them.
+
+INGEST_WORKERS = int(os.environ.get("LOXO_INGEST_WORKERS", 2))
+JOB_HISTORY = 1000 # Finished jobs kept for status requests
+
+JOB_PHASES = ["queued", "loading", "finished", "failed"]
+
+class IngestJob(object):
+    """The state of one queued ingestion, updated by the worker running it"""
+
+    def __init__(self, database, dataset, filename):
+        self.id = uuid4().hex
+        self.database = database
+        self.dataset = dataset
+        self.filename = filename
+        self.phase = "queued"
+        self.features = 0
+        self.errors = []
+        self.validation = None # ValidationReport of the features read, set by the loader
+        self.mismatches = {} # CSV columns with values not of the column's type, loaded as null
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+
+    def set_phase(self, phase):
+        self.phase = phase
+
+    def progress(self, loaded, elapsed):
+        """Load progress callback, as taken by load_features"""
+        self.features = loaded
+
+    def rate(self):
+        """Features loaded per second so far"""
+        if not self.started:
+            return 0.0
+        elapsed = (self.finished or time.time()) - self.started
+        return self.features / max(elapsed, 1e-9)
+
+    def done(self):
+        return self.phase in ("finished", "failed")
+
+    def to_dict(self):
+        return {
+            "id" : self.id,
+            "database" : self.database,
+            "dataset" : self.dataset,
+            "file" : os.path.basename(self.filename),
+            "phase" : self.phase,
+            "features" : self.features,
+            "rate" : round(self.rate(), 1),
+            "errors" : self.errors,
+            "validation" : self.validation.to_dict() if self.validation else None,
+            "mismatches" : dict(self.mismatches),
+            "created" : self.created,
+            "started" : self.started,
+            "finished" : self.finished,
+        }
+
+
+class JobQueue(object):
+    """
+    Runs queued jobs on a pool of worker threads, several at a time. Threads are started
+    with the first job, so processes that never ingest (or fork first) do not carry them.
+    """
+
+    def __init__(self, workers=INGEST_WORKERS, history=JOB_HISTORY):
+        self.workers = max(1, int(workers))
+        self.history = history
+        self.queue = Queue.Queue()
+        self.jobs = OrderedDict()
+        self.lock = Lock()
+        self.threads = []
+
+    def start(self):
+        with self.lock:
+            if self.threads:
+                return
+            for _ in xrange(self.workers):
+                thread = Thread(target=self.work)
+                thread.daemon = True
+                thread.start()
+                self.threads.append(thread)
+
+    def submit(self, job, run):
+        """Queue run(job) and return the job"""
+        self.start()
+        with self.lock:
+            self.jobs[job.id] = job
+            self.forget_finished()
+        self.queue.put((job, run))
+        return job
+
+    def forget_finished(self):
+        """Drop the oldest finished jobs beyond the history limit"""
+        finished = [job_id for job_id, job in self.jobs.iteritems() if job.done()]
+        for job_id in finished[:max(0, len(self.jobs) - self.history)]:
+            del self.jobs[job_id]
+
+    def get(self, job_id):
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def work(self):
+        while True:
+            job, run = self.queue.get()
+            job.started = time.time()
+            try:
+                run(job)
+                job.set_phase("finished")
+            except Exception as err:
+                print "Ingestion job", job.id, "failed:", traceback.format_exc()
+                job.errors.append(str(err) or err.__class__.__name__)
+                job.set_phase("failed")
+            finally:
+                job.finished = time.time()
+
+
+ingest_jobs = JobQueue()
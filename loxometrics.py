@@ -0,0 +1,248 @@
+from collections import defaultdict
+from pymongo import monitoring
+from conversiontools.geojson2mongo import register_load_listener
+import threading
+import bisect
+import time
+
+# Counters and histograms in the Prometheus text format, kept in process without the
+# prometheus_client package. Recording a value is a dict lookup, a bisect and a few additions
+# under a lock, cheap enough to leave on. Each process keeps its own metrics, so servers
+# running several workers are scraped once per worker.
+#
+# Time spent on Mongo commands is also added to a per thread (per greenlet under gevent)
+# total, so that the serialization time of a streamed response can leave out the time its
+# generator spent waiting on the cursor.
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+KERNEL_BUCKETS = (0.001, 0.01, 0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0, 300.0)
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+def format_labels(names, values):
+    if not names:
+        return ""
+    escaped = (unicode(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"') for value in values)
+    return "{" + ",".join(name + '="' + value + '"' for name, value in zip(names, escaped)) + "}"
+
+def format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value))
+
+class Metric(object):
+    """A named metric with a value per combination of label values"""
+    kind = None
+
+    def __init__(self, name, description, labels=()):
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+        self.lock = threading.Lock()
+
+    def header(self):
+        return ["# HELP " + self.name + " " + self.description, "# TYPE " + self.name + " " + self.kind]
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, name, description, labels=()):
+        Metric.__init__(self, name, description, labels)
+        self.values = defaultdict(float)
+
+    def inc(self, amount=1, *label_values):
+        with self.lock:
+            self.values[label_values] += amount
+
+    def render(self):
+        with self.lock:
+            values = sorted(self.values.items())
+        return self.header() + [self.name + format_labels(self.labels, key) + " " + format_value(value) for key, value in values]
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, description, labels=(), buckets=LATENCY_BUCKETS):
+        Metric.__init__(self, name, description, labels)
+        self.buckets = tuple(buckets)
+        self.values = {}
+
+    def observe(self, value, *label_values):
+        with self.lock:
+            if label_values not in self.values:
+                self.values[label_values] = [[0] * (len(self.buckets) + 1), 0.0]
+            counts = self.values[label_values]
+            counts[0][bisect.bisect_left(self.buckets, value)] += 1
+            counts[1] += value
+
+    def render(self):
+        with self.lock:
+            values = sorted((key, (list(counts), total)) for key, (counts, total) in self.values.items())
+        lines = self.header()
+        names = self.labels + ("le",)
+        for key, (counts, total) in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                lines.append(self.name + "_bucket" + format_labels(names, key + (format_value(bound),)) + " " + str(cumulative))
+            lines.append(self.name + "_sum" + format_labels(self.labels, key) + " " + format_value(total))
+            lines.append(self.name + "_count" + format_labels(self.labels, key) + " " + str(cumulative))
+        return lines
+
+class CollectedCounters(Metric):
+    """Counters read at scrape time from collect(), which returns {label values : value}"""
+    kind = "counter"
+
+    def __init__(self, name, description, labels, collect):
+        Metric.__init__(self, name, description, labels)
+        self.collect = collect
+
+    def render(self):
+        values = sorted(self.collect().items())
+        return self.header() + [self.name + format_labels(self.labels, key) + " " + format_value(value) for key, value in values]
+
+class MetricsRegistry(object):
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+metrics = MetricsRegistry()
+request_duration = metrics.register(Histogram("loxo_request_duration_seconds",
+    "Time from a request arriving to the last byte of its response", ("route", "method", "status")))
+response_bytes = metrics.register(Counter("loxo_response_bytes_total",
+    "Bytes of response bodies sent", ("route",)))
+serialization_seconds = metrics.register(Counter("loxo_serialization_seconds_total",
+    "Time spent writing streamed responses, not counting Mongo commands", ("format",)))
+mongo_duration = metrics.register(Histogram("loxo_mongo_command_duration_seconds",
+    "Round trip time of Mongo commands", ("command",)))
+mongo_documents = metrics.register(Counter("loxo_mongo_documents_returned_total",
+    "Documents returned by Mongo find and getMore commands", ("command",)))
+mongo_failures = metrics.register(Counter("loxo_mongo_command_failures_total",
+    "Mongo commands that failed", ("command",)))
+kernel_duration = metrics.register(Histogram("loxo_stats_kernel_duration_seconds",
+    "Time spent in stats kernels", ("kernel",), KERNEL_BUCKETS))
+ingested_features = metrics.register(Counter("loxo_ingested_features_total",
+    "Features loaded into collections", ("database",)))
+ingest_invalid_features = metrics.register(Counter("loxo_ingest_invalid_features_total",
+    "Invalid features left out of loads", ("database",)))
+ingest_seconds = metrics.register(Counter("loxo_ingest_seconds_total",
+    "Time spent loading features, the ingestion rate is features over seconds", ("database",)))
+pairwise_tiles_planned = metrics.register(Counter("loxo_pairwise_tiles_planned_total",
+    "Distance matrix tiles that pairwise sums have set out to sum"))
+pairwise_tiles_summed = metrics.register(Counter("loxo_pairwise_tiles_summed_total",
+    "Distance matrix tiles summed, the tiles of running sums still to go are planned less summed"))
+
+
+# Mongo commands, from pymongo's command monitoring
+
+mongo_time = threading.local()
+
+def get_mongo_seconds():
+    """Seconds this thread has spent on Mongo commands"""
+    return getattr(mongo_time, "seconds", 0.0)
+
+class MongoMetricsListener(monitoring.CommandListener):
+    """Records the round trip time of every command, and the documents that finds return"""
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        seconds = event.duration_micros / 1e6
+        mongo_duration.observe(seconds, event.command_name)
+        mongo_time.seconds = get_mongo_seconds() + seconds
+        cursor = event.reply.get("cursor") if event.command_name in ("find", "getMore", "aggregate") else None
+        if cursor:
+            batch = cursor.get("firstBatch", cursor.get("nextBatch")) or ()
+            mongo_documents.inc(len(batch), event.command_name)
+
+    def failed(self, event):
+        seconds = event.duration_micros / 1e6
+        mongo_duration.observe(seconds, event.command_name)
+        mongo_time.seconds = get_mongo_seconds() + seconds
+        mongo_failures.inc(1, event.command_name)
+
+# Applies to the clients made after this, which the lazily made shared clients are
+monitoring.register(MongoMetricsListener())
+
+
+def timed_kernel(function):
+    """Wrap a stats kernel so its running time is recorded under its name"""
+    name = getattr(function, "__name__", function.__class__.__name__)
+    def timed(*args, **kwargs):
+        started = time.time()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            kernel_duration.observe(time.time() - started, name)
+    timed.__name__ = name
+    return timed
+
+def record_pairwise_progress(done, total, elapsed):
+    """A pairwise_distance_sum progress callback, so the progress of long sums can be followed in the metrics"""
+    if done == 1:
+        pairwise_tiles_planned.inc(total)
+    pairwise_tiles_summed.inc(1)
+
+def timed_serialization(chunks, output_format):
+    """Pass the chunks of a streamed response through, recording the time taken to make them less Mongo's"""
+    chunks = iter(chunks)
+    while True:
+        started = time.time()
+        mongo_started = get_mongo_seconds()
+        try:
+            chunk = next(chunks)
+        except StopIteration:
+            return
+        finally:
+            elapsed = time.time() - started - (get_mongo_seconds() - mongo_started)
+            serialization_seconds.inc(max(elapsed, 0.0), output_format)
+        yield chunk
+
+def record_load(database, collection_name, loaded, elapsed, invalid):
+    """A load listener recording ingestion rates"""
+    ingested_features.inc(loaded, database)
+    ingest_invalid_features.inc(invalid, database)
+    ingest_seconds.inc(elapsed, database)
+
+register_load_listener(record_load)
+
+
+# Request latency and response sizes, for a Flask app
+
+def count_bytes(chunks, route):
+    for chunk in chunks:
+        response_bytes.inc(len(chunk), route)
+        yield chunk
+
+def instrument_app(app):
+    """Record the latency and response size of every request to app, by route"""
+    from flask import request, g
+
+    @app.before_request
+    def start_timer():
+        g.metrics_started = time.time()
+
+    @app.after_request
+    def record_response(response):
+        started = getattr(g, "metrics_started", None)
+        if started is None:
+            return response
+        route = request.url_rule.rule if request.url_rule else "unmatched"
+        method, status = request.method, response.status_code
+        if response.is_streamed:
+            response.response = count_bytes(response.response, route)
+        elif not response.direct_passthrough:
+            response_bytes.inc(len(response.get_data()), route)
+        # Streamed responses are only finished once the server has sent them and closed them
+        response.call_on_close(lambda: request_duration.observe(time.time() - started, route, method, status))
+        return response
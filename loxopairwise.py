@@ -0,0 +1,95 @@
+from multiprocessing import Pool, cpu_count
+from loxoutils import *
+import numpy as np
+import math
+import time
+import os
+
+# All-pairs distance aggregates. The upper triangle of the distance matrix is split into
+# square tiles that are summed independently on a pool of worker processes, so memory is
+# bounded by the tile size and the work spreads across every core.
+
+PAIRWISE_TILE_SIZE = int(os.environ.get("LOXO_PAIRWISE_TILE_SIZE", 2048))
+PAIRWISE_PROCESSES = int(os.environ.get("LOXO_PAIRWISE_PROCESSES", cpu_count()))
+
+# Pools of worker processes are started for jobs of more than one task, unless a server whose
+# threads cannot fork them turns them off (see loxoasync)
+process_pools = True
+
+def set_process_pools(enabled):
+    """Let imap_tasks start pools of worker processes, or run every task in the calling process"""
+    global process_pools
+    process_pools = enabled
+
+# Points shared with the worker processes by pool_initializer
+_points = {}
+
+def pool_initializer(lons, lats, method):
+    _points["lons"] = lons
+    _points["lats"] = lats
+    _points["method"] = method
+
+def iter_upper_tiles(n, tile_size):
+    """Yield (i0, i1, j0, j1) tiles that cover the upper triangle of an n x n matrix"""
+    for i0 in xrange(0, n, tile_size):
+        for j0 in xrange(i0, n, tile_size):
+            yield i0, min(i0 + tile_size, n), j0, min(j0 + tile_size, n)
+
+def sum_tile(tile):
+    """Return (pairs, distance sum) for one tile, counting each pair in the diagonal tiles once"""
+    i0, i1, j0, j1 = tile
+    lons, lats = _points["lons"], _points["lats"]
+    distances = get_distance_block(lons[i0:i1], lats[i0:i1], lons[j0:j1], lats[j0:j1], _points["method"])
+    if i0 == j0:
+        distances = distances[np.triu_indices(i1 - i0, 1)]
+    return distances.size, float(distances.sum())
+
+def imap_tasks(function, tasks, initializer, initargs, processes=None, ordered=False):
+    """
+    Yield function(task) for every task, run on a pool of processes that are each set up
+    with initializer(*initargs). Runs in this process when one process or task is enough, or
+    process pools are turned off.
+    """
+    processes = max(1, int(processes or PAIRWISE_PROCESSES))
+    if processes == 1 or len(tasks) <= 1 or not process_pools:
+        initializer(*initargs)
+        for task in tasks:
+            yield function(task)
+        return
+
+    pool = Pool(min(processes, len(tasks)), initializer, initargs)
+    try:
+        results = pool.imap(function, tasks) if ordered else pool.imap_unordered(function, tasks)
+        for result in results:
+            yield result
+    except:
+        pool.terminate()
+        raise
+    else:
+        pool.close()
+    finally:
+        pool.join()
+
+def pairwise_distance_sum(lons, lats, method=DEFAULT_DISTANCE_METHOD, tile_size=None, processes=None, progress=None):
+    """
+    Return (pairs, total distance in metres) over every unordered pair of points.
+
+    Tiles are summed with NumPy's pairwise summation and the tile totals are combined
+    with math.fsum, so the result does not drift as the number of pairs grows. Memory use
+    is a tile_size x tile_size block per process. progress, if given, is called with
+    (tiles done, total tiles, seconds elapsed) as tiles complete.
+    """
+    tile_size = max(1, int(tile_size or PAIRWISE_TILE_SIZE))
+    tiles = list(iter_upper_tiles(len(lons), tile_size))
+    started = time.time()
+
+    pairs = 0
+    sums = []
+    results = imap_tasks(sum_tile, tiles, pool_initializer, (lons, lats, method), processes)
+    for done, (tile_pairs, tile_sum) in enumerate(results, 1):
+        pairs += tile_pairs
+        sums.append(tile_sum)
+        if progress:
+            progress(done, len(tiles), time.time() - started)
+
+    return pairs, math.fsum(sums)
@@ -0,0 +1,281 @@
+import struct
+import json
+
+# Just enough of the protocol buffers wire format to write Mapbox Vector Tiles
+# (https://github.com/mapbox/vector-tile-spec/tree/master/2.1) and Geobuf
+# (https://github.com/mapbox/geobuf), without needing the protobuf library or generated
+# classes. Both are only ever written, never read.
+
+VARINT = 0
+FIXED64 = 1
+LENGTH_DELIMITED = 2
+FIXED32 = 5
+
+MVT_VERSION = 2
+MVT_EXTENT = 4096
+MVT_GEOMETRY_TYPES = { "Point" : 1, "LineString" : 2, "Polygon" : 3 }
+MOVE_TO, LINE_TO, CLOSE_PATH = 1, 2, 7
+
+GEOBUF_PRECISION = 6 # Decimal places kept of coordinates, the geobuf default
+GEOBUF_GEOMETRY_TYPES = {
+    "Point" : 0,
+    "MultiPoint" : 1,
+    "LineString" : 2,
+    "MultiLineString" : 3,
+    "Polygon" : 4,
+    "MultiPolygon" : 5,
+    "GeometryCollection" : 6,
+}
+MAX_INT64 = (1 << 63) - 1
+
+def encode_varint(value):
+    """Encode a non-negative integer as a base 128 varint"""
+    value = int(value)
+    if value < 0:
+        value += 1 << 64 # Negative int64s take all ten bytes, as protobuf writes them
+    encoded = bytearray()
+    while True:
+        byte = value & 0x7f
+        value >>= 7
+        if value:
+            encoded.append(byte | 0x80)
+        else:
+            encoded.append(byte)
+            return bytes(encoded)
+
+def zigzag(value):
+    """Map signed integers onto unsigned ones so small magnitudes stay small"""
+    return (value << 1) ^ (value >> 63)
+
+def encode_key(field, wire_type):
+    return encode_varint((field << 3) | wire_type)
+
+def encode_uint(field, value):
+    return encode_key(field, VARINT) + encode_varint(value)
+
+def encode_sint(field, value):
+    return encode_key(field, VARINT) + encode_varint(zigzag(value))
+
+def encode_double(field, value):
+    return encode_key(field, FIXED64) + struct.pack("<d", value)
+
+def encode_bytes(field, value):
+    if isinstance(value, unicode):
+        value = value.encode("utf-8")
+    return encode_key(field, LENGTH_DELIMITED) + encode_varint(len(value)) + value
+
+def encode_packed(field, values):
+    """Encode a repeated uint32 field in packed form"""
+    return encode_bytes(field, "".join(encode_varint(value) for value in values))
+
+
+def encode_packed_sint(field, values):
+    """Encode a repeated sint64 field in packed form"""
+    return encode_bytes(field, "".join(encode_varint(zigzag(value)) for value in values))
+
+def encode_value(value):
+    """Encode a property value as an MVT Value message"""
+    if isinstance(value, bool):
+        return encode_uint(7, int(value))
+    if isinstance(value, (int, long)):
+        if value < 0:
+            return encode_sint(6, value)
+        return encode_uint(5, value)
+    if isinstance(value, float):
+        return encode_double(3, value)
+    return encode_bytes(1, value if isinstance(value, basestring) else unicode(value))
+
+def command(command_id, count):
+    return (command_id & 0x7) | (count << 3)
+
+def encode_geometry(geometry_type, parts):
+    """
+    Encode the command integers of an MVT geometry from parts: lists of integer [x, y] tile
+    positions. Points are one part of positions, lines one part per line, and polygons one
+    part per ring (without its repeated closing position) in the winding order MVT expects.
+    """
+    commands = []
+    cursor_x = cursor_y = 0
+    for part in parts:
+        if geometry_type == "Point":
+            commands.append(command(MOVE_TO, len(part)))
+            for x, y in part:
+                commands.extend((zigzag(x - cursor_x), zigzag(y - cursor_y)))
+                cursor_x, cursor_y = x, y
+            continue
+        x, y = part[0]
+        commands.extend((command(MOVE_TO, 1), zigzag(x - cursor_x), zigzag(y - cursor_y)))
+        cursor_x, cursor_y = x, y
+        commands.append(command(LINE_TO, len(part) - 1))
+        for x, y in part[1:]:
+            commands.extend((zigzag(x - cursor_x), zigzag(y - cursor_y)))
+            cursor_x, cursor_y = x, y
+        if geometry_type == "Polygon":
+            commands.append(command(CLOSE_PATH, 1))
+    return commands
+
+class LayerEncoder(object):
+    """Collects the features of one MVT layer, sharing its key and value tables between them"""
+
+    def __init__(self, name, extent=MVT_EXTENT):
+        self.name = name
+        self.extent = extent
+        self.keys = {}
+        self.values = {}
+        self.features = []
+
+    def index(self, table, item):
+        if item not in table:
+            table[item] = len(table)
+        return table[item]
+
+    def add_feature(self, geometry_type, parts, properties=None, feature_id=None):
+        """Add a feature of a type in MVT_GEOMETRY_TYPES, with parts as encode_geometry takes them"""
+        tags = []
+        for key, value in sorted((properties or {}).iteritems()):
+            if value is None:
+                continue
+            # Tag values are matched by type as well as value, so True and 1 stay apart
+            tags.append(self.index(self.keys, key))
+            tags.append(self.index(self.values, (type(value), value)))
+        feature = ""
+        if feature_id is not None and feature_id >= 0:
+            feature += encode_uint(1, feature_id)
+        if tags:
+            feature += encode_packed(2, tags)
+        feature += encode_uint(3, MVT_GEOMETRY_TYPES[geometry_type])
+        feature += encode_packed(4, encode_geometry(geometry_type, parts))
+        self.features.append(feature)
+
+    def encode(self):
+        layer = encode_uint(15, MVT_VERSION) + encode_bytes(1, self.name)
+        for feature in self.features:
+            layer += encode_bytes(2, feature)
+        for key, _ in sorted(self.keys.items(), key=lambda item: item[1]):
+            layer += encode_bytes(3, key)
+        for (_, value), _ in sorted(self.values.items(), key=lambda item: item[1]):
+            layer += encode_bytes(4, encode_value(value))
+        layer += encode_uint(5, self.extent)
+        return layer
+
+def encode_tile(layers):
+    """Encode LayerEncoders as a vector tile. Layers without features are left out."""
+    return "".join(encode_bytes(3, layer.encode()) for layer in layers if layer.features)
+
+
+def encode_geobuf_value(value):
+    """Encode a property value as a geobuf Value message, with None as an empty one"""
+    if value is None:
+        return ""
+    if isinstance(value, bool):
+        return encode_uint(5, int(value))
+    if isinstance(value, basestring):
+        return encode_bytes(1, value)
+    if isinstance(value, float) and value.is_integer() and abs(value) <= MAX_INT64:
+        value = int(value) # As geobuf writes whole numbers
+    if isinstance(value, (int, long)) and abs(value) <= MAX_INT64:
+        if value < 0:
+            return encode_uint(4, -value)
+        return encode_uint(3, value)
+    if isinstance(value, float):
+        return encode_double(2, value)
+    return encode_bytes(6, json.dumps(value, separators=(',', ':'), default=unicode))
+
+def geobuf_line(coordinates, line, scale, closed=False):
+    """Append a line's positions to coordinates, rounded to the precision and delta encoded from its start"""
+    last_x = last_y = 0
+    for position in (line[:-1] if closed else line):
+        x, y = int(round(position[0] * scale)), int(round(position[1] * scale))
+        coordinates.extend((x - last_x, y - last_y))
+        last_x, last_y = x, y
+
+def encode_geobuf_geometry(geometry, scale):
+    """
+    Encode a GeoJSON geometry as a geobuf Geometry message. Positions keep two dimensions.
+    Ring lengths leave out the closing position, which is not written, and are left out
+    altogether where there is a single line or ring, as geobuf does.
+    """
+    geometry_type = geometry["type"]
+    message = encode_uint(1, GEOBUF_GEOMETRY_TYPES[geometry_type])
+    if geometry_type == "GeometryCollection":
+        for part in geometry["geometries"]:
+            message += encode_bytes(4, encode_geobuf_geometry(part, scale))
+        return message
+
+    coordinates = geometry["coordinates"]
+    lengths = []
+    values = []
+    if geometry_type == "Point":
+        values = [int(round(coordinates[0] * scale)), int(round(coordinates[1] * scale))]
+    elif geometry_type in ("MultiPoint", "LineString"):
+        geobuf_line(values, coordinates, scale)
+    elif geometry_type in ("MultiLineString", "Polygon"):
+        closed = geometry_type == "Polygon"
+        if len(coordinates) != 1:
+            lengths = [len(line) - (1 if closed else 0) for line in coordinates]
+        for line in coordinates:
+            geobuf_line(values, line, scale, closed)
+    else:
+        if len(coordinates) != 1 or len(coordinates[0]) != 1:
+            lengths = [len(coordinates)]
+            for polygon in coordinates:
+                lengths.append(len(polygon))
+                lengths.extend(len(ring) - 1 for ring in polygon)
+        for polygon in coordinates:
+            for ring in polygon:
+                geobuf_line(values, ring, scale, True)
+    if lengths:
+        message += encode_packed(2, lengths)
+    return message + encode_packed_sint(3, values)
+
+class GeobufEncoder(object):
+    """
+    Collects features into a geobuf FeatureCollection, sharing the table of property keys
+    between them. encode() writes the collection and starts a new one, so a long stream of
+    features can be written as a series of collections.
+    """
+
+    def __init__(self, precision=GEOBUF_PRECISION):
+        self.precision = precision
+        self.scale = 10 ** precision
+        self.reset()
+
+    def reset(self):
+        self.keys = {}
+        self.features = []
+        self.size = 0
+
+    def key(self, name):
+        if name not in self.keys:
+            self.keys[name] = len(self.keys)
+        return self.keys[name]
+
+    def encode_properties(self, properties, field):
+        """The Value messages and packed key, value index pairs of a set of properties"""
+        message = ""
+        indexes = []
+        for index, (name, value) in enumerate(sorted(properties.iteritems())):
+            message += encode_bytes(13, encode_geobuf_value(value))
+            indexes.extend((self.key(name), index))
+        if indexes:
+            message += encode_packed(field, indexes)
+        return message
+
+    def add_feature(self, feature):
+        message = ""
+        if feature.get("geometry"):
+            message += encode_bytes(1, encode_geobuf_geometry(feature["geometry"], self.scale))
+        message += self.encode_properties(feature.get("properties") or {}, 14)
+        self.features.append(message)
+        self.size += len(message)
+
+    def encode(self, custom_properties=None):
+        """Encode the collected features as a geobuf Data message, with any foreign members of the collection"""
+        collection = "".join(encode_bytes(1, feature) for feature in self.features)
+        collection += self.encode_properties(custom_properties or {}, 15)
+        data = "".join(encode_bytes(1, key) for key, _ in sorted(self.keys.items(), key=lambda item: item[1]))
+        if self.precision != GEOBUF_PRECISION:
+            data += encode_uint(3, self.precision)
+        data += encode_bytes(4, collection)
+        self.reset()
+        return data
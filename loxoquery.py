@@ -0,0 +1,186 @@
+from multiprocessing.pool import ThreadPool
+from ast import literal_eval
+from loxoutils import *
+from conversiontools.validategeojson import geometry_errors
+import traceback
+import threading
+import json
+import os
+
+# The filters of a collection query, turned from request arguments into a Mongo find. Building
+# a query touches neither the request nor the database, so a GET request's arguments and each
+# query of a batch go through the same code, and a batch's queries can run side by side on a
+# pool of threads sharing the Mongo connection pool.
+
+FILTER_ARGS = ["property", "value", "withinProximity", "withinDonut", "withinPolygon", "withinBBox", "intersects", "kNearest"]
+BATCH_WORKERS = int(os.environ.get("LOXO_BATCH_WORKERS", 8)) # Queries of a batch run at once
+BATCH_MAX_QUERIES = int(os.environ.get("LOXO_BATCH_MAX_QUERIES", 1000))
+
+class InvalidQuery(ValueError):
+    """A query whose arguments cannot be understood, with any details as payload"""
+
+    def __init__(self, message, payload=None):
+        ValueError.__init__(self, message)
+        self.payload = payload
+
+def parse_numbers(value, names, arg):
+    """Parse a comma separated argument holding len(names) numbers"""
+    try:
+        numbers = [float(number) for number in value.split(",")]
+    except ValueError:
+        numbers = []
+    if len(numbers) != len(names):
+        raise InvalidQuery(arg + " must be " + ",".join(names))
+    return numbers
+
+def build_query(args, other_args=()):
+    """
+    Return the query for a set of filter arguments, as a dict with find (the Mongo find) and,
+    for kNearest, near ([lng, lat]) and k. property filters take precedence over spatial ones.
+    Arguments besides filters, paging, detail and other_args are refused.
+    """
+    if args.get("property"):
+        return { "find" : { "properties." + args.get("property") : args.get("value") } }
+
+    if args.get("withinProximity"):
+        lng, lat, radius = parse_numbers(args.get("withinProximity"), ["lng", "lat", "radius"], "withinProximity")
+        return { "find" : { "geometry" : { "$geoWithin" : { "$centerSphere" : [[lng, lat], meters_to_radians(abs(radius))] } } } }
+
+    if args.get("withinDonut"):
+        lng, lat, donut_min, donut_max = parse_numbers(args.get("withinDonut"), ["lng", "lat", "min", "max"], "withinDonut")
+        # GeoJSON points measure $minDistance and $maxDistance in metres
+        donut_query = { "$nearSphere" : { "$geometry" : get_point(lng, lat), "$minDistance" : abs(donut_min), "$maxDistance" : abs(donut_max) } }
+        return { "find" : { "geometry" : donut_query } }
+
+    if args.get("withinPolygon"):
+        try:
+            polygon = [[float(value) for value in point] for point in literal_eval(args.get("withinPolygon"))]
+        except (SyntaxError, TypeError, ValueError):
+            raise InvalidQuery("withinPolygon must be a list of [lng, lat] points")
+        if polygon and polygon[0] != polygon[-1]:
+            polygon.append(polygon[0]) # GeoJSON rings are closed
+        if len(polygon) < 4:
+            raise InvalidQuery("withinPolygon must have at least three different [lng, lat] points")
+        return { "find" : { "geometry" : { "$geoWithin" : { "$geometry" : { "type" : "Polygon", "coordinates" : [polygon] } } } } }
+
+    if args.get("withinBBox"):
+        bbox = parse_numbers(args.get("withinBBox"), ["minx", "miny", "maxx", "maxy"], "withinBBox")
+        try:
+            return { "find" : get_bbox_query(*bbox) }
+        except ValueError:
+            raise InvalidQuery("withinBBox must be minx,miny,maxx,maxy in degrees")
+
+    if args.get("intersects"):
+        try:
+            geometry = json.loads(args.get("intersects"))
+        except ValueError:
+            geometry = None
+        problems = geometry_errors(geometry)
+        if problems:
+            raise InvalidQuery("intersects must be a GeoJSON geometry", { "errors" : problems })
+        return { "find" : { "geometry" : { "$geoIntersects" : { "$geometry" : geometry } } } }
+
+    if args.get("kNearest"):
+        lng, lat, k = parse_numbers(args.get("kNearest"), ["lng", "lat", "k"], "kNearest")
+        if k < 1 or k != int(k):
+            # Mongo takes a limit of 0 as no limit at all
+            raise InvalidQuery("kNearest k must be a whole number of at least 1")
+        near = { "geometry" : { "$nearSphere" : { "$geometry" : get_point(lng, lat) } } }
+        return { "find" : near, "near" : [lng, lat], "k" : int(k) }
+
+    if [arg for arg in args if arg not in PAGE_ARGS + DETAIL_ARGS + list(other_args)]:
+        raise InvalidQuery("Unknown query, filter with one of " + ", ".join(FILTER_ARGS))
+    return { "find" : {} }
+
+def run_query(collection, query, page=None, level=None):
+    """
+    Return the features of a query from build_query. Nearest features come in order of
+    distance, with kNeartestDistance in metres for points, and are not paged.
+    """
+    if "near" not in query:
+        return find_features(collection, query["find"], page, level)
+
+    lng, lat = query["near"]
+    results = list(with_level_of_detail(collection.find(query["find"], get_projection(None, level)).limit(query["k"]), level))
+    # Distances in metres, to points only
+    for feature in results:
+        geometry = feature.get("geometry") or {}
+        distance = None
+        if geometry.get("type") == "Point":
+            distance = float(get_distances(lng, lat, geometry["coordinates"][0], geometry["coordinates"][1]))
+        feature["properties"]["kNeartestDistance"] = distance
+    return results
+
+def query_spec_args(spec):
+    """
+    Return the arguments of a batch query spec, a JSON object in the vocabulary of the query
+    string, as the strings a request would have. Lists of numbers may stand for comma
+    separated ones, and withinPolygon and intersects may be JSON rather than JSON text.
+    """
+    if not isinstance(spec, dict):
+        raise InvalidQuery("Each query must be an object of query arguments")
+    args = {}
+    for name, value in spec.iteritems():
+        if name in ("withinPolygon", "intersects") and not isinstance(value, basestring):
+            value = json.dumps(value)
+        elif isinstance(value, (list, tuple)):
+            value = ",".join(unicode(part) for part in value)
+        elif not isinstance(value, basestring):
+            value = unicode(value)
+        args[name] = value
+    return args
+
+def run_query_spec(collection, spec):
+    """Run one query of a batch, returning its FeatureCollection, or its error, as JSON text"""
+    try:
+        args = query_spec_args(spec)
+        query = build_query(args)
+        page = get_page_options(args)
+        features = run_query(collection, query, page if "near" not in query else None, get_detail_level(args))
+        # The next page is the same query again, after the last feature returned
+        next_link = lambda after: dict(spec, after=after)
+        return "".join(iter_feature_collection(features, page["limit"] if "near" not in query else None, next_link))
+    except InvalidQuery as err:
+        error = dict(err.payload or (), message=str(err), status=400)
+    except ValueError as err:
+        error = { "message" : str(err), "status" : 400 }
+    except Exception as err:
+        # Such as a Mongo error, which fails this query but not the rest of the batch
+        print "Batch query", spec, "failed:", traceback.format_exc()
+        error = { "message" : str(err) or err.__class__.__name__, "status" : 500 }
+    return COMPACT_ENCODER.encode({ "error" : error })
+
+class BatchRunner(object):
+    """
+    Runs the queries of batches on a pool of threads. The pool is made with the first batch,
+    and made again in a forked process, which does not get its parent's threads.
+    """
+
+    def __init__(self, workers=BATCH_WORKERS):
+        self.workers = max(1, int(workers))
+        self.pool = None
+        self.pid = None
+        self.lock = threading.Lock()
+
+    def get_pool(self):
+        with self.lock:
+            if self.pid != os.getpid():
+                self.pool = ThreadPool(self.workers)
+                self.pid = os.getpid()
+            return self.pool
+
+    def run(self, collection, specs):
+        """Yield the JSON text of each query's result, in the order of specs, as the queries finish"""
+        return self.get_pool().imap(lambda spec: run_query_spec(collection, spec), specs)
+
+    def iter_results(self, collection, specs):
+        """Yield the results of a batch as a JSON object of a results array, a chunk at a time"""
+        yield '{"results":['
+        separator = ''
+        for result in self.run(collection, specs):
+            yield separator + result
+            separator = ','
+        yield ']}'
+
+
+batch_runner = BatchRunner()
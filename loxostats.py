@@ -1,25 +1,163 @@
-from pymongo import MongoClient, GEO2D, DESCENDING
-from flask import Flask, make_response, request,  Blueprint
+from pymongo import DESCENDING, ASCENDING
+from pymongo.errors import ConfigurationError
+from flask import Flask, make_response, request,  Blueprint, Response, stream_with_context, g
 from loxoutils import *
+from loxoerrors import *
+from loxoindex import *
+from loxopairwise import *
+from loxoweights import *
+from loxocache import *
+from loxointerp import *
+from loxocluster import *
+from loxometrics import record_pairwise_progress
+from conversiontools.mongoconnection import *
+import numpy as np
+import itertools
 import json
 from math import pow
 
 #Flask Setup
-client = MongoClient('localhost', 27017)
 stats_api = Blueprint('stats_api', __name__)
 
+def get_distance_method(default=DEFAULT_DISTANCE_METHOD):
+    """Return the distance method requested through the method parameter"""
+    method = request.args.get("method", default)
+    if method not in DISTANCE_METHODS:
+        raise InvalidUsage("Unknown distance method", 400, { "methods" : DISTANCE_METHODS })
+    return method
+
+def get_stats_session(database):
+    """
+    Return the request's causally consistent session on the stats client. The content version
+    and the data are read in it, so data read from a lagging secondary is never older than the
+    version it is cached and tagged under. None where the deployment has no sessions.
+    """
+    if "stats_session" not in g:
+        try:
+            g.stats_session = get_stats_database(database).client.start_session(causal_consistency=True)
+        except ConfigurationError:
+            g.stats_session = None
+    return g.stats_session
+
+@stats_api.teardown_request
+def end_stats_session(exception):
+    """End the request's stats session, if it started one"""
+    session = g.pop("stats_session", None)
+    if session is not None:
+        session.end_session()
+
+def find_points(database, dataset, projection=EXCLUDE_ID):
+    """Return a cursor over a datasets features in a stable (_id) order"""
+    return get_stats_database(database)[dataset].find({ }, projection, session=get_stats_session(database)).sort("_id", ASCENDING)
+
+def get_content_version(database, dataset):
+    """
+    Return the datasets content version as conditional_response read it, or "" for a dataset
+    loaded before versions were recorded, which a new load will give one. Cached structures
+    are kept under it, so they are never used with another version's points.
+    """
+    if "content_version" not in g:
+        metadata = get_stats_database(database)[METADATA_COLLECTION].find_one({ "_id" : dataset }, session=get_stats_session(database))
+        g.content_version = metadata["version"] if metadata else None
+    return g.content_version or ""
+
+def load_points(database, dataset):
+    """Return (lons, lats, loxo_ids) arrays for a dataset, from the weights cache when possible"""
+    def build():
+        features = list(find_points(database, dataset, { "_id" : 0, "geometry.coordinates" : 1, "properties.loxo_id" : 1 }))
+        lons, lats = get_coordinate_arrays(features)
+        ids = [-1 if id is None else id for id in get_feature_ids(features)]
+        return { "lons" : lons, "lats" : lats, "ids" : np.array(ids, dtype=np.int64) }
+
+    points = weights_cache.get_or_build((database, dataset, get_content_version(database, dataset), "points"), build)
+    return points["lons"], points["lats"], points["ids"]
+
+def load_attribute(database, dataset, attribute):
+    """Return a numeric attribute as a float array in the same order as load_points"""
+    return get_attribute_array(find_points(database, dataset, { "_id" : 0, "properties." + attribute : 1 }), attribute)
+
+def load_clusters(database, dataset, attributes):
+    """Return the ClusterIndex of a datasets points, aggregating attributes, from the cluster cache when possible"""
+    key = (database, dataset, get_content_version(database, dataset), tuple(attributes))
+    index = cluster_cache.get(key)
+    if index is None:
+        lons, lats, ids = load_points(database, dataset)
+        values = dict((attribute, load_attribute(database, dataset, attribute)) for attribute in attributes)
+        index = run_cpu_bound(ClusterIndex, lons, lats, ids, values)
+        cluster_cache.put(key, index)
+    return index
+
+def load_weights(database, dataset, spec, method, lons, lats):
+    """Return the CSR weights matrix of a dataset for a weights spec, from the weights cache when possible"""
+    name = "weights:" + json.dumps(spec, sort_keys=True) + ":" + method
+    build = lambda: weights_to_arrays(run_cpu_bound(build_weights, lons, lats, spec, method))
+    return arrays_to_weights(weights_cache.get_or_build((database, dataset, get_content_version(database, dataset), name), build))
+
+def load_tree(database, dataset, lons, lats):
+    """Return the unit-sphere KD-tree of a datasets points, from the tree cache when possible"""
+    key = (database, dataset, get_content_version(database, dataset))
+    tree = tree_cache.get(key)
+    if tree is None:
+        tree = run_cpu_bound(build_point_index, lons, lats)
+        tree_cache.put(key, tree)
+    return tree
+
+def get_idw_options(args):
+    """Return the neighbour search options (k, radius, power) of an IDW request"""
+    try:
+        options = {
+            "k" : int(args.get("k", DEFAULT_IDW_K)),
+            "radius" : float(args["radius"]) if args.get("radius") else None,
+            "power" : float(args.get("power", DEFAULT_IDW_POWER)),
+        }
+    except (TypeError, ValueError):
+        raise InvalidUsage("k, radius and power must be numbers", 400)
+    if options["k"] < 1 or options["power"] <= 0 or (options["radius"] is not None and options["radius"] <= 0):
+        raise InvalidUsage("k, radius and power must be positive", 400)
+    return options
+
+def get_tile_size():
+    """Return the tile size requested through the tileSize parameter"""
+    tile_size = request.args.get("tileSize", PAIRWISE_TILE_SIZE)
+    try:
+        tile_size = int(tile_size)
+    except ValueError:
+        raise InvalidUsage("tileSize must be a positive integer", 400)
+    if tile_size < 1:
+        raise InvalidUsage("tileSize must be a positive integer", 400)
+    return tile_size
+
+def get_feature_ids(features):
+    """Return the loxo_id of each feature, None where it has none"""
+    return [feature.get("properties", {}).get("loxo_id") for feature in features]
+
+def get_pair_ids(ids, i, j):
+    """Return the loxo_ids of a pair of points from a load_points id array"""
+    return [None if ids[index] < 0 else int(ids[index]) for index in (i, j)]
+
+def get_attribute_array(features, attribute):
+    """Return a float array of an attribute, raising InvalidUsage if it isn't numeric"""
+    try:
+        return np.array([float(feature["properties"][attribute]) for feature in features], dtype=np.float64)
+    except (KeyError, TypeError, ValueError):
+        raise InvalidUsage("Attribute " + str(attribute) + " is missing or none numerical", 400)
+
 @stats_api.route('/count', methods=['GET'])
+@conditional_response(get_stats_database, get_stats_session)
+@cache_response
 def get_feature_count(database, dataset):
     """Return a datasets feature count"""
-    db = client[database]
-    return make_response( json.dumps({ "count" : db[dataset].count()}) )
+    db = get_stats_database(database)
+    return make_response( json.dumps({ "count" : db[dataset].count(session=get_stats_session(database))}) )
 
 @stats_api.route('/centroid', methods=['GET'])
+@conditional_response(get_stats_database, get_stats_session)
+@cache_response
 def get_centroid(database, dataset):
     """Return centroid of a series of points"""
-    db = client[database]
+    db = get_stats_database(database)
     collection = db[dataset]
-    features = collection.find({ })
+    features = collection.find({ }, session=get_stats_session(database))
 
     #Compare all coordinates against all other coordinates (without duplicate comparisons)
     x_centroid = 0.0
@@ -39,117 +177,73 @@ def get_centroid(database, dataset):
 
 
 @stats_api.route('/averageDistance', methods=['GET'])
+@conditional_response(get_stats_database, get_stats_session)
+@cache_response
 def get_average_distance(database, dataset):
     """Return the average distance between a datasets geometries"""
-    db = client[database]
-    collection = db[dataset]
-    features = collection.find({ })
+    method = get_distance_method()
+    tile_size = get_tile_size()
+    lons, lats, ids = load_points(database, dataset)
 
     #Compare all coordinates against all other coordinates (without duplicate comparisons)
-    checked = set() # Use a set for checking purposes
-    counter = 0
-    distance = 0
-
-    for f1 in features:
-        counter += 1
-        coords1 = tuple(f1["geometry"]["coordinates"])
-        checked.add(coords1)
-        for f2 in features:
-            coords2 = tuple(f2["geometry"]["coordinates"])
-            if coords2 not in checked:
-                #Lon Lat for Mongo!
-                distance += abs(get_WGS84_distance(coords1[1], coords1[0], coords2[1],coords2[0]))
-
-    mean_distance = distance / counter
+    pairs, distance = run_cpu_bound(pairwise_distance_sum, lons, lats, method, tile_size, progress=record_pairwise_progress)
+
+    mean_distance = distance / pairs if pairs else 0.0
     return make_response( json.dumps({ "Average Distance (meters)" : mean_distance }) )
 
 
 @stats_api.route('/minDistance', methods=['GET'])
+@conditional_response(get_stats_database, get_stats_session)
+@cache_response
 def get_min_distance(database, dataset):
-    """Return the average distance between a datasets geometries"""
-    db = client[database]
-    collection = db[dataset]
-    features = collection.find({ })
+    """Return the minimum distance between a datasets geometries, and the features it is between"""
+    method = get_distance_method("geodesic")
+    lons, lats, ids = load_points(database, dataset)
 
-    #Compare all coordinates against all other coordinates (without duplicate comparisons)
-    checked = set() # Use a set for checking purposes
-    counter = 0
-    distance = 0
-    min_distance = None
-
-    for f1 in features:
-        counter += 1
-        coords1 = tuple(f1["geometry"]["coordinates"])
-        checked.add(coords1)
-        for f2 in features:
-            coords2 = tuple(f2["geometry"]["coordinates"])
-            if coords2 not in checked:
-                #Lon Lat for Mongo!
-                distance = abs(get_WGS84_distance(coords1[1], coords1[0], coords2[1],coords2[0]))
-                if not min_distance or distance < min_distance:
-                    min_distance = distance
-
-    return make_response( json.dumps({ "Minimum Distance (meters)" : min_distance }) )
+    pair = run_cpu_bound(closest_pair, lons, lats, method)
+    if pair is None:
+        return make_response( json.dumps({ "Minimum Distance (meters)" : None, "Features" : [] }) )
+
+    i, j, min_distance = pair
+    return make_response( json.dumps({ "Minimum Distance (meters)" : min_distance, "Features" : get_pair_ids(ids, i, j) }) )
 
 
 @stats_api.route('/maxDistance', methods=['GET'])
+@conditional_response(get_stats_database, get_stats_session)
+@cache_response
 def get_max_distance(database, dataset):
-    """Return the average distance between a datasets geometries"""
+    """Return the maximum distance between a datasets geometries, and the features it is between"""
+    method = get_distance_method("geodesic")
+    lons, lats, ids = load_points(database, dataset)
 
-    db = client[database]
-    collection = db[dataset]
-    features = collection.find({ })
+    pair = run_cpu_bound(farthest_pair, lons, lats, method)
+    if pair is None:
+        return make_response( json.dumps({ "Maximum Distance (meters)" : 0, "Features" : [] }) )
 
-    #Compare all coordinates against all other coordinates (without duplicate comparisons)
-    checked = set() # Use a set for checking purposes
-    counter = 0
-    distance = 0
-    max_distance = 0
-
-    for f1 in features:
-        counter += 1
-        coords1 = tuple(f1["geometry"]["coordinates"])
-        checked.add(coords1)
-        for f2 in features:
-            coords2 = tuple(f2["geometry"]["coordinates"])
-            if coords2 not in checked:
-                #Lon Lat for Mongo!
-                distance = abs(get_WGS84_distance(coords1[1], coords1[0], coords2[1],coords2[0]))
-                if distance > max_distance:
-                    max_distance = distance
-
-    return make_response( json.dumps({ "Maximum Distance (meters)" : max_distance }) )
+    i, j, max_distance = pair
+    return make_response( json.dumps({ "Maximum Distance (meters)" : max_distance, "Features" : get_pair_ids(ids, i, j) }) )
 
 
 @stats_api.route('/totalDistance', methods=['GET'])
+@conditional_response(get_stats_database, get_stats_session)
+@cache_response
 def get_total_distance(database, dataset):
-    """Return the average distance between a datasets geometries"""
-    db = client[database]
-    collection = db[dataset]
-    features = collection.find({ })
-
-    #Compare all coordinates against all other coordinates (without duplicate comparisons)
-    checked = set() # Use a set for checking purposes
-    distance = 0
+    """Return the total distance between a datasets geometries"""
+    method = get_distance_method()
+    tile_size = get_tile_size()
+    lons, lats, ids = load_points(database, dataset)
 
-    for f1 in features:
-        coords1 = tuple(f1["geometry"]["coordinates"])
-        checked.add(coords1)
-        for f2 in features:
-            coords2 = tuple(f2["geometry"]["coordinates"])
-            if coords2 not in checked:
-                #Lon Lat for Mongo!
-                distance += abs(get_WGS84_distance(coords1[1], coords1[0], coords2[1],coords2[0]))
+    pairs, distance = run_cpu_bound(pairwise_distance_sum, lons, lats, method, tile_size, progress=record_pairwise_progress)
 
-    mean_distance = distance
-    return make_response( json.dumps({ "Total Distance (meters)" : mean_distance }) )
+    return make_response( json.dumps({ "Total Distance (meters)" : distance }) )
 
 @stats_api.route('/idw', methods=['GET'])
+@conditional_response(get_stats_database, get_stats_session)
+@cache_response
 def get_idw_value(database, dataset):
-    """Return the average distance between a datasets geometries"""
-    db = client[database]
-    collection = db[dataset]
-    features = collection.find({ })
+    """Return an inverse distance weighted value for a point from its nearest neighbours"""
+    method = get_distance_method("haversine")
+    options = get_idw_options(request.args)
 
     target_point = request.args.get("interpPoint")
     point =  target_point.split(",")
@@ -157,157 +251,158 @@ def get_idw_value(database, dataset):
     lat = float(point[1])
 
     property = request.args.get("property")
+    lons, lats, ids = load_points(database, dataset)
+    values = load_attribute(database, dataset, property)
+    tree = load_tree(database, dataset, lons, lats)
 
-    interpolated_value = idw(features, property, [lng, lat])
+    interpolated_value = run_cpu_bound(idw, tree, lons, lats, values, [lng, lat], method, **options)
 
     return make_response( json.dumps( {"Point" : [lng, lat], "Interpolated Value" : interpolated_value } ) )
 
 
+@stats_api.route('/idw', methods=['POST'])
+def post_idw_values(database, dataset):
+    """
+    Return inverse distance weighted values for a batch of points, posted as JSON:
+    { "property" : "rating", "points" : [[lng, lat], ...], "k" : 12, "radius" : 5000, "power" : 2 }
+    """
+    body = request.get_json(silent=True)
+    if not isinstance(body, dict) or not body.get("property") or not isinstance(body.get("points"), list):
+        raise InvalidUsage("POST a JSON object with property and points", 400)
+    try:
+        targets = np.array(body["points"], dtype=np.float64).reshape(-1, 2)
+    except ValueError:
+        raise InvalidUsage("points must be a list of [lng, lat] pairs", 400)
+    method = body.get("method", "haversine")
+    if method not in DISTANCE_METHODS:
+        raise InvalidUsage("Unknown distance method", 400, { "methods" : DISTANCE_METHODS })
+    options = get_idw_options(body)
+
+    lons, lats, ids = load_points(database, dataset)
+    values = load_attribute(database, dataset, body["property"])
+    tree = load_tree(database, dataset, lons, lats)
+
+    interpolated = run_cpu_bound(idw_interpolate, tree, lons, lats, values, targets[:, 0], targets[:, 1], method=method, **options)
+    return make_response( json.dumps({ "property" : body["property"], "points" : targets.tolist(), "values" : nan_to_none(interpolated) }) )
+
+
+@stats_api.route('/idwGrid', methods=['GET'])
+@conditional_response(get_stats_database, get_stats_session)
+@cache_response
+def get_idw_grid(database, dataset):
+    """Return an inverse distance weighted grid of cell centres over bbox=minx,miny,maxx,maxy with cells resolution degrees wide"""
+    property = request.args.get("property")
+    if not property:
+        raise InvalidUsage("The property parameter is required", 400)
+    try:
+        bbox = [float(value) for value in request.args["bbox"].split(",")]
+        resolution = float(request.args["resolution"])
+    except (KeyError, ValueError):
+        raise InvalidUsage("bbox=minx,miny,maxx,maxy and resolution (degrees) are required", 400)
+    if len(bbox) != 4 or bbox[0] >= bbox[2] or bbox[1] >= bbox[3] or resolution <= 0:
+        raise InvalidUsage("bbox must be minx,miny,maxx,maxy and resolution positive", 400)
+    method = get_distance_method("haversine")
+    options = get_idw_options(request.args)
+
+    lons, lats, ids = load_points(database, dataset)
+    values = load_attribute(database, dataset, property)
+    tree = load_tree(database, dataset, lons, lats)
+
+    try:
+        grid = run_cpu_bound(idw_grid, tree, lons, lats, values, bbox, resolution, method=method, **options)
+    except ValueError as err:
+        raise InvalidUsage(str(err), 400)
+
+    return make_response( json.dumps({
+        "property" : property,
+        "bbox" : bbox,
+        "resolution" : resolution,
+        "width" : grid.shape[1],
+        "height" : grid.shape[0],
+        "values" : [nan_to_none(row) for row in grid],
+    }) )
+
+
+@stats_api.route('/clusters', methods=['GET'])
+@conditional_response(get_stats_database, get_stats_session)
+@cache_response
+def get_clusters(database, dataset):
+    """
+    Return the point clusters of a zoom level within bbox=minx,miny,maxx,maxy as GeoJSON, with
+    the sum, mean, min and max of each numeric property in aggregate=a,b. Points that are not
+    in a cluster are returned as themselves.
+    """
+    try:
+        zoom = int(request.args.get("zoom", 0))
+        bbox = [float(value) for value in request.args.get("bbox", "-180,-90,180,90").split(",")]
+    except ValueError:
+        raise InvalidUsage("zoom must be a zoom level and bbox minx,miny,maxx,maxy", 400)
+    if zoom < 0 or len(bbox) != 4 or bbox[1] > bbox[3]:
+        raise InvalidUsage("zoom must be a zoom level and bbox minx,miny,maxx,maxy", 400)
+    attributes = sorted(set(name.strip() for name in request.args.get("aggregate", "").split(",") if name.strip()))
+
+    clusters, point_ids = load_clusters(database, dataset, attributes).get_clusters(bbox, zoom)
+    points = find_features_by_id(get_stats_database(database)[dataset], point_ids, session=get_stats_session(database))
+    return Response(stream_with_context(iter_feature_collection(itertools.chain(clusters, points))), mimetype='application/json')
+
 
 @stats_api.route('/moransI', methods=['GET'])
+@conditional_response(get_stats_database, get_stats_session)
+@cache_response
 def get_morans_i(database, dataset):
-    """Return the Morans I for a given attribute"""
+    """Return the Morans I for a given attribute, weights are chosen with weights=knn&k=8 or weights=band&d=500"""
 
     attribute = request.args.get("attribute")
 
-    if len(request.args) == 0:
+    if not attribute:
         return "You must specify the attribute parameter!"
 
-    elif len(request.args) == 1 and attribute:
-        db = client[database]
-        collection = db[dataset]
+    method = get_distance_method()
+    spec = parse_weights_spec(request.args)
+    lons, lats, ids = load_points(database, dataset)
+    values = load_attribute(database, dataset, attribute)
+
+    weights = load_weights(database, dataset, spec, method, lons, lats)
+    check_autocorrelation(weights, values)
 
-        features = loads(dumps(collection.find({}, EXCLUDE_ID)))
-        I = morans_i(features, attribute)
-        return str(I)
+    I = run_cpu_bound(morans_i, weights, values)
+    return make_response( json.dumps({ "morans_i" : I, "weights" : spec }) )
 
 @stats_api.route('/gearysC', methods=['GET'])
+@conditional_response(get_stats_database, get_stats_session)
+@cache_response
 def get_gearys_c(database, dataset):
-    """Return the Morans I for a given attribute"""
+    """Return the Gearys C for a given attribute, weights are chosen with weights=knn&k=8 or weights=band&d=500"""
 
     attribute = request.args.get("attribute")
 
-    if len(request.args) == 0:
+    if not attribute:
         return "You must specify the attribute parameter!"
 
-    elif len(request.args) == 1 and attribute:
-        db = client[database]
-        collection = db[dataset]
+    method = get_distance_method()
+    spec = parse_weights_spec(request.args)
+    lons, lats, ids = load_points(database, dataset)
+    values = load_attribute(database, dataset, attribute)
 
-        features = loads(dumps(collection.find({}, EXCLUDE_ID)))
-        C = gearys_c(features, attribute)
-        return str(C)
+    weights = load_weights(database, dataset, spec, method, lons, lats)
+    check_autocorrelation(weights, values)
 
-def morans_i(points, attribute):
+    C = run_cpu_bound(gearys_c, weights, values)
+    return make_response( json.dumps({ "gearys_c" : C, "weights" : spec }) )
 
-    try:
-
-        weights_sum = 0.0   #S0
-        n = float(len(points))   #n
-        numerator = 0.0    #top part
-        denominator = 0.0   #bottom part
-
-        # Calculate the mean of our attribute (x bar)
-        x_mean = 0.0 #x bar
-        for x in points:
-            x_mean += float(x["properties"][attribute])
-        x_mean = x_mean / n
-
-        print "X MEAN: ", x_mean
-
-        # Double Sigma sum notation
-        for i in points:
-            lng1 = i["geometry"]["coordinates"][0]
-            lat1 = i["geometry"]["coordinates"][1]
-            i_attribute = float(i["properties"][attribute])
-            denominator += pow((i_attribute - x_mean), 2)
-
-            for j in points:
-                lng2 = j["geometry"]["coordinates"][0]
-                lat2 = j["geometry"]["coordinates"][1]
-                j_attribute = float(j["properties"][attribute])
-                d = get_WGS84_distance(lat1, lng1, lat2, lng2) # Distance
-
-                wij = 1 / 1 + d #pow( 1 + d, 1 )
-                weights_sum += wij
-
-                numerator += ( wij * (i_attribute - x_mean) * (j_attribute - x_mean) )
-
-        print weights_sum, n
-        n_over_weights = n / weights_sum
-        print numerator, denominator
-        I = n_over_weights * (numerator / denominator)
-        return '{ "morans_i" : "' + str(I) + '"}'
-
-    except TypeError:
-        return "Attribute is none numerical"
-
-
-def gearys_c(points, attribute):
-
-    try:
-        C = 0.0
-        n = float(len(points))   #n
-        numerator = 0.0    #top part
-        denominator = 0.0   #bottom part
-        weights_sum = 0.0
 
-        # Calculate the mean of our attribute (x bar)
-        x_mean = 0.0 #x bar
-        for x in points:
-            x_mean += float(x["properties"][attribute])
-        x_mean = x_mean / n
-
-        # Double Sigma sum notation
-        for i in points:
-            lng1 = i["geometry"]["coordinates"][0]
-            lat1 = i["geometry"]["coordinates"][1]
-            i_attribute = float(i["properties"][attribute])
-            denominator += pow((i_attribute - x_mean), 2)
-
-            for j in points:
-                lng2 = j["geometry"]["coordinates"][0]
-                lat2 = j["geometry"]["coordinates"][1]
-                j_attribute = float(j["properties"][attribute])
-                d = get_WGS84_distance(lat1, lng1, lat2, lng2) # Distance
-
-                wij = 1 / 1 + d #pow( 1 + d, 1 )
-                weights_sum += wij
-
-                numerator += (wij * pow( (i_attribute - x_mean), 2))
-
-
-        numerator = (n - 1) * numerator
-        denominator = 2 * weights_sum * denominator
-        C = numerator / denominator
-        return '{ "gearys_c" : "' + str() + '"}'
-
-    except TypeError:
-        return "Attribute is none numerical"
-
-
-
-def idw(points, variable, interp_point):
+def idw(tree, lons, lats, values, interp_point, method="haversine", **options):
 
     lon2 = float(interp_point[0])
     lat2 = float(interp_point[1])
-    numerator = 0
-    denominator = 0
-
-    for known_point in points:
-        lon1 = float(known_point["geometry"]["coordinates"][0])
-        lat1 = float(known_point["geometry"]["coordinates"][1])
-        known_point_variable = known_point["properties"][variable]
-        if not is_float(known_point_variable):
-            return "Variable", known_point_variable, "is not numeric; it cannot be interpolated"
-        distance = get_WGS84_distance( lat1, lon1, lat2, lon2 )
-        numerator += 1 / distance * float(known_point_variable)
-        denominator += 1 / distance
-
-    v = numerator / denominator
+    v = idw_interpolate(tree, lons, lats, values, [lon2], [lat2], method=method, **options)[0]
 
     return '{ "idw_interpolated_point" : "' + str(v) + '"}'
 
+def nan_to_none(values):
+    """Return a list of floats with NaN replaced by None, so it serialises as JSON null"""
+    return [None if value != value else value for value in values.tolist()]
+
 def is_float(value):
   try:
     float(value)
@@ -0,0 +1,376 @@
+from flask import Blueprint, Response, request, url_for
+from loxoutils import *
+from loxoerrors import *
+from loxocache import *
+from loxoproto import *
+from conversiontools.mongoconnection import *
+import numpy as np
+import json
+import math
+import time
+import sys
+
+# Map tiles of a dataset, for viewers that cannot take a whole collection at once. Each
+# tile's features are found with a bbox query, taken at the level of detail stored for its
+# zoom, projected to web mercator, clipped to the tile (plus a buffer) and quantized to the
+# tile's grid. Tiles are written as Mapbox Vector Tiles, or as compact GeoJSON for clients
+# without a vector tile renderer, and kept in a disk cache per dataset content version.
+
+tiles_api = Blueprint('tiles_api', __name__)
+
+TILE_EXTENT = MVT_EXTENT
+TILE_BUFFER = 64 # Tile units kept around lines and polygons, so clipped edges are drawn off the tile
+TILE_MAX_ZOOM = 22
+TILE_FULL_QUERY_ZOOM = 2 # Below this zoom tiles are too large for a bbox query, every feature is read
+TILE_FORMATS = { "mvt" : "application/vnd.mapbox-vector-tile", "pbf" : "application/vnd.mapbox-vector-tile", "json" : "application/json" }
+SEED_MAX_ZOOM = int(os.environ.get("LOXO_TILE_SEED_ZOOM", 6))
+MAX_LATITUDE = 85.0511287798 # Where web mercator is cut off
+
+def tile_scale(z):
+    """Tile units across the whole world at zoom z"""
+    return float(2 ** z * TILE_EXTENT)
+
+def lon_to_tile_x(lons, z):
+    return (np.asarray(lons, dtype=np.float64) + 180) / 360 * tile_scale(z)
+
+def lat_to_tile_y(lats, z):
+    lats = np.radians(np.clip(np.asarray(lats, dtype=np.float64), -MAX_LATITUDE, MAX_LATITUDE))
+    return (1 - np.log(np.tan(lats) + 1 / np.cos(lats)) / math.pi) / 2 * tile_scale(z)
+
+def tile_x_to_lon(xs, z):
+    return np.asarray(xs, dtype=np.float64) / tile_scale(z) * 360 - 180
+
+def tile_y_to_lat(ys, z):
+    return np.degrees(np.arctan(np.sinh(math.pi * (1 - 2 * np.asarray(ys, dtype=np.float64) / tile_scale(z)))))
+
+def tile_bounds(z, x, y, buffer=0):
+    """Return (west, south, east, north) of a tile, grown by buffer tile units"""
+    west, east = tile_x_to_lon([x * TILE_EXTENT - buffer, (x + 1) * TILE_EXTENT + buffer], z)
+    north, south = tile_y_to_lat([y * TILE_EXTENT - buffer, (y + 1) * TILE_EXTENT + buffer], z)
+    return max(west, -180.0), max(south, -90.0), min(east, 180.0), min(north, 90.0)
+
+def tile_query(z, x, y):
+    """The Mongo query for the features that may fall in a tile"""
+    if z < TILE_FULL_QUERY_ZOOM:
+        return {}
+    return get_bbox_query(*tile_bounds(z, x, y, TILE_BUFFER), operator="$geoIntersects")
+
+def project_positions(positions, z, x, y):
+    """Project a list of [lon, lat] positions to an (n, 2) array of a tile's units"""
+    positions = np.array([position[:2] for position in positions], dtype=np.float64).reshape(-1, 2)
+    projected = np.empty_like(positions)
+    projected[:, 0] = lon_to_tile_x(positions[:, 0], z) - x * TILE_EXTENT
+    projected[:, 1] = lat_to_tile_y(positions[:, 1], z) - y * TILE_EXTENT
+    return projected
+
+def quantize_part(points):
+    """Round tile positions to whole units, dropping the repeats that leaves"""
+    quantized = []
+    for point in np.rint(points).astype(np.int64).tolist():
+        if not quantized or point != quantized[-1]:
+            quantized.append(point)
+    return quantized
+
+def clip_segment(start, end, low, high):
+    """Liang-Barsky clipping of a segment to a square, returning the clipped ends or None"""
+    t0, t1 = 0.0, 1.0
+    delta = end - start
+    for axis in (0, 1):
+        for p, q in ((-delta[axis], start[axis] - low), (delta[axis], high - start[axis])):
+            if p == 0:
+                if q < 0:
+                    return None
+            else:
+                t = q / p
+                if p < 0:
+                    t0 = max(t0, t)
+                else:
+                    t1 = min(t1, t)
+    if t0 > t1:
+        return None
+    return start + t0 * delta, start + t1 * delta
+
+def clip_line(points, low, high):
+    """Clip a line of tile positions to a square, returning the parts left inside it"""
+    if points.min() >= low and points.max() <= high:
+        return [points]
+    parts = []
+    part = []
+    for start, end in zip(points[:-1], points[1:]):
+        clipped = clip_segment(start, end, low, high)
+        if clipped is None:
+            continue
+        if part and not np.array_equal(part[-1], clipped[0]):
+            parts.append(np.array(part))
+            part = []
+        if not part:
+            part.append(clipped[0])
+        part.append(clipped[1])
+    if part:
+        parts.append(np.array(part))
+    return parts
+
+def clip_ring(points, low, high):
+    """Sutherland-Hodgman clipping of a closed ring of tile positions to a square"""
+    if points.min() >= low and points.max() <= high:
+        return points
+    ring = points[:-1].tolist()
+    for axis in (0, 1):
+        for bound, inside in ((low, lambda value: value >= low), (high, lambda value: value <= high)):
+            if not ring:
+                return np.empty((0, 2))
+            clipped = []
+            previous = ring[-1]
+            for point in ring:
+                if inside(point[axis]) != inside(previous[axis]):
+                    t = (bound - previous[axis]) / (point[axis] - previous[axis])
+                    clipped.append([previous[0] + t * (point[0] - previous[0]), previous[1] + t * (point[1] - previous[1])])
+                if inside(point[axis]):
+                    clipped.append(point)
+                previous = point
+            ring = clipped
+    if not ring:
+        return np.empty((0, 2))
+    return np.array(ring + [ring[0]])
+
+def ring_area(ring):
+    """Shoelace area of a ring of tile positions, positive when clockwise on screen (y down)"""
+    return sum(x1 * y2 - x2 * y1 for (x1, y1), (x2, y2) in zip(ring[:-1], ring[1:])) / 2.0
+
+def iter_simple_geometries(geometry):
+    """
+    Yield a geometry as ("Point", positions), ("LineString", lines) and ("Polygon", polygons)
+    groups, the three geometry types a vector tile feature can have
+    """
+    if geometry is None:
+        return
+    geometry_type = geometry["type"]
+    if geometry_type == "GeometryCollection":
+        for part in geometry["geometries"]:
+            for simple in iter_simple_geometries(part):
+                yield simple
+    elif geometry_type == "Point":
+        yield "Point", [geometry["coordinates"]]
+    elif geometry_type == "MultiPoint":
+        yield "Point", geometry["coordinates"]
+    elif geometry_type == "LineString":
+        yield "LineString", [geometry["coordinates"]]
+    elif geometry_type == "MultiLineString":
+        yield "LineString", geometry["coordinates"]
+    elif geometry_type == "Polygon":
+        yield "Polygon", [geometry["coordinates"]]
+    elif geometry_type == "MultiPolygon":
+        yield "Polygon", geometry["coordinates"]
+
+def tile_geometry(geometry_type, parts, z, x, y):
+    """
+    Project, clip and quantize one of iter_simple_geometries' groups to a tile. Returns a list
+    of quantized positions for points, of lines for lines and of polygons (lists of closed
+    rings, outer ring first) for polygons; empty when nothing is left on the tile.
+    """
+    low, high = -TILE_BUFFER, TILE_EXTENT + TILE_BUFFER
+    if geometry_type == "Point":
+        # Points are only kept by the tile they are on, so they are never drawn twice
+        points = project_positions(parts, z, x, y)
+        inside = (points >= 0).all(axis=1) & (points < TILE_EXTENT).all(axis=1)
+        return quantize_part(points[inside]) if inside.any() else []
+
+    if geometry_type == "LineString":
+        lines = []
+        for line in parts:
+            for clipped in clip_line(project_positions(line, z, x, y), low, high):
+                clipped = quantize_part(clipped)
+                if len(clipped) >= 2:
+                    lines.append(clipped)
+        return lines
+
+    polygons = []
+    for polygon in parts:
+        rings = []
+        for ring in polygon:
+            clipped = quantize_part(clip_ring(project_positions(ring, z, x, y), low, high))
+            if len(clipped) >= 4 and ring_area(clipped) != 0:
+                rings.append(clipped)
+            elif not rings:
+                break # The outer ring is not on the tile, nor are its holes
+        if rings:
+            polygons.append(rings)
+    return polygons
+
+def tile_properties(properties):
+    """Vector tile values are scalars, nested properties are written as JSON"""
+    flat = {}
+    for key, value in (properties or {}).iteritems():
+        if isinstance(value, (dict, list)):
+            value = json.dumps(value, separators=(',', ':'), default=json_util.default)
+        elif value is not None and not isinstance(value, (basestring, bool, int, long, float)):
+            value = unicode(value)
+        flat[key] = value
+    return flat
+
+def mvt_parts(geometry_type, tiled):
+    """Turn tile_geometry's output into encode_geometry's parts, winding rings as MVT requires"""
+    if geometry_type != "Polygon":
+        return [tiled] if geometry_type == "Point" else tiled
+    parts = []
+    for polygon in tiled:
+        for index, ring in enumerate(polygon):
+            # Outer rings have a positive area and holes a negative one
+            if (ring_area(ring) > 0) != (index == 0):
+                ring = ring[::-1]
+            parts.append(ring[:-1])
+    return parts
+
+def tile_to_lon_lat(part, z, x, y, decimals):
+    """Turn quantized tile positions back into rounded [lon, lat] positions"""
+    part = np.array(part, dtype=np.float64)
+    lons = np.round(tile_x_to_lon(part[:, 0] + x * TILE_EXTENT, z), decimals)
+    lats = np.round(tile_y_to_lat(part[:, 1] + y * TILE_EXTENT, z), decimals)
+    return np.column_stack((lons, lats)).tolist()
+
+def geojson_geometry(geometry_type, tiled, z, x, y):
+    """Turn tile_geometry's output back into a GeoJSON geometry, at the precision of the tile's grid"""
+    decimals = max(0, int(math.ceil(math.log10(tile_scale(z) / 360))))
+    if geometry_type == "Point":
+        coordinates = tile_to_lon_lat(tiled, z, x, y, decimals)
+    elif geometry_type == "LineString":
+        coordinates = [tile_to_lon_lat(line, z, x, y, decimals) for line in tiled]
+    else:
+        coordinates = [[tile_to_lon_lat(ring, z, x, y, decimals) for ring in polygon] for polygon in tiled]
+    if len(coordinates) == 1:
+        return { "type" : geometry_type, "coordinates" : coordinates[0] }
+    return { "type" : "Multi" + geometry_type, "coordinates" : coordinates }
+
+def build_tile(collection, z, x, y, tile_format="mvt"):
+    """Return the bytes of a tile of a collection, in a format from TILE_FORMATS"""
+    features = find_features(collection, tile_query(z, x, y), None, get_level_of_detail(zoom=z))
+    layer = LayerEncoder(collection.name, TILE_EXTENT)
+    tile_features = []
+    for feature in features:
+        properties = feature.get("properties") or {}
+        for geometry_type, parts in iter_simple_geometries(feature.get("geometry")):
+            tiled = tile_geometry(geometry_type, parts, z, x, y)
+            if not tiled:
+                continue
+            if tile_format == "json":
+                tile_features.append({ "type" : "Feature", "properties" : properties, "geometry" : geojson_geometry(geometry_type, tiled, z, x, y) })
+            else:
+                layer.add_feature(geometry_type, mvt_parts(geometry_type, tiled), tile_properties(properties), properties.get("loxo_id"))
+    if tile_format == "json":
+        return "".join(iter_feature_collection(tile_features))
+    return encode_tile([layer])
+
+def get_tile(database, dataset, z, x, y, tile_format="mvt"):
+    """Return a tile from the tile cache, building and storing it if it is not there"""
+    db = get_database(database)
+    metadata = db[METADATA_COLLECTION].find_one({ "_id" : dataset })
+    name = "/".join((str(z), str(x), str(y) + "." + tile_format))
+    if metadata is not None:
+        tile = tile_cache.get(database, dataset, metadata["version"], name)
+        if tile is not None:
+            return tile
+    tile = build_tile(db[dataset], z, x, y, tile_format)
+    # Collections loaded before content versions were recorded have no version to cache under
+    if metadata is not None:
+        tile_cache.put(database, dataset, metadata["version"], name, tile)
+    return tile
+
+def iter_positions(geometry):
+    for geometry_type, parts in iter_simple_geometries(geometry):
+        if geometry_type == "Point":
+            lines = [parts]
+        elif geometry_type == "LineString":
+            lines = parts
+        else:
+            lines = [ring for polygon in parts for ring in polygon]
+        for line in lines:
+            for position in line:
+                yield position
+
+def get_bounds(collection):
+    """Return [west, south, east, north] of a collection, from its coarsest stored level of detail"""
+    level = get_level_of_detail(zoom=0)
+    bounds = [180.0, 90.0, -180.0, -90.0]
+    for feature in with_level_of_detail(collection.find({}, get_projection(["loxo_id"], level)), level):
+        positions = np.array([position[:2] for position in iter_positions(feature.get("geometry"))], dtype=np.float64).reshape(-1, 2)
+        if len(positions):
+            bounds[:2] = np.minimum(bounds[:2], positions.min(axis=0)).tolist()
+            bounds[2:] = np.maximum(bounds[2:], positions.max(axis=0)).tolist()
+    return bounds if bounds[0] <= bounds[2] else [-180.0, -90.0, 180.0, 90.0]
+
+def covering_tiles(bounds, z):
+    """Yield the (x, y) of every tile at zoom z that covers part of bounds"""
+    west, south, east, north = bounds
+    last = 2 ** z - 1
+    min_x, max_x = [min(last, max(0, int(value // TILE_EXTENT))) for value in lon_to_tile_x([west, east], z)]
+    min_y, max_y = [min(last, max(0, int(value // TILE_EXTENT))) for value in lat_to_tile_y([north, south], z)]
+    for x in xrange(min_x, max_x + 1):
+        for y in xrange(min_y, max_y + 1):
+            yield x, y
+
+def seed_tiles(database, dataset, max_zoom=SEED_MAX_ZOOM, tile_format="mvt"):
+    """Build and cache every tile of a dataset up to max_zoom, returning how many there were"""
+    bounds = get_bounds(get_database(database)[dataset])
+    count = 0
+    for z in xrange(max_zoom + 1):
+        started = time.time()
+        tiles = 0
+        for x, y in covering_tiles(bounds, z):
+            get_tile(database, dataset, z, x, y, tile_format)
+            tiles += 1
+        count += tiles
+        print "Seeded", tiles, "tiles at zoom", z, "in %.1fs" % (time.time() - started)
+    return count
+
+
+@tiles_api.route('', methods=['GET'])
+@conditional_response(get_database)
+@cache_response
+def get_tilejson(database, dataset):
+    """Describe a datasets tiles as TileJSON, with a tile URL template for format (mvt or json)"""
+    tile_format = request.args.get("format", "mvt")
+    if tile_format not in TILE_FORMATS:
+        raise InvalidUsage("Unknown tile format", 400, { "formats" : sorted(TILE_FORMATS) })
+    template = request.base_url + "/{z}/{x}/{y}." + tile_format
+    return Response(json.dumps({
+        "tilejson" : "2.2.0",
+        "name" : dataset,
+        "format" : tile_format,
+        "tiles" : [template],
+        "minzoom" : 0,
+        "maxzoom" : TILE_MAX_ZOOM,
+        "bounds" : get_bounds(get_database(database)[dataset]),
+        "vector_layers" : [{ "id" : dataset }],
+    }), mimetype='application/json')
+
+@tiles_api.route('/<int:z>/<int:x>/<int:y>', methods=['GET'])
+@tiles_api.route('/<int:z>/<int:x>/<int:y>.<tile_format>', methods=['GET'])
+@conditional_response(get_database)
+def get_data_tile(database, dataset, z, x, y, tile_format="mvt"):
+    """Return a tile of a dataset as a Mapbox Vector Tile, or compact GeoJSON with the .json extension"""
+    if tile_format not in TILE_FORMATS:
+        raise InvalidUsage("Unknown tile format", 400, { "formats" : sorted(TILE_FORMATS) })
+    if z > TILE_MAX_ZOOM or x >= 2 ** z or y >= 2 ** z:
+        raise InvalidUsage("No such tile", 404)
+    return Response(get_tile(database, dataset, z, x, y, tile_format), mimetype=TILE_FORMATS[tile_format])
+
+
+if __name__ == '__main__':
+
+    try:
+        if len(sys.argv) < 3:
+            print "Usage: python loxotiles.py <database> <dataset> [max zoom, default " + str(SEED_MAX_ZOOM) + "] [mvt or json]"
+        else:
+            database, dataset = sys.argv[1], sys.argv[2]
+            max_zoom = int(sys.argv[3]) if len(sys.argv) > 3 else SEED_MAX_ZOOM
+            tile_format = sys.argv[4] if len(sys.argv) > 4 else "mvt"
+            if get_database(database)[METADATA_COLLECTION].find_one({ "_id" : dataset }) is None:
+                print "No content version is recorded for", dataset, "so its tiles cannot be cached, load it again first"
+            else:
+                started = time.time()
+                count = seed_tiles(database, dataset, max_zoom, tile_format)
+                print "Seeded", count, "tiles of", dataset, "in %.1fs" % (time.time() - started)
+
+    except:
+        error = sys.exc_info()[0]
+        print "There was an error: ", error
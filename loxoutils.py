@@ -1,29 +1,330 @@
 from json import *
 from bson.json_util import dumps
+from bson import json_util
 from geographiclib.geodesic import Geodesic
+import numpy as np
+import itertools
+import os
 from conversiontools.csv2geojson import *
 from conversiontools.geojson2mongo import *
+from conversiontools.csv2mongo import *
+from conversiontools.shp2mongo import *
+from conversiontools.kml2mongo import *
+from conversiontools.simplifygeojson import LOD_FIELD, LOD_ZOOMS, get_level_of_detail
+from loxometrics import timed_kernel
 
 EARTH_RADIUS = 6378.1
 GEO_DIST = "s12" # How geographiclib calls distance?
-EXCLUDE_ID = {"_id": 0 }
+EXCLUDE_ID = {"_id": 0, LOD_FIELD: 0 } # Stored levels of detail are only read when asked for
+STREAM_CHUNK_SIZE = 64 * 1024 # Bytes of features gathered before a chunk is sent
+COMPACT_ENCODER = JSONEncoder(separators=(',', ':'), default=json_util.default)
+LOXO_ID = "properties.loxo_id"
+PAGE_ARGS = ["limit", "after", "fields"] # Query arguments that page a response rather than filter it
+ID_BATCH_SIZE = 1000 # loxo_ids per query when features are found by id
+DETAIL_ARGS = ["simplify", "zoom"] # Query arguments that choose a level of detail
+WRITE_CSV_GEOJSON = os.environ.get("LOXO_WRITE_CSV_GEOJSON") == "1" # Keep a GeoJSON copy of CSV uploads
 
-def create_feature_collection(return_features):
-    arg_type = type(return_features)
-    if arg_type != list and arg_type == str:
-        return dumps({ "type": "FeatureCollection", 'features':  loads(return_features) }, indent=4 )
-    elif arg_type == list:
-        return dumps({ "type": "FeatureCollection", 'features':  return_features }, indent=4 )
+# Batch distance kernels
+MEAN_EARTH_RADIUS = 6371008.8 # IUGG mean radius in metres, used by the haversine kernel
+HAVERSINE_RELATIVE_ERROR = 0.0057 # Worst case relative error of haversine against the WGS84 geodesic
+WGS84_A = Geodesic.WGS84.a
+WGS84_F = Geodesic.WGS84.f
+WGS84_B = (1 - WGS84_F) * WGS84_A
+VINCENTY_TOLERANCE = 1e-12
+VINCENTY_MAX_ITERATIONS = 200
+DISTANCE_METHODS = ["haversine", "vincenty", "geodesic"]
+DEFAULT_DISTANCE_METHOD = "vincenty"
+BBOX_EDGE_STEP = 1.0 # Degrees between the points added along the north and south edges of a bbox polygon
+STRICT_WINDING_CRS = { "type" : "name", "properties" : { "name" : "urn:x-mongodb:crs:strictwinding:EPSG:4326" } }
+
+def iter_feature_collection(features, limit=None, next_link=None):
+    """
+    Yield a FeatureCollection as compact JSON text, one chunk of features at a time, so that a
+    cursor can be streamed to the client without holding the whole collection in memory.
+
+    When limit is given, at most limit features are written. If the features run on past the
+    limit (find_features fetches one extra), the footer carries a "next" member built by
+    next_link(loxo_id of the last feature written).
+    """
+    yield '{"type":"FeatureCollection","features":['
+    chunk = []
+    chunk_size = 0
+    separator = ''
+    written = 0
+    last_feature = None
+    more = False
+    for feature in features:
+        if limit is not None and written == limit:
+            more = True
+            break
+        written += 1
+        last_feature = feature
+        encoded = separator + COMPACT_ENCODER.encode(feature)
+        separator = ','
+        chunk.append(encoded)
+        chunk_size += len(encoded)
+        if chunk_size >= STREAM_CHUNK_SIZE:
+            yield ''.join(chunk)
+            chunk = []
+            chunk_size = 0
+    if chunk:
+        yield ''.join(chunk)
+    if more and next_link:
+        yield '],"next":' + COMPACT_ENCODER.encode(next_link(last_feature["properties"]["loxo_id"])) + '}'
+    else:
+        yield ']}'
+
+# CPU heavy work, such as the stats kernels, goes through run_cpu_bound. It runs in the
+# caller's thread unless a server that serves many requests per thread sets an executor with
+# set_cpu_executor, which loads share (see geojson2mongo)
+
+def run_cpu_bound(function, *args, **kwargs):
+    """Return function(*args, **kwargs), run by the CPU executor if one is set, recording its running time"""
+    return run_in_cpu_executor(timed_kernel(function), *args, **kwargs)
 
 def meters_to_radians(meters):
     rads = float(meters / 1000) / EARTH_RADIUS
     return rads
 
+def get_point(lng, lat):
+    return { "type" : "Point", "coordinates" : [lng, lat] }
+
 def get_WGS84_distance( lat1, lon1, lat2, lon2 ):
     return Geodesic.WGS84.Inverse(lat1, lon1, lat2, lon2, Geodesic.DISTANCE)[GEO_DIST]
 
-def find_features(collection, findDict):
-    return dumps(collection.find(findDict, EXCLUDE_ID))
+def haversine_distances(lons1, lats1, lons2, lats2):
+    """
+    Great circle distances in metres on a sphere of radius MEAN_EARTH_RADIUS.
+    Inputs are broadcast against each other like any NumPy ufunc.
+
+    Error bound: the sphere ignores the flattening of the WGS84 ellipsoid, so results can
+    be off by up to HAVERSINE_RELATIVE_ERROR (0.57%) of the true geodesic distance,
+    typically below 0.3%.
+    """
+    lons1, lats1, lons2, lats2 = [np.radians(np.asarray(a, dtype=np.float64)) for a in (lons1, lats1, lons2, lats2)]
+    h = np.sin((lats2 - lats1) / 2) ** 2 + np.cos(lats1) * np.cos(lats2) * np.sin((lons2 - lons1) / 2) ** 2
+    return 2 * MEAN_EARTH_RADIUS * np.arcsin(np.sqrt(np.clip(h, 0.0, 1.0)))
+
+def vincenty_distances(lons1, lats1, lons2, lats2):
+    """
+    Ellipsoidal distances in metres using Vincenty's inverse formula on WGS84, iterated for
+    all pairs at once. Inputs are broadcast against each other like any NumPy ufunc.
+
+    Error bound: 0.5mm for pairs that converge. Vincenty fails to converge for nearly
+    antipodal pairs; those pairs fall back to the exact geodesic solution.
+    """
+    lons1, lats1, lons2, lats2 = np.broadcast_arrays(*[np.asarray(a, dtype=np.float64) for a in (lons1, lats1, lons2, lats2)])
+
+    L = np.radians(lons2 - lons1)
+    U1 = np.arctan((1 - WGS84_F) * np.tan(np.radians(lats1)))
+    U2 = np.arctan((1 - WGS84_F) * np.tan(np.radians(lats2)))
+    sin_U1, cos_U1 = np.sin(U1), np.cos(U1)
+    sin_U2, cos_U2 = np.sin(U2), np.cos(U2)
+
+    lam = L.copy()
+    converged = np.zeros(L.shape, dtype=bool)
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        for _ in xrange(VINCENTY_MAX_ITERATIONS):
+            sin_lam, cos_lam = np.sin(lam), np.cos(lam)
+            sin_sigma = np.sqrt((cos_U2 * sin_lam) ** 2 + (cos_U1 * sin_U2 - sin_U1 * cos_U2 * cos_lam) ** 2)
+            cos_sigma = sin_U1 * sin_U2 + cos_U1 * cos_U2 * cos_lam
+            sigma = np.arctan2(sin_sigma, cos_sigma)
+            sin_alpha = np.where(sin_sigma == 0, 0.0, cos_U1 * cos_U2 * sin_lam / sin_sigma)
+            cos_sq_alpha = 1 - sin_alpha ** 2
+            # Equatorial lines have cos_sq_alpha == 0
+            cos_2sigma_m = np.where(cos_sq_alpha == 0, 0.0, cos_sigma - 2 * sin_U1 * sin_U2 / cos_sq_alpha)
+            C = WGS84_F / 16 * cos_sq_alpha * (4 + WGS84_F * (4 - 3 * cos_sq_alpha))
+            lam_previous = lam
+            lam = L + (1 - C) * WGS84_F * sin_alpha * (sigma + C * sin_sigma * (cos_2sigma_m + C * cos_sigma * (-1 + 2 * cos_2sigma_m ** 2)))
+            converged = np.abs(lam - lam_previous) <= VINCENTY_TOLERANCE
+            if converged.all():
+                break
+
+        u_sq = cos_sq_alpha * (WGS84_A ** 2 - WGS84_B ** 2) / WGS84_B ** 2
+        A = 1 + u_sq / 16384 * (4096 + u_sq * (-768 + u_sq * (320 - 175 * u_sq)))
+        B = u_sq / 1024 * (256 + u_sq * (-128 + u_sq * (74 - 47 * u_sq)))
+        delta_sigma = B * sin_sigma * (cos_2sigma_m + B / 4 * (cos_sigma * (-1 + 2 * cos_2sigma_m ** 2) -
+                      B / 6 * cos_2sigma_m * (-3 + 4 * sin_sigma ** 2) * (-3 + 4 * cos_2sigma_m ** 2)))
+        distances = WGS84_B * A * (sigma - delta_sigma)
+
+    failed = ~converged | ~np.isfinite(distances)
+    if failed.any():
+        distances[failed] = geodesic_distances(lons1[failed], lats1[failed], lons2[failed], lats2[failed])
+    return distances
+
+def geodesic_distances(lons1, lats1, lons2, lats2):
+    """
+    Exact WGS84 geodesic distances in metres (Karney's algorithm via geographiclib).
+    Inputs are broadcast against each other like any NumPy ufunc.
+
+    Error bound: 15 nanometres, but every pair is a separate solve in Python, so this is
+    by far the slowest method. Use it to refine a small set of candidate pairs.
+    """
+    lons1, lats1, lons2, lats2 = np.broadcast_arrays(*[np.asarray(a, dtype=np.float64) for a in (lons1, lats1, lons2, lats2)])
+    distances = np.empty(lons1.shape, dtype=np.float64)
+    flat_distances = distances.reshape(-1)
+    for index, (lon1, lat1, lon2, lat2) in enumerate(zip(lons1.flat, lats1.flat, lons2.flat, lats2.flat)):
+        flat_distances[index] = get_WGS84_distance(lat1, lon1, lat2, lon2)
+    return distances
+
+DISTANCE_KERNELS = {
+    "haversine": haversine_distances,
+    "vincenty": vincenty_distances,
+    "geodesic": geodesic_distances,
+}
+
+def get_distances(lons1, lats1, lons2, lats2, method=DEFAULT_DISTANCE_METHOD):
+    """Distances in metres between broadcastable coordinate arrays using the chosen method"""
+    if method not in DISTANCE_KERNELS:
+        raise ValueError("Unknown distance method " + str(method) + ", must be one of " + ", ".join(DISTANCE_METHODS))
+    return DISTANCE_KERNELS[method](lons1, lats1, lons2, lats2)
+
+def get_distance_block(lons1, lats1, lons2, lats2, method=DEFAULT_DISTANCE_METHOD):
+    """Matrix of distances in metres from every point in the first arrays to every point in the second"""
+    lons1, lats1 = np.asarray(lons1, dtype=np.float64), np.asarray(lats1, dtype=np.float64)
+    return get_distances(lons1[:, np.newaxis], lats1[:, np.newaxis], lons2, lats2, method)
+
+def get_coordinate_arrays(features):
+    """Return the longitudes and latitudes of an iterable of point features as NumPy arrays"""
+    coords = np.array([feature["geometry"]["coordinates"][:2] for feature in features], dtype=np.float64).reshape(-1, 2)
+    return coords[:, 0], coords[:, 1]
+
+def get_page_options(args):
+    """
+    Return the paging options of a request: limit (features per page), after (the loxo_id the
+    page starts after) and fields (the properties to return, comma separated).
+    """
+    page = { "limit" : None, "after" : None, "fields" : None }
+    try:
+        if args.get("limit"):
+            page["limit"] = int(args["limit"])
+            if page["limit"] < 1:
+                raise ValueError
+        if args.get("after"):
+            page["after"] = int(args["after"])
+    except ValueError:
+        raise ValueError("limit must be a positive integer and after a loxo_id")
+    if args.get("fields"):
+        page["fields"] = [field.strip() for field in args["fields"].split(",") if field.strip()]
+    return page
+
+def get_detail_level(args):
+    """
+    Return the stored level of detail asked for by zoom (a web map zoom level) or simplify (a
+    tolerance in degrees), or None for full detail.
+    """
+    try:
+        zoom = int(args["zoom"]) if args.get("zoom") else None
+        tolerance = float(args["simplify"]) if args.get("simplify") else None
+        if zoom is not None and zoom < 0 or tolerance is not None and not tolerance >= 0:
+            raise ValueError
+    except ValueError:
+        raise ValueError("zoom must be a zoom level and simplify a tolerance in degrees")
+    return get_level_of_detail(zoom, tolerance)
+
+def get_projection(fields=None, level=None):
+    """
+    Project features down to the given properties, always keeping geometry and loxo_id, along
+    with the stored level of detail if one is given.
+    """
+    if not fields:
+        if level is None:
+            return EXCLUDE_ID
+        projection = { "_id" : 0 }
+        for zoom in LOD_ZOOMS:
+            if str(zoom) != level:
+                projection[LOD_FIELD + "." + str(zoom)] = 0
+        return projection
+    projection = { "_id" : 0, "type" : 1, "geometry" : 1, LOXO_ID : 1 }
+    for field in fields:
+        projection["properties." + field] = 1
+    if level is not None:
+        projection[LOD_FIELD + "." + level] = 1
+    return projection
+
+def with_level_of_detail(features, level):
+    """Swap each feature's geometry for its stored level of detail, where it has one"""
+    for feature in features:
+        levels = feature.pop(LOD_FIELD, None)
+        if levels and level in levels:
+            feature["geometry"] = levels[level]
+        yield feature
+
+# Collections known to have a loxo_id index, so it is only created once per process
+indexed_collections = set()
+
+def ensure_loxo_id_index(collection):
+    key = (collection.database.name, collection.name)
+    if key not in indexed_collections:
+        collection.create_index([(LOXO_ID, 1)], background=True)
+        indexed_collections.add(key)
+
+def find_features(collection, findDict, page=None, level=None, session=None):
+    """
+    Return a cursor over the features matching findDict. With paging options from
+    get_page_options the find is keyset paged on loxo_id: it starts after the given
+    loxo_id and returns one feature beyond the limit, so the caller can tell if more follow.
+    With a level from get_detail_level, features come with that level's geometry.
+    A session, when given, is the one the find is made in.
+    """
+    options = { "session" : session } if session else {}
+    if not page:
+        cursor = collection.find(findDict, get_projection(None, level), **options)
+    elif page["limit"] is None and page["after"] is None:
+        cursor = collection.find(findDict, get_projection(page["fields"], level), **options)
+    else:
+        ensure_loxo_id_index(collection)
+        if page["after"] is not None:
+            after = { LOXO_ID : { "$gt" : page["after"] } }
+            findDict = { "$and" : [findDict, after] } if findDict else after
+        cursor = collection.find(findDict, get_projection(page["fields"], level), **options).sort(LOXO_ID, 1)
+        if page["limit"] is not None:
+            cursor = cursor.limit(page["limit"] + 1)
+    if level is not None:
+        return with_level_of_detail(cursor, level)
+    return cursor
+
+def find_features_by_id(collection, ids, batch_size=ID_BATCH_SIZE, session=None):
+    """
+    Return an iterator over the features with the given loxo_ids, in loxo_id order. They are
+    found batch_size ids at a time, so no query outgrows Mongo's document size limit and
+    features are only fetched as they are consumed.
+    """
+    ensure_loxo_id_index(collection)
+    ids = sorted(ids)
+    batches = (ids[start:start + batch_size] for start in xrange(0, len(ids), batch_size))
+    return itertools.chain.from_iterable(find_features(collection, { LOXO_ID : { "$in" : batch } }, session=session) for batch in batches)
+
+def get_bbox_polygon(west, south, east, north):
+    """
+    Return a GeoJSON Polygon for a longitude and latitude box, for $geoIntersects and
+    $geoWithin queries. Mongo joins polygon points along great circles, so points are added
+    along the north and south edges to keep them close to their parallels. The ring runs
+    anticlockwise with Mongo's strict winding CRS, so boxes larger than a hemisphere keep
+    their inside.
+    """
+    steps = max(1, int(np.ceil((east - west) / BBOX_EDGE_STEP)))
+    lons = np.linspace(west, east, steps + 1).tolist()
+    ring = [[lon, south] for lon in lons] + [[lon, north] for lon in reversed(lons)]
+    return { "type" : "Polygon", "coordinates" : [ring + [ring[0]]], "crs" : STRICT_WINDING_CRS }
+
+def get_bbox_query(west, south, east, north, operator="$geoWithin"):
+    """
+    Return the find for features within (or, with $geoIntersects, touching) a box, which uses
+    the 2dsphere index on geometry. Boxes with west > east cross the antimeridian. Boxes
+    without width or height are refused.
+    """
+    if south >= north or west == east or not (-90 <= south and north <= 90 and -180 <= west <= 180 and -180 <= east <= 180):
+        raise ValueError("bbox must be minx,miny,maxx,maxy in degrees")
+    if west > east:
+        # A box starting or ending on the antimeridian has nothing on one side of it
+        sides = [(low, high) for low, high in [(west, 180.0), (-180.0, east)] if low < high]
+        if not sides:
+            raise ValueError("bbox must be minx,miny,maxx,maxy in degrees")
+        queries = [get_bbox_query(low, south, high, north, operator) for low, high in sides]
+        return { "$or" : queries } if len(queries) > 1 else queries[0]
+    return { "geometry" : { operator : { "$geometry" : get_bbox_polygon(west, south, east, north) } } }
 
 def allowed_file(filename, ALLOWED_EXTENSIONS):
     return '.' in filename and filename.rsplit('.', 1)[1] in ALLOWED_EXTENSIONS
@@ -31,12 +332,29 @@ def allowed_file(filename, ALLOWED_EXTENSIONS):
 def get_file_type(filename):
     return filename.rsplit('.', 1)[1]
 
-def handle_file(db, filename, endpoint_name, host):
+def handle_file(db, filename, endpoint_name, job=None, validation=LOAD_VALIDATION):
+    """
+    Load an uploaded file into a collection, skipping or rejecting invalid features as
+    validation says. Phases, progress, the validation report and CSV type mismatches go to
+    job if given.
+    """
     file_type = get_file_type(filename)
+    options = { "validation" : validation }
+    if job:
+        if validation not in (None, "none"):
+            job.validation = options["report"] = ValidationReport()
+        options["progress"] = job.progress
+        job.set_phase("loading")
+
     if file_type == "csv":
-        file = csv_to_geojson(filename, "./uploads/" + endpoint_name)
+        # Rows go straight into Mongo, the GeoJSON copy is only written when asked for
+        output_name = "./uploads/" + endpoint_name if WRITE_CSV_GEOJSON else None
+        mismatches = job.mismatches if job else None
+        return csv_to_mongodb(db, filename, endpoint_name, output_name=output_name, mismatches=mismatches, **options)
     if file_type == "geojson":
-        file = filename
-
-    feature_collection_to_mongodb(db, file, collection_name=endpoint_name, host=host)
-
+        return feature_collection_to_mongodb(db, filename, collection_name=endpoint_name, **options)
+    if file_type == "zip":
+        return shapefile_to_mongodb(db, filename, endpoint_name, **options)
+    if file_type == "kml":
+        return kml_to_mongodb(db, filename, endpoint_name, **options)
+    raise ValueError("Loading " + file_type + " files is not supported yet")
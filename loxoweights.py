@@ -0,0 +1,144 @@
+from scipy import sparse
+from loxoindex import *
+from loxoerrors import *
+import numpy as np
+
+# Spatial weights matrices for autocorrelation statistics, stored as CSR sparse matrices
+# so that only neighbouring pairs are kept and the statistics become matrix-vector products.
+
+WEIGHT_TYPES = ["knn", "band", "idw"]
+WEIGHT_TRANSFORMS = ["b", "r"] # Binary (as built) or row standardised
+DEFAULT_WEIGHTS = "knn"
+DEFAULT_K = 8
+DEFAULT_POWER = 1.0
+
+def pairs_to_weights(n, i, j, values=None):
+    """Return a symmetric n x n CSR matrix with the given values on the (i, j) and (j, i) pairs"""
+    if values is None:
+        values = np.ones(len(i))
+    rows = np.concatenate((i, j))
+    columns = np.concatenate((j, i))
+    return sparse.csr_matrix((np.concatenate((values, values)), (rows, columns)), shape=(n, n))
+
+def knn_weights(lons, lats, k=DEFAULT_K, tree=None):
+    """Return binary weights linking every point to its k nearest neighbours (not symmetric)"""
+    n = len(lons)
+    k = min(k, n - 1)
+    if k < 1:
+        return sparse.csr_matrix((n, n))
+    if tree is None:
+        tree = build_point_index(lons, lats)
+
+    _, neighbours = tree.query(tree.data, k=k + 1)
+    rows = np.arange(n)[:, np.newaxis]
+    # Drop each point from its own neighbour list, or the farthest neighbour when duplicates hid it
+    not_self = neighbours != rows
+    not_self[not_self.all(axis=1), -1] = False
+    columns = neighbours[not_self].reshape(n, k)
+    return sparse.csr_matrix((np.ones(n * k), (np.repeat(np.arange(n), k), columns.ravel())), shape=(n, n))
+
+def band_pairs(lons, lats, distance, method=DEFAULT_DISTANCE_METHOD, tree=None):
+    """Return (i, j, distances) for every pair of points no more than distance metres apart"""
+    if tree is None:
+        tree = build_point_index(lons, lats)
+    # Widen the chord search by the haversine error so the exact method makes the final cut
+    radius = meters_to_chord(distance * SPHERICAL_ERROR_MARGIN)
+    pairs = tree.query_pairs(radius, output_type='ndarray')
+    distances = refine_pairs(lons, lats, pairs, method)
+    keep = distances <= distance
+    return pairs[keep, 0], pairs[keep, 1], distances[keep]
+
+def band_weights(lons, lats, distance, method=DEFAULT_DISTANCE_METHOD, tree=None):
+    """Return binary weights linking every pair of points within distance metres"""
+    i, j, _ = band_pairs(lons, lats, distance, method, tree)
+    return pairs_to_weights(len(lons), i, j)
+
+def inverse_distance_weights(lons, lats, distance, power=DEFAULT_POWER, method=DEFAULT_DISTANCE_METHOD, tree=None):
+    """
+    Return weights of 1 / d ** power for every pair of points within distance metres.
+    Coincident points have no finite inverse distance, so they are left unlinked.
+    """
+    i, j, distances = band_pairs(lons, lats, distance, method, tree)
+    apart = distances > 0
+    return pairs_to_weights(len(lons), i[apart], j[apart], 1.0 / distances[apart] ** power)
+
+def row_standardize(weights):
+    """Return the weights scaled so that every row with neighbours sums to one"""
+    row_sums = np.asarray(weights.sum(axis=1)).ravel()
+    scale = np.zeros(len(row_sums))
+    scale[row_sums > 0] = 1.0 / row_sums[row_sums > 0]
+    return sparse.diags(scale).dot(weights).tocsr()
+
+def parse_weights_spec(args):
+    """
+    Return a normalised weights spec dictionary from request arguments, e.g.
+    weights=knn&k=8, weights=band&d=500 or weights=idw&d=500&power=2, with an
+    optional transform=r for row standardised weights.
+    """
+    weights = args.get("weights", DEFAULT_WEIGHTS)
+    if weights not in WEIGHT_TYPES:
+        raise InvalidUsage("Unknown weights type", 400, { "weights" : WEIGHT_TYPES })
+    transform = args.get("transform", "b")
+    if transform not in WEIGHT_TRANSFORMS:
+        raise InvalidUsage("Unknown weights transform", 400, { "transform" : WEIGHT_TRANSFORMS })
+
+    spec = { "weights" : weights, "transform" : transform }
+    try:
+        if weights == "knn":
+            spec["k"] = int(args.get("k", DEFAULT_K))
+            if spec["k"] < 1:
+                raise ValueError
+        else:
+            spec["d"] = float(args["d"])
+            if spec["d"] <= 0:
+                raise ValueError
+        if weights == "idw":
+            spec["power"] = float(args.get("power", DEFAULT_POWER))
+    except KeyError:
+        raise InvalidUsage("The d parameter (metres) is required for " + weights + " weights", 400)
+    except ValueError:
+        raise InvalidUsage("Weights parameters must be positive numbers", 400)
+    return spec
+
+def build_weights(lons, lats, spec, method=DEFAULT_DISTANCE_METHOD):
+    """Build the CSR weights matrix described by a spec from parse_weights_spec"""
+    tree = build_point_index(lons, lats)
+    if spec["weights"] == "knn":
+        weights = knn_weights(lons, lats, spec["k"], tree)
+    elif spec["weights"] == "band":
+        weights = band_weights(lons, lats, spec["d"], method, tree)
+    else:
+        weights = inverse_distance_weights(lons, lats, spec["d"], spec["power"], method, tree)
+    if spec["transform"] == "r":
+        weights = row_standardize(weights)
+    return weights
+
+def check_autocorrelation(weights, values):
+    """
+    Raise InvalidUsage when Moran's I and Geary's C are undefined for a value vector, which is
+    when the values are constant or not all finite, or no points are neighbours (S0 is 0)
+    """
+    if not np.isfinite(values).all():
+        raise InvalidUsage("The attribute must be finite for every feature", 400)
+    if len(values) < 2 or values.min() == values.max():
+        raise InvalidUsage("The attribute is constant, so its autocorrelation is undefined", 400)
+    if weights.sum() == 0:
+        raise InvalidUsage("No features are neighbours under these weights, so autocorrelation is undefined", 400)
+
+def morans_i(weights, values):
+    """Moran's I of a value vector: n / S0 * (z' W z) / (z' z) where z are deviations from the mean"""
+    n = float(len(values))
+    z = values - values.mean()
+    weights_sum = weights.sum()   #S0
+    return (n / weights_sum) * (z.dot(weights.dot(z)) / z.dot(z))
+
+def gearys_c(weights, values):
+    """Geary's C of a value vector: (n - 1) * sum(wij (xi - xj)^2) / (2 * S0 * sum(z^2))"""
+    n = float(len(values))
+    z = values - values.mean()
+    weights_sum = weights.sum()   #S0
+    # sum(wij (zi - zj)^2) expanded into row sums, column sums and z' W z
+    row_sums = np.asarray(weights.sum(axis=1)).ravel()
+    column_sums = np.asarray(weights.sum(axis=0)).ravel()
+    squared_differences = (z ** 2).dot(row_sums) + (z ** 2).dot(column_sums) - 2 * z.dot(weights.dot(z))
+    return (n - 1) * squared_differences / (2 * weights_sum * z.dot(z))
@@ -19,18 +19,104 @@ function onEachFeature(feature, layer) {
     layer.bindPopup(popupContent)
 }
 
+// Loxo collections are drawn from GeoJSON tiles, fetched for the tiles in view as the map moves
+var LOXO_COLLECTION = /^(.*\/loxo\/[^\/?]+\/collections\/[^\/?]+)\/?$/;
+
+var GeoJSONTileLayer = L.Class.extend({
+
+    initialize: function (template, options) {
+        this._template = template;
+        this._tiles = {};
+        L.setOptions(this, options);
+    },
+
+    onAdd: function (map) {
+        this._map = map;
+        this._group = L.layerGroup().addTo(map);
+        map.on('moveend', this._update, this);
+        this._update();
+    },
+
+    onRemove: function (map) {
+        map.off('moveend', this._update, this);
+        map.removeLayer(this._group);
+        this._tiles = {};
+    },
+
+    _update: function () {
+        var map = this._map;
+        var zoom = map.getZoom();
+        var bounds = map.getPixelBounds();
+        var last = Math.pow(2, zoom) - 1;
+        var minX = Math.max(0, Math.floor(bounds.min.x / 256)), maxX = Math.min(last, Math.floor(bounds.max.x / 256));
+        var minY = Math.max(0, Math.floor(bounds.min.y / 256)), maxY = Math.min(last, Math.floor(bounds.max.y / 256));
+        var wanted = {};
+
+        for (var x = minX; x <= maxX; x++) {
+            for (var y = minY; y <= maxY; y++) {
+                var key = zoom + "/" + x + "/" + y;
+                wanted[key] = true;
+                if (!this._tiles[key]) {
+                    this._load(key, zoom, x, y);
+                }
+            }
+        }
+        for (var tile in this._tiles) {
+            if (!wanted[tile]) {
+                if (this._tiles[tile] !== true) {
+                    this._group.removeLayer(this._tiles[tile]);
+                }
+                delete this._tiles[tile];
+            }
+        }
+    },
+
+    _load: function (key, zoom, x, y) {
+        var self = this;
+        var url = L.Util.template(this._template, { z: zoom, x: x, y: y });
+        this._tiles[key] = true; // Loading
+        $.getJSON(url, function (tile) {
+            if (self._tiles[key] !== true) {
+                return; // Scrolled away while it loaded
+            }
+            self._tiles[key] = L.geoJson(tile, self.options);
+            self._group.addLayer(self._tiles[key]);
+        });
+    }
+});
+
+var geoJsonOptions = {
+    onEachFeature: onEachFeature,
+    pointToLayer: function (feature, latlng) {
+        return L.circleMarker(latlng, { radius: 4 });
+    }
+};
+
 function viewGeoJson(element) {
 
     var url = document.getElementById("geojson-endpoint").value;
     console.log(url);
+    if (geoJsonLayer) {
+        map.removeLayer(geoJsonLayer)
+    }
+
+    var collection = LOXO_COLLECTION.exec(url);
+    if (collection) {
+        $.getJSON(collection[1] + "/tiles?format=json", function (tileJson) {
+            var bounds = tileJson.bounds;
+            geoJsonLayer = new GeoJSONTileLayer(tileJson.tiles[0], geoJsonOptions);
+            map.fitBounds([[bounds[1], bounds[0]], [bounds[3], bounds[2]]]);
+            map.addLayer(geoJsonLayer);
+        });
+        return false;
+    }
+
     $.get(url,
         function(geoJson) {
             if (geoJson) {
-                var geoJsonFeatures = JSON.parse(geoJson);
-                if (geoJsonLayer) {
-                    map.removeLayer(geoJsonLayer)
-                }
-                geoJsonLayer = L.geoJson(geoJsonFeatures,{ onEachFeature: onEachFeature }).addTo(map);
+                // Loxo serves application/json, which jQuery has usually parsed already
+                var geoJsonFeatures = typeof geoJson === "string" ? JSON.parse(geoJson) : geoJson;
+                geoJsonLayer = L.geoJson(geoJsonFeatures, geoJsonOptions).addTo(map);
                 map.fitBounds(geoJsonLayer.getBounds());
             }
         }
@@ -1,6 +1,9 @@
 import unittest
+import json
 import os
-from pymongo import MongoClient, GEO2D, DESCENDING
+from StringIO import StringIO
+from pymongo import DESCENDING
+from pymongo.read_preferences import ReadPreference
 from bson import json_util
 from conversiontools.csv2geojson import *
 from conversiontools.kml2geojson import *
@@ -8,6 +11,9 @@ from conversiontools.shp2geojson import *
 from conversiontools.validategeojson import *
 from conversiontools.geojson2mongo import *
 from conversiontools.geojsonurl2mongo import *
+from conversiontools.simplifygeojson import *
+from conversiontools.topology import *
+from conversiontools.mongoconnection import *
 
 
 class conversionTest(unittest.TestCase):
@@ -17,8 +23,7 @@ class conversionTest(unittest.TestCase):
         self.data_input_folder = "data-load/example/"
         self.data_output_folder = "data-outputs/"
         self.database = "testdatabase"
-        self.client = MongoClient('localhost', 27017)
-        self.db = self.client[self.database]
+        self.db = get_database(self.database)
         os.chdir("../conversiontools")
 
 
@@ -31,6 +36,47 @@ class conversionTest(unittest.TestCase):
         self.assertFalse(validate_geojson_from_file(invalid_input_geojson))
 
 
+    def validationreport_test(self):
+        """ Testing that validation reports every invalid feature, not just the first """
+
+        feature = lambda geometry: { "type" : "Feature", "properties" : {}, "geometry" : geometry }
+        features = [
+            feature({ "type" : "Point", "coordinates" : [1.0, 2.0] }),
+            feature({ "type" : "Polygon", "coordinates" : [[[0, 0], [1, 0], [1, 1], [0, 1]]] }),
+            feature({ "type" : "MultiLineString", "coordinates" : [[[0, 0], [1, 95]]] }),
+            feature({ "type" : "GeometryCollection", "geometries" : [{ "type" : "MultiPoint", "coordinates" : [[1, 2], [3, 4, 5]] }] }),
+            { "type" : "Feature", "geometry" : { "type" : "Point", "coordinates" : [1.0, 2.0] } },
+        ]
+        report = validate_features(features).to_dict()
+        self.assertEqual(report["features"], 5)
+        self.assertEqual(report["invalid"], 3)
+        self.assertEqual([error["feature"] for error in report["errors"]], [1, 2, 4])
+        self.assertEqual(geometry_errors({ "type" : "Polygon", "coordinates" : [[1, 2, 3, 4]] }), ["Coordinates must be arrays of at least two numbers"])
+
+        invalid_input_geojson = self.data_input_folder + "cupcakesmalformed.geojson"
+        report = validate_geojson_report(invalid_input_geojson)
+        self.assertEqual(report.invalid, 1)
+        self.assertEqual(report.errors[0]["feature"], 0)
+
+
+    def topology_test(self):
+        """ Testing that a border shared by two polygons becomes one arc and is simplified the same on both sides """
+
+        border = [[0.001 * (i % 2), i / 100.0] for i in range(101)]
+        west = { "type" : "Polygon", "coordinates" : [border + [[-1, 1], [-1, 0], border[0]]] }
+        east = { "type" : "Polygon", "coordinates" : [border[::-1] + [[1, 0], [1, 1], border[-1]]] }
+        arcs, shapes = build_topology([west, east])
+        self.assertEqual(len(arcs), 3)
+        self.assertEqual(shape_to_geometry(shapes[0], arcs), west)
+        self.assertEqual(shape_to_geometry(shapes[1], arcs), east)
+
+        levels = build_levels_of_detail([west, east], [6])
+        west_border = set(tuple(position) for position in levels[0]["6"]["coordinates"][0] if position[0] > -1)
+        east_border = set(tuple(position) for position in levels[1]["6"]["coordinates"][0] if position[0] < 1)
+        self.assertEqual(west_border, east_border)
+        self.assertTrue(len(west_border) < len(border))
+
+
     def csv2geojson_test(self):
         """ Testing that CSV correctly translates to GeoJSON """
 
@@ -43,6 +89,32 @@ class conversionTest(unittest.TestCase):
         self.assertTrue(validate_geojson_from_file(output_geojson))
 
 
+    def csvfeatures_test(self):
+        """ Testing that CSV rows stream as features with numeric columns typed """
+
+        input_csv = self.data_input_folder + "significantmonth.csv"
+        features = list(iter_csv_features(input_csv))
+        self.assertEqual(len(features), 14)
+        self.assertEqual(features[0]["geometry"]["coordinates"], [-70.6323, -24.8174])
+        self.assertEqual(features[0]["properties"]["mag"], 6.2)
+        self.assertEqual(features[0]["properties"]["gap"], 45)
+        self.assertEqual(features[0]["properties"]["place"], "66km NNW of Taltal, Chile")
+
+
+    def csvtypes_test(self):
+        """ Testing that codes with leading zeros stay text and values past the sample do not mix types in a column """
+
+        input_csv = self.data_output_folder + "csvtypes.csv"
+        with open(input_csv, "w") as csv_file:
+            csv_file.write("lng,lat,code,count\n0,1,007,1\n0,1,010,2\n0,1,123,3.5\n0,1,020,n/a\n")
+        mismatches = {}
+        features = list(iter_csv_features(input_csv, sample_rows=2, mismatches=mismatches))
+        os.remove(input_csv)
+        self.assertEqual([feature["properties"]["code"] for feature in features], ["007", "010", "123", "020"])
+        self.assertEqual([feature["properties"]["count"] for feature in features], [1, 2, 3.5, None])
+        self.assertEqual(mismatches, { "count" : { "rows" : 1, "first_row" : 4, "value" : "n/a" } })
+
+
     def shp2geojson_test(self):
         """ Testing that Shapefile correctly translates to GeoJSON """
 
@@ -52,21 +124,67 @@ class conversionTest(unittest.TestCase):
         output_geojson_suffixed = output_geojson + ".geojson"
         self.assertTrue(os.path.exists(output_geojson_suffixed) == 1, msg="Current working directory is: {0}".format(os.getcwd()) )
         num_lines = sum(1 for line in open(output_geojson_suffixed))
-        self.assertTrue(num_lines == 136195)
+        self.assertTrue(num_lines == 16)
         self.assertTrue(validate_geojson_from_file(output_geojson_suffixed))
 
+    def zippedshp_test(self):
+        """ Testing that a zipped Shapefile is read from the archive, and can be simplified on the way """
+
+        input_zip = self.data_input_folder + "London Shapefile/Greater_London_Const_Region.zip"
+        input_shp = self.data_input_folder + "London Shapefile/Greater_London_Const_Region.shp"
+        features = list(iter_shapefile_features(input_zip))
+        self.assertEqual(features, list(iter_shapefile_features(input_shp)))
+        self.assertEqual(len(features), 14)
+
+        simplified = list(iter_shapefile_features(input_zip, tolerance=0.001, precision=5))
+        points = sum(len(ring) for feature in features for ring in feature["geometry"]["coordinates"])
+        simplified_points = sum(len(ring) for feature in simplified for ring in feature["geometry"]["coordinates"])
+        self.assertTrue(simplified_points < points / 2)
+        for feature in simplified:
+            for ring in feature["geometry"]["coordinates"]:
+                self.assertTrue(len(ring) >= 4 and ring[0] == ring[-1])
+
+    def zippedshp_members_test(self):
+        """ Testing that the .dbf and .shx read are those named as the first .shp in the archive, in any case """
+
+        folder = self.data_input_folder + "London Shapefile/Greater_London_Const_Region"
+        input_zip = self.data_output_folder + "members.zip"
+        with zipfile.ZipFile(input_zip, "w") as archive:
+            archive.write(folder + ".shp", "london/London.SHP")
+            archive.write(folder + ".dbf", "london/london.dbf")
+            archive.write(folder + ".shx", "london/LONDON.shx")
+            archive.write(folder + ".shp", "other/other.shp")
+            archive.writestr("other/other.dbf", "not a dbf")
+        try:
+            self.assertEqual(list(iter_shapefile_features(input_zip)), list(iter_shapefile_features(folder + ".shp")))
+            with zipfile.ZipFile(input_zip, "w") as archive:
+                archive.write(folder + ".shp", "london/london.shp")
+                archive.write(folder + ".dbf", "other/london.dbf")
+            self.assertRaises(ValueError, open_shapefile, input_zip)
+        finally:
+            os.remove(input_zip)
+
 
     def kml2geojson_test(self):
-        """ Testing that CSV correctly translates to GeoJSON """
+        """ Testing that KML correctly translates to GeoJSON """
 
         input_kml = self.data_input_folder + "placemark.kml"
         output_geojson = self.data_output_folder + "placemark.geojson"
         kml_to_geojson(input_kml, output_geojson)
         num_lines = sum(1 for line in open(output_geojson))
         self.assertTrue(os.path.exists(output_geojson) == 1, msg="Current working directory is: , {0}".format(os.getcwd()) )
-        self.assertTrue(num_lines == 19)
+        self.assertTrue(num_lines == 3)
         self.assertTrue(validate_geojson_from_file(output_geojson))
 
+    def geojsonstream_test(self):
+        """ Testing that features streamed from a GeoJSON file match the parsed file """
+        input_geojson = self.data_input_folder + "cupcakes.geojson"
+        with open(input_geojson) as data_file:
+            features = json.load(data_file)["features"]
+        with open(input_geojson, "rb") as data_file:
+            streamed = list(iter_geojson_features(data_file, read_size=7))
+        self.assertEqual(streamed, features)
+
     def geojson2mongo_test(self):
         """ Testing that GeoJSON correctly gets put into the MongoDB instance database """
         database = self.database
@@ -79,6 +197,16 @@ class conversionTest(unittest.TestCase):
         test_collection = json_util.dumps(feature_collection)
         self.assertTrue(count == 74, msg="Record count is " + str(count))
 
+    def failedload_test(self):
+        """ Testing that a load failing part way still gives the collection a new content version """
+        input_geojson = self.data_input_folder + "cupcakes.geojson"
+        feature_collection_to_mongodb(self.database, input_geojson, "testcupcakes")
+        version = self.db[METADATA_COLLECTION].find_one({ "_id" : "testcupcakes" })["version"]
+        with open(input_geojson, "rb") as data_file:
+            truncated = StringIO(data_file.read()[:-1000])
+        self.assertRaises(ValueError, ingest_features, self.db, "testcupcakes", iter_geojson_features(truncated), "truncated", batch_size=10)
+        self.assertNotEqual(self.db[METADATA_COLLECTION].find_one({ "_id" : "testcupcakes" })["version"], version)
+
     def geojsonurl2mongo_test(self):
         """ Testing that GeoJSON correctly gets put into the MongoDB instance database """
         database = self.database
@@ -90,6 +218,20 @@ class conversionTest(unittest.TestCase):
         test_collection = json_util.dumps(feature_collection)
         self.assertTrue(count == 74, msg="Record count is " + str(count))
 
+    def mongoconnection_test(self):
+        """ Testing that clients are shared within a process, made again after a fork, and configured for loads and stats """
+        connection = MongoConnection(host="localhost")
+        client = connection.client()
+        self.assertTrue(connection.client("localhost") is client)
+        self.assertFalse(connection.client("otherhost") is client)
+        connection.pid = -1 # As if this process had been forked
+        self.assertFalse(connection.client() is client)
+        self.assertEqual(get_write_concern("majority", True).document, { "w" : "majority", "j" : True })
+        self.assertEqual(get_write_concern("0").document, { "w" : 0 })
+        self.assertEqual(get_read_preference("secondaryPreferred"), ReadPreference.SECONDARY_PREFERRED)
+        self.assertRaises(ValueError, get_read_preference, "secondaries")
+        self.assertEqual(connection.get_stats_database("test").read_preference, ReadPreference.PRIMARY)
+
     def tearDown(self):
         self.db["testcupcakes"].drop();
         self.db["testurlcupcakes"].drop();
@@ -0,0 +1,55 @@
+import unittest
+import subprocess
+import sys
+import os
+
+try:
+    import gevent
+except ImportError:
+    gevent = None
+
+# gevent's monkey patching lasts for the whole process, so the server's setup is tried in a
+# process of its own
+ASYNC_SCRIPT = """
+import loxoasync
+from gevent import monkey
+get_ident = monkey.get_original("thread", "get_ident")
+loxoasync.configure(2)
+
+from loxoutils import run_cpu_bound
+from loxopairwise import pairwise_distance_sum
+from conversiontools.geojson2mongo import load_features
+import numpy as np
+
+random = np.random.RandomState(7)
+lons, lats = random.uniform(-1.0, 1.0, 600), random.uniform(50.0, 51.0, 600)
+assert run_cpu_bound(pairwise_distance_sum, lons, lats, "haversine", 100, 4) == pairwise_distance_sum(lons, lats, "haversine", 100, 1)
+
+threads = { "parse" : set(), "insert" : set() }
+def features():
+    for _ in range(10):
+        threads["parse"].add(get_ident())
+        yield { "type" : "Feature", "properties" : {}, "geometry" : None }
+class Collection(object):
+    def insert_many(self, batch, ordered):
+        threads["insert"].add(get_ident())
+assert load_features(Collection(), features(), batch_size=3) == 10
+assert threads["insert"] == set([get_ident()]) and get_ident() not in threads["parse"]
+"""
+
+class LoxoAsyncTest(unittest.TestCase):
+    """TestCase for serving under gevent"""
+
+    @unittest.skipIf(gevent is None, "gevent is not installed")
+    def cpu_executor_test(self):
+        """ Testing that under gevent pairwise sums run without process pools, and loads are parsed off the event loop """
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        environment = dict(os.environ, PYTHONPATH=root)
+        process = subprocess.Popen([sys.executable, "-c", ASYNC_SCRIPT], cwd=root, env=environment,
+                                   stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        output = process.communicate()[0]
+        self.assertEqual(process.returncode, 0, msg=output)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,127 @@
+import unittest
+import tempfile
+from werkzeug.datastructures import MultiDict
+from flask import Flask, Response
+from datetime import datetime
+from loxocache import *
+
+class MetadataCollection(object):
+    """Stands in for the metadata collection of one database"""
+
+    def __init__(self, documents):
+        self.documents = documents
+        self.sessions = []
+
+    def find_one(self, query, **options):
+        self.sessions.append(options.get("session"))
+        return self.documents.get(query["_id"])
+
+class LoxoCacheTest(unittest.TestCase):
+    """TestCase for the dataset and response caches"""
+
+    def normalize_query_test(self):
+        """ Testing that query keys do not depend on the order of the arguments """
+        first = normalize_query("db", "ds", "/path", MultiDict([("limit", "5"), ("fields", "v")]))
+        second = normalize_query("db", "ds", "/path", MultiDict([("fields", "v"), ("limit", "5")]))
+        self.assertEqual(first, second)
+        self.assertNotEqual(first, normalize_query("db", "other", "/path", MultiDict([("limit", "5")])))
+
+    def memory_backend_test(self):
+        """ Testing that the memory backend evicts least recently used entries past its size """
+        backend = MemoryBackend(max_bytes=10)
+        backend.set("a", "xxxx")
+        backend.set("b", "xxxx")
+        backend.get("a")
+        backend.set("c", "xxxx")
+        self.assertEqual(backend.get("b"), None)
+        self.assertEqual(backend.get("a"), "xxxx")
+        self.assertEqual(backend.evictions, 1)
+
+    def response_cache_test(self):
+        """ Testing that streamed responses are cached and retired when the dataset version changes """
+        cache = ResponseCache(MemoryBackend(), max_entry_bytes=100)
+        key = cache.key("db", "ds", "/path", MultiDict())
+        response = cache.store(key, Response(iter(["[1,", "2]"]), mimetype="application/json"))
+        self.assertEqual(cache.get(key), None)
+        self.assertEqual("".join(response.response), "[1,2]")
+        self.assertEqual(cache.get(key).get_data(), "[1,2]")
+        self.assertEqual(cache.hits, 1)
+
+        cache.bump_version("db", "ds")
+        self.assertNotEqual(cache.key("db", "ds", "/path", MultiDict()), key)
+        self.assertEqual(cache.backend.size, 0)
+
+    def oversize_response_test(self):
+        """ Testing that streamed responses larger than an entry are not cached """
+        cache = ResponseCache(MemoryBackend(), max_entry_bytes=4)
+        key = cache.key("db", "ds", "/path", MultiDict())
+        response = cache.store(key, Response(iter(["[1,", "2]"]), mimetype="application/json"))
+        self.assertEqual("".join(response.response), "[1,2]")
+        self.assertEqual(cache.get(key), None)
+        self.assertEqual(cache.oversize, 1)
+
+    def conditional_response_test(self):
+        """ Testing that matching If-None-Match requests get a 304 without running the view """
+        metadata = { "ds" : { "version" : u"abc", "modified" : datetime(2016, 1, 1, 12, 0, 0, 500) } }
+        calls = []
+        @conditional_response(lambda database: { METADATA_COLLECTION : MetadataCollection(metadata) })
+        def view(database, dataset):
+            calls.append(dataset)
+            return Response("[]", mimetype="application/json")
+
+        app = Flask(__name__)
+        with app.test_request_context("/loxo/db/collections/ds?limit=5"):
+            response = view("db", "ds")
+            etag = response.get_etag()[0]
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.last_modified, datetime(2016, 1, 1, 12, 0, 0))
+        with app.test_request_context("/loxo/db/collections/ds?limit=5", headers={ "If-None-Match" : '"' + etag + '"' }):
+            self.assertEqual(view("db", "ds").status_code, 304)
+        with app.test_request_context("/loxo/db/collections/ds?limit=6", headers={ "If-None-Match" : '"' + etag + '"' }):
+            self.assertEqual(view("db", "ds").status_code, 200)
+        self.assertEqual(len(calls), 2)
+
+    def conditional_response_session_test(self):
+        """ Testing that the content version is read in the session the view reads its data in """
+        collection = MetadataCollection({ "ds" : { "version" : u"abc", "modified" : datetime(2016, 1, 1) } })
+        @conditional_response(lambda database: { METADATA_COLLECTION : collection }, lambda database: "session:" + database)
+        def view(database, dataset):
+            return Response("[]", mimetype="application/json")
+
+        with Flask(__name__).test_request_context("/loxo/db/collections/ds/stats/count"):
+            self.assertEqual(view("db", "ds").status_code, 200)
+        self.assertEqual(collection.sessions, ["session:db"])
+
+    def content_version_test(self):
+        """ Testing that cached responses are retired by a new content version, kept apart by host, and not cached without a version """
+        metadata = { "versioned" : { "version" : u"one", "modified" : datetime(2016, 1, 1) } }
+        calls = []
+        @conditional_response(lambda database: { METADATA_COLLECTION : MetadataCollection(metadata) })
+        @cache_response
+        def view(database, dataset):
+            calls.append((dataset, request.host))
+            return Response(request.base_url, mimetype="application/json")
+
+        app = Flask(__name__)
+        for dataset, host, version in [("versioned", "a", "one"), ("versioned", "a", "one"), ("versioned", "b", "one"),
+                                       ("versioned", "a", "two"), ("unversioned", "a", None), ("unversioned", "a", None)]:
+            if version:
+                metadata["versioned"]["version"] = version
+            with app.test_request_context("/loxo/db/collections/" + dataset + "/tiles", base_url="http://" + host):
+                self.assertEqual(view("db", dataset).get_data(), "http://" + host + "/loxo/db/collections/" + dataset + "/tiles")
+        self.assertEqual(calls, [("versioned", "a"), ("versioned", "b"), ("versioned", "a"), ("unversioned", "a"), ("unversioned", "a")])
+
+    def array_cache_version_test(self):
+        """ Testing that spilled arrays are kept per content version, and a new version's spill removes the old ones """
+        directory = tempfile.mkdtemp()
+        try:
+            cache = ArrayCache(1, directory)
+            cache.put(("db", "ds", "one", "points"), { "lons" : np.arange(3.0) })
+            cache.put(("db", "ds", "two", "points"), { "lons" : np.arange(4.0) })
+            self.assertTrue(os.path.exists(cache.spill_path(("db", "ds", "one", "points"))))
+            self.assertEqual(cache.get(("db", "ds", "three", "points")), None)
+            cache.put(("db", "ds", "three", "points"), { "lons" : np.arange(5.0) })
+            self.assertFalse(os.path.exists(cache.spill_path(("db", "ds", "one", "points"))))
+            self.assertEqual(len(cache.get(("db", "ds", "two", "points"))["lons"]), 4)
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
@@ -0,0 +1,42 @@
+import unittest
+import numpy as np
+from loxocluster import *
+
+class LoxoClusterTest(unittest.TestCase):
+    """TestCase for the hierarchical point clustering module"""
+
+    def setUp(self):
+        random = np.random.RandomState(42)
+        self.lons = np.concatenate([random.normal(-0.1, 0.05, 200), random.uniform(-10, 10, 100)])
+        self.lats = np.concatenate([random.normal(51.5, 0.05, 200), random.uniform(40, 60, 100)])
+        self.values = random.uniform(0, 10, 300)
+        self.index = ClusterIndex(self.lons, self.lats, np.arange(300), { "rating" : self.values })
+
+    def point_counts(self, features, points):
+        return sum(feature["properties"]["point_count"] for feature in features) + len(points)
+
+    def cluster_counts_test(self):
+        """ Testing that every point is counted once at every zoom """
+        for zoom in (0, 4, 8, 12, 17):
+            features, points = self.index.get_clusters([-180, -90, 180, 90], zoom)
+            self.assertEqual(self.point_counts(features, points), 300)
+        features, points = self.index.get_clusters([-180, -90, 180, 90], 0)
+        self.assertEqual(len(features), 1)
+        self.assertAlmostEqual(features[0]["properties"]["rating"]["sum"], self.values.sum())
+        self.assertAlmostEqual(features[0]["properties"]["rating"]["max"], self.values.max())
+        features, points = self.index.get_clusters([-180, -90, 180, 90], CLUSTER_MAX_ZOOM + 1)
+        self.assertEqual((len(features), sorted(points)), (0, range(300)))
+
+    def cluster_bbox_test(self):
+        """ Testing that only clusters within the bbox are returned, including across the antimeridian """
+        features, points = self.index.get_clusters([-1, 51, 1, 52], 14)
+        self.assertTrue(all(-1 <= self.lons[point] <= 1 for point in points))
+        for feature in features:
+            lon, lat = feature["geometry"]["coordinates"]
+            self.assertTrue(-1 <= lon <= 1 and 51 <= lat <= 52)
+        index = ClusterIndex(np.array([179.5, -179.5, 0.0]), np.array([0.0, 0.0, 0.0]), np.array([0, 1, 2]))
+        self.assertEqual(sorted(index.get_clusters([179, -10, -179, 10], 10)[1]), [0, 1])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,60 @@
+import unittest
+import json
+from werkzeug.datastructures import MIMEAccept
+from loxoformats import *
+from loxoproto import encode_geobuf_geometry, zigzag
+
+class LoxoFormatsTest(unittest.TestCase):
+    """TestCase for the output formats of feature collections"""
+
+    def setUp(self):
+        self.features = [
+            { "type" : "Feature", "geometry" : { "type" : "Polygon", "coordinates" : [[[0, 0], [1, 0], [1, 1], [0, 1], [0, 0]]] }, "properties" : { "loxo_id" : 0 } },
+            { "type" : "Feature", "geometry" : { "type" : "Polygon", "coordinates" : [[[1, 0], [2, 0], [2, 1], [1, 1], [1, 0]]] }, "properties" : { "loxo_id" : 1 } },
+        ]
+
+    def output_options_test(self):
+        """ Testing that the format comes from the format argument, then the accept header """
+        self.assertEqual(get_output_options({}), { "format" : "geojson", "precision" : None })
+        self.assertEqual(get_output_options({ "format" : "topojson", "precision" : "4" }), { "format" : "topojson", "precision" : 4 })
+        accept = MIMEAccept([("application/x-protobuf", 1)])
+        self.assertEqual(get_output_options({}, accept)["format"], "geobuf")
+        self.assertEqual(get_output_options({ "format" : "geojson" }, accept)["format"], "geojson")
+        self.assertEqual(get_output_options({}, MIMEAccept([("*/*", 1)]))["format"], "geojson")
+        self.assertRaises(ValueError, get_output_options, { "format" : "kml" })
+        self.assertRaises(ValueError, get_output_options, { "precision" : "-1" })
+
+    def geojson_precision_test(self):
+        """ Testing that compact GeoJSON rounds coordinates and pages as before """
+        features = [{ "type" : "Feature", "geometry" : { "type" : "Point", "coordinates" : [0.123456, 51.987654] }, "properties" : { "loxo_id" : 7 } }] * 2
+        options = { "format" : "geojson", "precision" : 3 }
+        collection = json.loads("".join(iter_output(iter(features), options, "points", 1, lambda after: "next/" + str(after))))
+        self.assertEqual(collection["features"][0]["geometry"]["coordinates"], [0.123, 51.988])
+        self.assertEqual(collection["next"], "next/7")
+        self.assertEqual(features[0]["geometry"]["coordinates"], [0.123456, 51.987654])
+
+    def topojson_test(self):
+        """ Testing that neighbouring polygons share their border arc, quantized when a precision is given """
+        topology = json.loads("".join(iter_topojson(iter(self.features), "areas")))
+        geometries = topology["objects"]["areas"]["geometries"]
+        self.assertEqual(len(topology["arcs"]), 3)
+        self.assertEqual(geometries[0]["arcs"][0][0], ~geometries[1]["arcs"][0][1])
+        self.assertEqual(geometries[1]["properties"], { "loxo_id" : 1 })
+        topology = json.loads("".join(iter_topojson(iter(self.features), "areas", precision=2)))
+        self.assertEqual(topology["transform"], { "scale" : [0.01, 0.01], "translate" : [0, 0] })
+        self.assertEqual(topology["arcs"][0], [[100, 0], [0, 100]])
+
+    def geobuf_test(self):
+        """ Testing that geometries are written as geobuf does, and streamed as length delimited collections """
+        point = encode_geobuf_geometry({ "type" : "Point", "coordinates" : [1.5, -2] }, 10)
+        self.assertEqual(point, "\x08\x00\x1a\x02" + chr(zigzag(15)) + chr(zigzag(-20)))
+        polygon = encode_geobuf_geometry(self.features[0]["geometry"], 1)
+        self.assertEqual(polygon, "\x08\x04\x1a\x08" + "".join(chr(zigzag(value)) for value in [0, 0, 1, 0, 0, 1, -1, 0]))
+        chunks = list(iter_geobuf(iter(self.features)))
+        self.assertEqual(len(chunks), 1)
+        self.assertEqual(ord(chunks[0][0]), len(chunks[0]) - 1)
+        self.assertEqual(chunks[0][1:11], "\x0a\x07loxo_id\x22")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,51 @@
+import unittest
+import numpy as np
+from loxoindex import *
+
+class LoxoIndexTest(unittest.TestCase):
+    """TestCase for the spherical spatial index module"""
+
+    def setUp(self):
+        random = np.random.RandomState(42)
+        self.lons = random.uniform(-2.0, 2.0, 60)
+        self.lats = random.uniform(50.0, 53.0, 60)
+        i, j = np.triu_indices(len(self.lons), 1)
+        self.distances = geodesic_distances(self.lons[i], self.lats[i], self.lons[j], self.lats[j])
+
+    def chord_conversion_test(self):
+        """ Testing that chord lengths and great circle distances convert back and forth """
+        self.assertAlmostEqual(chord_to_meters(meters_to_chord(64105.0)), 64105.0, places=6)
+        self.assertAlmostEqual(meters_to_chord(np.pi * MEAN_EARTH_RADIUS), 2.0)
+
+    def closest_pair_test(self):
+        """ Testing that the KD-tree closest pair matches a brute force search """
+        i, j, distance = closest_pair(self.lons, self.lats)
+        self.assertAlmostEqual(distance, self.distances.min(), places=6)
+        self.assertAlmostEqual(get_WGS84_distance(self.lats[i], self.lons[i], self.lats[j], self.lons[j]), distance, places=6)
+
+    def closest_duplicate_pair_test(self):
+        """ Testing that duplicate points are a closest pair at distance 0, without gathering every coincident pair """
+        lons = np.append(self.lons, [self.lons[5]] * 2000)
+        lats = np.append(self.lats, [self.lats[5]] * 2000)
+        i, j, distance = closest_pair(lons, lats)
+        self.assertEqual(distance, 0.0)
+        self.assertTrue(i < j and (lons[i], lats[i]) == (lons[j], lats[j]))
+
+    def farthest_pair_test(self):
+        """ Testing that the spherical hull farthest pair matches a brute force search """
+        i, j, distance = farthest_pair(self.lons, self.lats)
+        self.assertAlmostEqual(distance, self.distances.max(), places=6)
+        self.assertTrue(i in spherical_hull(to_unit_vectors(self.lons, self.lats)))
+
+    def farthest_pair_global_test(self):
+        """ Testing that datasets spanning the globe fall back to an exhaustive search """
+        lons = np.array([0.0, 90.0, 180.0, -90.0, 10.0])
+        lats = np.array([0.0, 10.0, 0.0, 20.0, 89.0])
+        self.assertTrue(spherical_hull(to_unit_vectors(lons, lats)) is None)
+        i, j, distance = farthest_pair(lons, lats)
+        self.assertEqual(sorted([i, j]), [0, 2])
+        self.assertAlmostEqual(distance, get_WGS84_distance(0.0, 0.0, 0.0, 180.0), places=6)
+
+
+if __name__ == '__main__':
+    unittest.main()
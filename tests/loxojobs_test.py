@@ -0,0 +1,35 @@
+import unittest
+import time
+from loxojobs import *
+
+class LoxoJobsTest(unittest.TestCase):
+    """TestCase for the background ingestion jobs"""
+
+    def wait(self, job):
+        for _ in xrange(100):
+            if job.done():
+                return
+            time.sleep(0.01)
+
+    def finished_job_test(self):
+        """ Testing that a job runs in the background and reports its progress """
+        def run(job):
+            job.set_phase("loading")
+            job.progress(50, 0.5)
+        job = JobQueue(workers=2).submit(IngestJob("db", "dataset", "uploads/dataset.geojson"), run)
+        self.wait(job)
+        status = job.to_dict()
+        self.assertEqual(status["phase"], "finished")
+        self.assertEqual(status["features"], 50)
+        self.assertEqual(status["file"], "dataset.geojson")
+        self.assertEqual(status["mismatches"], {})
+
+    def failed_job_test(self):
+        """ Testing that errors raised by a job are recorded against it """
+        def run(job):
+            raise ValueError("Bad file")
+        queue = JobQueue(workers=1)
+        job = queue.submit(IngestJob("db", "dataset", "dataset.csv"), run)
+        self.wait(job)
+        self.assertEqual(queue.get(job.id).phase, "failed")
+        self.assertEqual(job.errors, ["Bad file"])
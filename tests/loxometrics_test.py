@@ -0,0 +1,52 @@
+import unittest
+from loxometrics import *
+
+class LoxoMetricsTest(unittest.TestCase):
+    """TestCase for the Prometheus metrics"""
+
+    def histogram_test(self):
+        """ Testing that histograms are written with cumulative buckets, a sum and a count """
+        histogram = Histogram("test_seconds", "A test histogram", ("route",), (0.1, 1.0))
+        for value in (0.05, 0.1, 0.5, 2.0):
+            histogram.observe(value, "/a")
+        lines = histogram.render()
+        self.assertEqual(lines[:2], ["# HELP test_seconds A test histogram", "# TYPE test_seconds histogram"])
+        self.assertEqual(lines[2:], [
+            'test_seconds_bucket{route="/a",le="0.1"} 2',
+            'test_seconds_bucket{route="/a",le="1.0"} 3',
+            'test_seconds_bucket{route="/a",le="+Inf"} 4',
+            'test_seconds_sum{route="/a"} 2.65',
+            'test_seconds_count{route="/a"} 4',
+        ])
+
+    def counter_test(self):
+        """ Testing that counters add up per label value, with label values escaped """
+        counter = Counter("test_total", "A test counter", ("name",))
+        counter.inc(2, 'say "hi"')
+        counter.inc(1, 'say "hi"')
+        self.assertEqual(counter.render()[2:], ['test_total{name="say \\"hi\\""} 3.0'])
+
+    def timed_serialization_test(self):
+        """ Testing that chunks pass through and Mongo time is left out of serialization time """
+        def chunks():
+            mongo_time.seconds = get_mongo_seconds() + 100.0 # As if a getMore took 100s
+            yield "a"
+            yield "b"
+        before = serialization_seconds.values[("test",)]
+        self.assertEqual(list(timed_serialization(chunks(), "test")), ["a", "b"])
+        self.assertTrue(0 <= serialization_seconds.values[("test",)] - before < 1)
+        self.assertEqual(timed_kernel(len)([1, 2]), 2)
+        self.assertEqual(kernel_duration.values[("len",)][0][0], 1)
+
+    def pairwise_progress_test(self):
+        """ Testing that pairwise sums count their planned and summed tiles """
+        from loxopairwise import pairwise_distance_sum
+        import numpy as np
+        planned, summed = pairwise_tiles_planned.values[()], pairwise_tiles_summed.values[()]
+        pairwise_distance_sum(np.arange(10.0), np.zeros(10), "haversine", 4, 1, progress=record_pairwise_progress)
+        self.assertEqual(pairwise_tiles_planned.values[()] - planned, 6)
+        self.assertEqual(pairwise_tiles_summed.values[()] - summed, 6)
+
+
+if __name__ == '__main__':
+    unittest.main()
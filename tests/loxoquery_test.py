@@ -0,0 +1,44 @@
+import unittest
+from loxoquery import *
+
+class LoxoQueryTest(unittest.TestCase):
+    """TestCase for building collection queries from their arguments"""
+
+    def build_query_test(self):
+        """ Testing that filter arguments become the matching Mongo finds """
+        self.assertEqual(build_query({}), { "find" : {} })
+        self.assertEqual(build_query({ "limit" : "10" }), { "find" : {} })
+        self.assertEqual(build_query({ "property" : "name", "value" : "a" }), { "find" : { "properties.name" : "a" } })
+        proximity = build_query({ "withinProximity" : "0,51,6378.1" })["find"]["geometry"]["$geoWithin"]["$centerSphere"]
+        self.assertEqual(proximity[0], [0, 51])
+        self.assertAlmostEqual(proximity[1], 0.001)
+        polygon = build_query({ "withinPolygon" : "[[0, 0], [1, 0], [1, 1]]" })["find"]["geometry"]["$geoWithin"]["$geometry"]
+        self.assertEqual(polygon["coordinates"], [[[0, 0], [1, 0], [1, 1], [0, 0]]])
+        nearest = build_query({ "kNearest" : "0,51,5" })
+        self.assertEqual((nearest["near"], nearest["k"]), ([0, 51], 5))
+
+    def invalid_query_test(self):
+        """ Testing that malformed and unknown arguments are refused """
+        self.assertRaises(InvalidQuery, build_query, { "withinProximity" : "0,51" })
+        self.assertRaises(InvalidQuery, build_query, { "withinBBox" : "0,10,1,5" })
+        self.assertRaises(InvalidQuery, build_query, { "withinPolygon" : "[[0, 0], " })
+        self.assertRaises(InvalidQuery, build_query, { "intersects" : '{"type" : "Point"}' })
+        self.assertRaises(InvalidQuery, build_query, { "intersects" : '{"type" : "Polygon", "coordinates" : [[1, 2, 3, 4]]}' })
+        self.assertRaises(InvalidQuery, build_query, { "withinPolygon" : "[]" })
+        self.assertRaises(InvalidQuery, build_query, { "withinPolygon" : "[[0, 0], [1, 1], [0, 0]]" })
+        self.assertRaises(InvalidQuery, build_query, { "kNearest" : "0,51,0" })
+        self.assertRaises(InvalidQuery, build_query, { "kNearest" : "0,51,-3" })
+        self.assertRaises(InvalidQuery, build_query, { "near" : "0,51" })
+        self.assertEqual(build_query({ "format" : "geobuf" }, ["format"]), { "find" : {} })
+
+    def query_spec_args_test(self):
+        """ Testing that batch query specs are read as the query string would be """
+        args = query_spec_args({ "kNearest" : [0, 51.5, 3], "intersects" : { "type" : "Point", "coordinates" : [0, 1] }, "limit" : 10 })
+        self.assertEqual(args["kNearest"], "0,51.5,3")
+        self.assertEqual(args["limit"], "10")
+        self.assertEqual(build_query({ "intersects" : args["intersects"] })["find"]["geometry"]["$geoIntersects"]["$geometry"]["coordinates"], [0, 1])
+        self.assertRaises(InvalidQuery, query_spec_args, ["withinBBox", "0,0,1,1"])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,44 @@
+import unittest
+import numpy as np
+from loxotiles import *
+
+class LoxoTilesTest(unittest.TestCase):
+    """TestCase for map tiles and the vector tile encoder"""
+
+    def varint_test(self):
+        """ Testing that integers are written as protobuf varints and zigzag encoded """
+        self.assertEqual(encode_varint(1), "\x01")
+        self.assertEqual(encode_varint(300), "\xac\x02")
+        self.assertEqual([zigzag(value) for value in (0, -1, 1, -2)], [0, 1, 2, 3])
+        self.assertEqual(encode_geometry("Point", [[[25, 17]]]), [9, 50, 34])
+
+    def tile_bounds_test(self):
+        """ Testing that tiles are projected to and from web mercator """
+        west, south, east, north = tile_bounds(1, 1, 0)
+        self.assertAlmostEqual(west, 0.0)
+        self.assertAlmostEqual(east, 180.0)
+        self.assertAlmostEqual(south, 0.0)
+        self.assertAlmostEqual(north, MAX_LATITUDE, 6)
+        self.assertEqual(list(covering_tiles([-1, 51, 1, 52], 2)), [(1, 1), (2, 1)])
+
+    def clipping_test(self):
+        """ Testing that lines and rings are clipped to the tile """
+        parts = clip_line(np.array([[-100.0, 10.0], [50.0, 10.0], [50.0, -100.0]]), 0, 100)
+        self.assertEqual(len(parts), 1)
+        self.assertEqual(parts[0].tolist(), [[0.0, 10.0], [50.0, 10.0], [50.0, 0.0]])
+        ring = clip_ring(np.array([[-50.0, -50.0], [50.0, -50.0], [50.0, 50.0], [-50.0, 50.0], [-50.0, -50.0]]), 0, 100)
+        self.assertEqual(abs(ring_area(ring.tolist())), 2500)
+
+    def tile_geometry_test(self):
+        """ Testing that features are clipped, quantized and left out of tiles they are not on """
+        polygon = [[[-1, 51], [1, 51], [1, 52], [-1, 52], [-1, 51]]]
+        self.assertEqual(tile_geometry("Polygon", [polygon], 8, 100, 85), [])
+        tiled = tile_geometry("Polygon", [polygon], 8, 127, 85)
+        self.assertEqual(len(tiled), 1)
+        self.assertTrue(all(isinstance(value, (int, long)) for position in tiled[0][0] for value in position))
+        self.assertEqual(tile_geometry("Point", [[0.2, 51.2]], 8, 127, 85), [])
+        self.assertEqual(len(tile_geometry("Point", [[0.2, 51.2]], 8, 128, 85)), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -13,6 +13,118 @@ class LoxoTest(unittest.TestCase):
         """ Testing that distance calculations between WGS84 coordinates are correct """
         self.assertAlmostEqual(get_WGS84_distance(55.5, -0.5, 55.0, 0), 64105.67608673149)
 
+    def get_distances_test(self):
+        """ Testing that the batch distance kernels agree with the geodesic within their error bounds """
+        lons1 = [-0.5, 10.0, -179.5, 30.0]
+        lats1 = [55.5, 0.0, 0.5, 45.0]
+        lons2 = [0.0, 10.0, 0.0, 30.0]
+        lats2 = [55.0, 1.0, -0.5, 45.0]
+        exact = get_distances(lons1, lats1, lons2, lats2, "geodesic")
+        self.assertAlmostEqual(exact[0], 64105.67608673149)
+        self.assertEqual(exact[3], 0)
+        vincenty = get_distances(lons1, lats1, lons2, lats2, "vincenty")
+        for i in range(len(exact)):
+            self.assertAlmostEqual(vincenty[i], exact[i], places=3)
+        haversine = get_distances(lons1, lats1, lons2, lats2, "haversine")
+        for i in range(3):
+            self.assertTrue(abs(haversine[i] - exact[i]) / exact[i] < 0.0057)
+
+    def get_distance_block_test(self):
+        """ Testing that distance blocks hold the distance from every row point to every column point """
+        block = get_distance_block([-0.5, 0.0], [55.5, 55.0], [0.0, -0.5, 1.0], [55.0, 55.5, 55.0])
+        self.assertEqual(block.shape, (2, 3))
+        self.assertAlmostEqual(block[0, 0], 64105.67608673149, places=3)
+        self.assertAlmostEqual(block[1, 1], block[0, 0], places=3)
+        self.assertEqual(block[0, 1], 0)
+
+    def iter_feature_collection_test(self):
+        """ Testing that streamed FeatureCollections are compact, valid JSON """
+        features = [{ "type" : "Feature", "geometry" : { "type" : "Point", "coordinates" : [i, i] }, "properties" : { "loxo_id" : i } } for i in range(5000)]
+        chunks = list(iter_feature_collection(iter(features)))
+        self.assertTrue(len(chunks) > 3)
+        collection = "".join(chunks)
+        self.assertEqual(loads(collection), { "type" : "FeatureCollection", "features" : features })
+        self.assertTrue(", " not in collection and "\n" not in collection)
+        self.assertEqual(loads("".join(iter_feature_collection([]))), { "type" : "FeatureCollection", "features" : [] })
+
+    def paged_feature_collection_test(self):
+        """ Testing that a limited FeatureCollection links to the page after its last feature """
+        features = [{ "type" : "Feature", "geometry" : None, "properties" : { "loxo_id" : i } } for i in range(4)]
+        page = loads("".join(iter_feature_collection(features, 3, lambda after: "?after=" + str(after))))
+        self.assertEqual(len(page["features"]), 3)
+        self.assertEqual(page["next"], "?after=2")
+        last_page = loads("".join(iter_feature_collection(features[:3], 3, lambda after: "?after=" + str(after))))
+        self.assertFalse("next" in last_page)
+
+    def get_page_options_test(self):
+        """ Testing that paging arguments are parsed and projected into Mongo """
+        page = get_page_options({ "limit" : "100", "after" : "250", "fields" : "name, rating" })
+        self.assertEqual(page, { "limit" : 100, "after" : 250, "fields" : ["name", "rating"] })
+        projection = get_projection(page["fields"])
+        self.assertEqual(projection["properties.rating"], 1)
+        self.assertEqual(projection["properties.loxo_id"], 1)
+        self.assertEqual(projection["_id"], 0)
+        self.assertRaises(ValueError, get_page_options, { "limit" : "0" })
+
+    def get_detail_level_test(self):
+        """ Testing that zoom and simplify pick the coarsest stored level that is fine enough """
+        self.assertEqual(get_detail_level({}), None)
+        self.assertEqual(get_detail_level({ "zoom" : "3" }), "3")
+        self.assertEqual(get_detail_level({ "zoom" : "4" }), "6")
+        self.assertEqual(get_detail_level({ "zoom" : "20" }), None)
+        self.assertEqual(get_detail_level({ "simplify" : "0.01" }), "9")
+        self.assertRaises(ValueError, get_detail_level, { "zoom" : "-1" })
+        projection = get_projection(["name"], "6")
+        self.assertEqual(projection["loxo_lod.6"], 1)
+        self.assertEqual(get_projection()["loxo_lod"], 0)
+
+    def run_cpu_bound_test(self):
+        """ Testing that CPU heavy work runs in place, or through the executor when one is set """
+        self.assertEqual(run_cpu_bound(pow, 2, 3), 8)
+        calls = []
+        set_cpu_executor(lambda function, *args, **kwargs: calls.append(function) or function(*args, **kwargs))
+        try:
+            self.assertEqual(run_cpu_bound(pow, 2, 4), 16)
+        finally:
+            set_cpu_executor(None)
+        self.assertEqual([function.__name__ for function in calls], ["pow"])
+
+    def get_bbox_query_test(self):
+        """ Testing that bbox queries use strict winding polygons and split at the antimeridian """
+        query = get_bbox_query(-1, 51, 1, 52)
+        polygon = query["geometry"]["$geoWithin"]["$geometry"]
+        self.assertEqual(polygon["crs"], STRICT_WINDING_CRS)
+        self.assertEqual(polygon["coordinates"][0][0], polygon["coordinates"][0][-1])
+        self.assertEqual(polygon["coordinates"][0][:2], [[-1.0, 51], [0.0, 51]])
+        query = get_bbox_query(170, -10, -170, 10, "$geoIntersects")
+        self.assertEqual(len(query["$or"]), 2)
+        self.assertTrue("$geoIntersects" in query["$or"][1]["geometry"])
+        self.assertRaises(ValueError, get_bbox_query, 0, 10, 1, 5)
+        self.assertRaises(ValueError, get_bbox_query, -190, 0, 1, 5)
+        self.assertRaises(ValueError, get_bbox_query, 1, 0, 1, 5)
+        self.assertRaises(ValueError, get_bbox_query, 0, 5, 1, 5)
+        self.assertRaises(ValueError, get_bbox_query, 180, 0, -180, 5)
+        self.assertEqual(get_bbox_query(180, 0, -170, 5), get_bbox_query(-180, 0, -170, 5))
+
+    def find_features_by_id_test(self):
+        """ Testing that features are found by id a batch at a time, as they are consumed """
+        class Collection(object):
+            name = "ids"
+            database = type("Database", (object,), { "name" : "test" })
+            queries = []
+            def create_index(self, keys, **options):
+                pass
+            def find(self, query, projection):
+                self.queries.append(query[LOXO_ID]["$in"])
+                return [{ "properties" : { "loxo_id" : id } } for id in query[LOXO_ID]["$in"]]
+
+        collection = Collection()
+        features = find_features_by_id(collection, [4, 0, 3, 1, 2], batch_size=2)
+        self.assertEqual(collection.queries, [])
+        self.assertEqual([feature["properties"]["loxo_id"] for feature in features], [0, 1, 2, 3, 4])
+        self.assertEqual(collection.queries, [[0, 1], [2, 3], [4]])
+        self.assertEqual(list(find_features_by_id(collection, [])), [])
+
 
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
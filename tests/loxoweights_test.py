@@ -0,0 +1,59 @@
+import unittest
+import numpy as np
+from loxoweights import *
+
+class LoxoWeightsTest(unittest.TestCase):
+    """TestCase for the spatial weights module"""
+
+    def setUp(self):
+        random = np.random.RandomState(7)
+        self.lons = random.uniform(-1.0, 1.0, 120)
+        self.lats = random.uniform(50.0, 51.0, 120)
+        self.values = random.uniform(0.0, 10.0, 120) + self.lons
+
+    def knn_weights_test(self):
+        """ Testing that k nearest neighbour weights link every point to k other points """
+        weights = knn_weights(self.lons, self.lats, 4)
+        self.assertEqual(weights.nnz, 4 * 120)
+        self.assertEqual(weights.diagonal().sum(), 0)
+        self.assertTrue((np.asarray(weights.sum(axis=1)).ravel() == 4).all())
+
+    def band_weights_test(self):
+        """ Testing that distance band weights link exactly the pairs within the band """
+        weights = band_weights(self.lons, self.lats, 10000.0, "geodesic")
+        i, j = np.triu_indices(120, 1)
+        distances = geodesic_distances(self.lons[i], self.lats[i], self.lons[j], self.lats[j])
+        self.assertEqual(weights.nnz, 2 * (distances <= 10000.0).sum())
+        self.assertEqual((weights - weights.T).nnz, 0)
+
+    def autocorrelation_test(self):
+        """ Testing that the sparse Moran's I and Geary's C match their dense definitions """
+        spec = parse_weights_spec({ "weights" : "idw", "d" : "20000", "power" : "2" })
+        weights = build_weights(self.lons, self.lats, spec)
+        dense = weights.toarray()
+        z = self.values - self.values.mean()
+        n = len(z)
+        expected_i = n / dense.sum() * z.dot(dense).dot(z) / z.dot(z)
+        differences = (self.values[:, np.newaxis] - self.values[np.newaxis, :]) ** 2
+        expected_c = (n - 1) * (dense * differences).sum() / (2 * dense.sum() * z.dot(z))
+        self.assertAlmostEqual(morans_i(weights, self.values), expected_i)
+        self.assertAlmostEqual(gearys_c(weights, self.values), expected_c)
+
+    def undefined_autocorrelation_test(self):
+        """ Testing that constant attributes and weights without neighbours are refused rather than giving NaN """
+        weights = knn_weights(self.lons, self.lats, 4)
+        check_autocorrelation(weights, self.values)
+        self.assertRaises(InvalidUsage, check_autocorrelation, weights, np.ones(120))
+        self.assertRaises(InvalidUsage, check_autocorrelation, weights, np.append(self.values[1:], np.nan))
+        no_neighbours = band_weights(self.lons, self.lats, 1.0)
+        self.assertRaises(InvalidUsage, check_autocorrelation, no_neighbours, self.values)
+
+    def parse_weights_spec_test(self):
+        """ Testing that weights parameters are validated """
+        self.assertEqual(parse_weights_spec({}), { "weights" : "knn", "k" : 8, "transform" : "b" })
+        self.assertRaises(InvalidUsage, parse_weights_spec, { "weights" : "band" })
+        self.assertRaises(InvalidUsage, parse_weights_spec, { "weights" : "queen" })
+
+
+if __name__ == '__main__':
+    unittest.main()